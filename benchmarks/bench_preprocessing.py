@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of page preprocessing: the fused `preprocess_image` against the
+original `_grayscale` -> `_binarize` -> `_denoise` chain.
+
+Uses synthetic A4 pages at `config.OCR_DPI` so it runs without poppler,
+and checks the two give exactly the same pixels.
+
+Usage:
+    python benchmarks/bench_preprocessing.py [--pages N] [--repeats N]
+"""
+import argparse
+import timeit
+
+import PIL.Image
+import numpy as np
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.utils.configuration as configuration
+
+config = configuration.get_config()
+
+A4_INCHES = (8.27, 11.69)
+
+
+def synthetic_page(seed):
+    """RGB scan of an A4 page with blocks of 'text' and some specks"""
+    rng = np.random.default_rng(seed)
+    width, height = (int(inches * config.OCR_DPI) for inches in A4_INCHES)
+
+    page = rng.normal(225, 20, size=(height, width)).astype(np.float32)
+    for _ in range(2000):
+        top, left = rng.integers(0, height - 40), rng.integers(0, width - 200)
+        page[
+            top : top + rng.integers(10, 40), left : left + rng.integers(20, 200)
+        ] -= 150
+
+    page = np.clip(page, 0, 255).astype(np.uint8)
+    return PIL.Image.fromarray(np.stack([page] * 3, axis=-1))
+
+
+def reference_preprocess(im):
+    im = preprocessing._grayscale(im)
+    im = preprocessing._binarize(im)
+    im = preprocessing._denoise(im)
+    return im
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = [synthetic_page(seed) for seed in range(args.pages)]
+    print(f"{len(pages)} pages of {pages[0].size[0]}x{pages[0].size[1]} pixels")
+
+    for page in pages:
+        fused = np.asarray(preprocessing.preprocess_image(page))
+        reference = np.asarray(reference_preprocess(page))
+        assert np.array_equal(fused, reference), "Fused preprocessing differs"
+
+    results = {}
+    for name, f in [
+        ("reference", reference_preprocess),
+        ("fused", preprocessing.preprocess_image),
+    ]:
+        seconds = min(
+            timeit.repeat(
+                lambda: [f(page) for page in pages], number=1, repeat=args.repeats
+            )
+        )
+        results[name] = seconds / len(pages)
+        print(f"{name:>10}: {1000 * results[name]:7.1f} ms/page")
+
+    print(f"speedup: {results['reference'] / results['fused']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
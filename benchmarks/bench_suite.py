@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the pipeline stages and the whole pipeline over the test PDFs.
+
+Times each stage on its own, with each of the given worker counts:
+
+* preprocess_pdf: render, preprocess and save every PDF (`preprocess_task` on a pool)
+* preprocess_image: preprocess pages already rendered in memory
+* run_tesseract: Tesseract over the preprocessed pages (`_run_tesseract`)
+* create_final_output: join the TSVs to the pages and write the CSVs (`_create_final_output`)
+* end_to_end: `preprocess_pdfs_for_ocr` followed by `run_ocr`, as in the staged pipeline
+
+Each stage runs in a fresh process, so its peak RSS (of the process and, separately, of its
+largest worker) isn't inflated by earlier stages. The Tesseract stages are skipped if the
+`tesseract` command isn't installed.
+
+Results are saved as JSON. Given a baseline (an earlier results file) stages whose best
+pages/second dropped by more than the threshold are reported and the exit status is 1.
+
+Usage:
+    python benchmarks/bench_suite.py [--pdf-dir DIR] [--repeats N] [--workers 1,4]
+        [--stages preprocess_pdf,...] [--output results.json]
+        [--baseline old.json] [--threshold 0.1]
+
+Compare two results files without running anything:
+    python benchmarks/bench_suite.py --results new.json --baseline old.json
+"""
+import argparse
+import datetime
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import types
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+import ch_ocr_runner.output as output
+import ch_ocr_runner.utils.configuration as configuration
+from ch_ocr_runner.utils.timing import Timer
+
+config = configuration.get_config()
+
+DEFAULT_PDF_DIR = os.path.join(
+    os.path.dirname(__file__), os.pardir, "tests", "resources", "pdfs"
+)
+
+STAGES = [
+    "preprocess_pdf",
+    "preprocess_image",
+    "run_tesseract",
+    "create_final_output",
+    "end_to_end",
+]
+TESSERACT_STAGES = {"run_tesseract", "create_final_output", "end_to_end"}
+
+# Config which changes the results, saved with them
+CONFIG_KEYS = [
+    "OCR_DPI",
+    "IMAGE_FORMAT",
+    "IMAGE_SUFFIX",
+    "RENDER_PAGE_WINDOW",
+    "SPLIT_PDF_PAGES",
+    "EXTRACT_EMBEDDED_IMAGES",
+    "TESSERACT_PAGES_PER_CHUNK",
+    "OUTPUT_FORMAT",
+    "TSV_READER",
+]
+
+# Rendered pages for the preprocess_image stage, inherited by forked workers
+_pages = []
+
+
+class Fixtures(object):
+    """Inputs shared by the stages, prepared once before timing"""
+
+    def __init__(self, pdf_dir, work_dir):
+        self.work_dir = work_dir
+        self.pdf_filepaths = sorted(
+            glob.glob(os.path.join(pdf_dir, "**", "*.pdf"), recursive=True)
+        )
+        if not self.pdf_filepaths:
+            raise ValueError(f"No PDFs found under {pdf_dir}")
+
+        self.raw_dir = self._dir("fixture_raw")
+        self.image_dir = self._dir("fixture_processed")
+        self.chunk_dir = self._dir("fixture_chunks")
+        self.tsv_dir = self._dir("fixture_tsv")
+
+        self.image_files = []
+        for pdf_filepath in self.pdf_filepaths:
+            result = preprocessing.preprocess_pdf(
+                self.raw_dir, self.image_dir, pdf_filepath
+            )
+            self.image_files.extend(result.image_files)
+
+        self.has_tsv = False
+
+    @property
+    def num_pages(self):
+        return len(self.image_files)
+
+    def chunks(self, chunk_dir=None):
+        return tesseract_wrapper._create_chunks(
+            self.image_files, chunk_dir=chunk_dir or self.chunk_dir
+        )
+
+    def ensure_tsv(self):
+        """Runs Tesseract once to create the TSVs read by create_final_output"""
+        if not self.has_tsv:
+            tesseract_wrapper._run_tesseract(self.chunks(), tsv_dir=self.tsv_dir)
+            self.has_tsv = True
+
+    def _dir(self, name):
+        path = os.path.join(self.work_dir, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def __repr__(self):
+        return f"Fixtures(pdfs={len(self.pdf_filepaths)}, pages={self.num_pages})"
+
+
+class _Batch(object):
+    """The parts of `WorkBatch` used by `preprocess_pdfs_for_ocr`"""
+
+    def __init__(self, pdf_filepaths):
+        self.batch_id = 0
+        self.pdf_filepaths = pdf_filepaths
+
+    def filepaths(self):
+        return iter(self.pdf_filepaths)
+
+    def page_counts(self):
+        return ((pdf_filepath, None) for pdf_filepath in self.pdf_filepaths)
+
+
+def _fresh_dirs(parent, *names):
+    if os.path.exists(parent):
+        shutil.rmtree(parent)
+
+    paths = [os.path.join(parent, name) for name in names]
+    for path in paths:
+        os.makedirs(path)
+
+    return paths
+
+
+def _preprocess_page(i):
+    return preprocessing.preprocess_image(_pages[i]).size
+
+
+def time_preprocess_pdf(fixtures, workers, run_dir):
+    raw_dir, image_dir = _fresh_dirs(run_dir, "raw", "processed")
+    tasks = [preprocessing.PageRangeTask(pdf) for pdf in fixtures.pdf_filepaths]
+    preprocess_f = functools.partial(preprocessing.preprocess_task, raw_dir, image_dir)
+
+    with Timer() as timer:
+        with multiprocessing.Pool(processes=workers) as pool:
+            results = pool.map(preprocess_f, tasks, chunksize=1)
+
+    return timer.elapsed, sum(len(result.image_files) for _, result in results)
+
+
+def time_preprocess_image(fixtures, workers, run_dir):
+    (raw_dir,) = _fresh_dirs(run_dir, "raw")
+
+    if not _pages:
+        for pdf_filepath in fixtures.pdf_filepaths:
+            for page in preprocessing.render_pdf(raw_dir, pdf_filepath):
+                page.image.load()
+                _pages.append(page.image)
+
+    with Timer() as timer:
+        with multiprocessing.Pool(processes=workers) as pool:
+            pool.map(_preprocess_page, range(len(_pages)), chunksize=1)
+
+    return timer.elapsed, len(_pages)
+
+
+def time_run_tesseract(fixtures, workers, run_dir):
+    chunk_dir, tsv_dir = _fresh_dirs(run_dir, "chunks", "tsv")
+
+    chunks = fixtures.chunks(chunk_dir)
+    with Timer() as timer:
+        tesseract_wrapper._run_tesseract(chunks, tsv_dir=tsv_dir, max_processes=workers)
+
+    return timer.elapsed, fixtures.num_pages
+
+
+def time_create_final_output(fixtures, workers, run_dir):
+    (output_dir,) = _fresh_dirs(run_dir, "output")
+    output.NUM_PROCESSES = workers
+
+    chunks = fixtures.chunks()
+    with Timer() as timer:
+        tesseract_wrapper._create_final_output(
+            chunks, tsv_dir=fixtures.tsv_dir, output_dir=output_dir, batch_id=0
+        )
+
+    return timer.elapsed, fixtures.num_pages
+
+
+def time_end_to_end(fixtures, workers, run_dir):
+    dirs = _fresh_dirs(run_dir, "raw", "processed", "chunks", "tsv", "output")
+    raw_dir, image_dir, chunk_dir, tsv_dir, output_dir = dirs
+    output.NUM_PROCESSES = workers
+
+    working_dir = types.SimpleNamespace(
+        manifest=None, image_raw_dir=raw_dir, image_processed_dir=image_dir
+    )
+
+    with Timer() as timer:
+        preprocessing.preprocess_pdfs_for_ocr(
+            _Batch(fixtures.pdf_filepaths), working_dir, processes=workers
+        )
+        tesseract_wrapper.run_ocr(
+            image_dir=image_dir,
+            chunk_dir=chunk_dir,
+            tsv_dir=tsv_dir,
+            output_dir=output_dir,
+            batch_id=0,
+            max_processes=workers,
+        )
+
+    return timer.elapsed, fixtures.num_pages
+
+
+STAGE_FUNCTIONS = {
+    "preprocess_pdf": time_preprocess_pdf,
+    "preprocess_image": time_preprocess_image,
+    "run_tesseract": time_run_tesseract,
+    "create_final_output": time_create_final_output,
+    "end_to_end": time_end_to_end,
+}
+
+
+def _peak_rss_mb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _run_stage(stage, fixtures, workers, repeats, run_dir, conn):
+    """Runs in a fresh process, sends back the timings and peak memory"""
+    try:
+        runs = [
+            STAGE_FUNCTIONS[stage](fixtures, workers, run_dir) for _ in range(repeats)
+        ]
+        conn.send(
+            {
+                "seconds": [seconds for seconds, _ in runs],
+                "pages": runs[0][1],
+                "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+                "worker_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            }
+        )
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+
+def run_stage(stage, fixtures, workers, repeats):
+    """
+    Times a stage in a forked process.
+
+    Returns:
+        dict: Result for the stage, with the best and median pages per second
+    """
+    ctx = multiprocessing.get_context("fork")
+    receiver, sender = ctx.Pipe(duplex=False)
+    run_dir = os.path.join(fixtures.work_dir, f"{stage}_{workers}")
+
+    process = ctx.Process(
+        target=_run_stage, args=(stage, fixtures, workers, repeats, run_dir, sender)
+    )
+    process.start()
+    sender.close()
+    measured = receiver.recv()
+    process.join()
+
+    if "error" in measured:
+        raise RuntimeError(f"Stage {stage} failed: {measured['error']}")
+
+    best = min(measured["seconds"])
+    median = statistics.median(measured["seconds"])
+
+    return {
+        "stage": stage,
+        "workers": workers,
+        "repeats": repeats,
+        "best_seconds": best,
+        "median_seconds": median,
+        "pages_per_second": measured["pages"] / best,
+        "median_pages_per_second": measured["pages"] / median,
+        **measured,
+    }
+
+
+def run_suite(pdf_dir, stages, worker_counts, repeats):
+    """Runs the benchmarks, returns results ready to be saved as JSON"""
+    results = []
+    skipped = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        with Timer() as setup_timer:
+            fixtures = Fixtures(pdf_dir, work_dir)
+        print(f"{fixtures} prepared in {setup_timer.elapsed:.1f} s")
+
+        has_tesseract = shutil.which("tesseract") is not None
+
+        for stage in stages:
+            if stage in TESSERACT_STAGES and not has_tesseract:
+                print(f"tesseract not installed, skipping {stage}")
+                skipped.append(stage)
+                continue
+
+            if stage == "create_final_output":
+                fixtures.ensure_tsv()
+
+            for workers in worker_counts:
+                result = run_stage(stage, fixtures, workers, repeats)
+                print(format_result(result))
+                results.append(result)
+
+    return {
+        "meta": {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "host": socket.gethostname(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "pdfs": len(fixtures.pdf_filepaths),
+            "pages": fixtures.num_pages,
+            "skipped": skipped,
+            "config": {key: getattr(config, key) for key in CONFIG_KEYS},
+        },
+        "results": results,
+    }
+
+
+def format_result(result):
+    return (
+        f"{result['stage']:>20} x{result['workers']:<3} "
+        f"{result['best_seconds']:8.2f} s  {result['pages_per_second']:7.2f} pages/s  "
+        f"peak RSS {result['peak_rss_mb']:7.1f} MB "
+        f"(largest worker {result['worker_peak_rss_mb']:.1f} MB)"
+    )
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares best pages/second of the stages in both results.
+
+    Returns:
+        list[str]: Stages (with worker count) slower than the baseline by more than `threshold`
+    """
+    baseline_results = {
+        (result["stage"], result["workers"]): result for result in baseline["results"]
+    }
+
+    regressions = []
+    for result in current["results"]:
+        key = (result["stage"], result["workers"])
+        if key not in baseline_results:
+            continue
+
+        before = baseline_results[key]["pages_per_second"]
+        after = result["pages_per_second"]
+        change = after / before - 1
+
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(f"{key[0]} x{key[1]}")
+
+        print(
+            f"{key[0]:>20} x{key[1]:<3} {before:7.2f} -> {after:7.2f} pages/s "
+            f"({change:+.1%}){flag}"
+        )
+
+    if baseline["meta"]["config"] != current["meta"]["config"]:
+        print("Note: the results were run with different config")
+
+    return regressions
+
+
+def _load(filepath):
+    with open(filepath, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--workers",
+        default=f"1,{multiprocessing.cpu_count()}",
+        help="Comma separated worker counts",
+    )
+    parser.add_argument(
+        "--stages", default=",".join(STAGES), help="Comma separated stages"
+    )
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--results", help="Compare these saved results, don't run")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fractional drop in pages/s counted as a regression",
+    )
+    args = parser.parse_args()
+
+    if args.results:
+        current = _load(args.results)
+    else:
+        stages = args.stages.split(",")
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+        worker_counts = sorted({int(workers) for workers in args.workers.split(",")})
+        current = run_suite(args.pdf_dir, stages, worker_counts, args.repeats)
+
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(current, f, indent=2)
+            print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        regressions = compare(_load(args.baseline), current, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
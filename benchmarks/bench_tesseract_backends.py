@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the tesseract CLI backend with the in-process C API backend.
+
+Renders and preprocesses every PDF under `tests/resources/pdfs` once, then times OCR of
+all the pages with each backend on a single core (run with OMP_THREAD_LIMIT=1).
+
+The CLI backend is timed as it is run by `tesseract_wrapper`: chunks of
+`config.TESSERACT_PAGES_PER_CHUNK` TIFF files per `tesseract` process.
+The C API backend is timed with one engine and the numpy arrays passed straight in,
+the time to initialise the engine is included.
+
+Usage:
+    python benchmarks/bench_tesseract_backends.py [--pdf-dir DIR] [--repeats N]
+"""
+import argparse
+import glob
+import os
+import tempfile
+
+import PIL.Image
+import numpy as np
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_engine as tesseract_engine
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+import ch_ocr_runner.utils.configuration as configuration
+from ch_ocr_runner.utils.timing import Timer
+
+config = configuration.get_config()
+
+DEFAULT_PDF_DIR = os.path.join(
+    os.path.dirname(__file__), os.pardir, "tests", "resources", "pdfs"
+)
+
+
+def load_pages(pdf_dir, raw_dir):
+    """Returns preprocessed pages for every PDF under `pdf_dir` as uint8 arrays"""
+    pdf_filepaths = sorted(
+        glob.glob(os.path.join(pdf_dir, "**", "*.pdf"), recursive=True)
+    )
+
+    pages = []
+    for pdf_filepath in pdf_filepaths:
+        for page in preprocessing.render_pdf(raw_dir, pdf_filepath):
+            pages.append(np.asarray(preprocessing.preprocess_image(page.image)))
+
+    return pdf_filepaths, pages
+
+
+def time_cli(pages, work_dir):
+    image_dir = os.path.join(work_dir, "processed")
+    chunk_dir = os.path.join(work_dir, "chunks")
+    tsv_dir = os.path.join(work_dir, "tsv")
+    for d in (image_dir, chunk_dir, tsv_dir):
+        os.makedirs(d, exist_ok=True)
+
+    with Timer() as timer:
+        image_files = []
+        for i, page in enumerate(pages):
+            filepath = os.path.join(image_dir, f"page_{i:05}{config.IMAGE_SUFFIX}")
+            PIL.Image.fromarray(page).save(
+                filepath, dpi=(config.OCR_DPI, config.OCR_DPI)
+            )
+            image_files.append(filepath)
+
+        for chunk in tesseract_wrapper._create_chunks(image_files, chunk_dir=chunk_dir):
+            tesseract_wrapper._run_tesseract_on_file(
+                chunk.path, chunk.tsv_filepath_no_suffix(tsv_dir)
+            )
+
+    return timer.elapsed
+
+
+def time_capi(pages):
+    with Timer() as timer:
+        engine = tesseract_engine.TesseractEngine()
+        for i, page in enumerate(pages):
+            engine.tsv(page, page_index=i, dpi=config.OCR_DPI)
+        engine.close()
+
+    return timer.elapsed
+
+
+def report(name, seconds, num_pages):
+    print(f"{name:>5}: {seconds:8.2f} s  {num_pages / seconds:6.2f} pages/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        pdf_filepaths, pages = load_pages(args.pdf_dir, raw_dir=work_dir)
+        print(f"{len(pages)} pages from {len(pdf_filepaths)} PDFs")
+
+        cli_seconds = min(time_cli(pages, work_dir) for _ in range(args.repeats))
+        report("cli", cli_seconds, len(pages))
+
+    if not tesseract_engine.is_available():
+        print("libtesseract not available, skipping the capi backend")
+        return
+
+    capi_seconds = min(time_capi(pages) for _ in range(args.repeats))
+    report("capi", capi_seconds, len(pages))
+
+    print(f"capi speedup: {cli_seconds / capi_seconds:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of Tesseract TSV ingestion: the original python engine read against
+the readers in `ch_ocr_runner.images.tsv_reader`.
+
+Writes a synthetic TSV (a million rows by default) with awkward words in it
+(quotes, "NA", "null", numbers) and checks every reader gives the same DataFrame.
+
+Usage:
+    python benchmarks/bench_tsv_ingest.py [--rows N] [--repeats N]
+"""
+import argparse
+import csv
+import os
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import ch_ocr_runner.images.tsv_reader as tsv_reader
+from ch_ocr_runner.images.tesseract_wrapper import TSV_HEADER
+
+WORDS = ["Company", "accounts", '"quoted', "it's", "NA", "null", "£1,000", "2019"]
+
+
+def write_synthetic_tsv(filepath, rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    ints = rng.integers(0, 3000, size=(rows, 10))
+    conf = rng.integers(0, 100, size=rows)
+    words = rng.choice(WORDS, size=rows)
+
+    with open(filepath, "w", encoding="utf-8") as f:
+        f.write(TSV_HEADER)
+        for row_ints, row_conf, word in zip(ints.tolist(), conf.tolist(), words):
+            f.write("\t".join(map(str, row_ints)) + f"\t{row_conf}\t{word}\n")
+
+
+def python_engine_read(filepath):
+    return pd.read_csv(
+        filepath,
+        sep="\t",
+        engine="python",
+        quotechar=None,
+        quoting=csv.QUOTE_NONE,
+        encoding="utf-8",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000 * 1000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    readers = [
+        ("python", python_engine_read),
+        ("c", lambda f: tsv_reader.read_tsv(f, engine="c")),
+    ]
+    if tsv_reader.pyarrow is not None:
+        readers.append(("pyarrow", lambda f: tsv_reader.read_tsv(f, engine="pyarrow")))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, "synthetic.tsv")
+        write_synthetic_tsv(filepath, args.rows)
+        print(f"{args.rows:,} rows, {os.path.getsize(filepath) / 1e6:.1f} MB")
+
+        reference = python_engine_read(filepath)
+
+        results = {}
+        for name, read_f in readers:
+            pd.testing.assert_frame_equal(read_f(filepath), reference)
+
+            results[name] = min(
+                timeit.repeat(lambda: read_f(filepath), number=1, repeat=args.repeats)
+            )
+            print(
+                f"{name:>10}: {results[name]:6.2f} s "
+                f"({args.rows / results[name]:,.0f} rows/s, "
+                f"{results['python'] / results[name]:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
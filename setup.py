@@ -30,6 +30,7 @@ REQUIRED = [
 EXTRAS = {
     # TODO put stuff for generating docs here? e.g. sphinx_autodoc_typehints
     # 'fancy feature': ['django'],
+    'arrow': ['pyarrow'],
 }
 
 # The rest you shouldn't have to touch too much :)
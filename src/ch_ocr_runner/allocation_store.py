@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed copy of the batch allocation CSV, so each machine only reads its own rows.
+
+The allocation CSV has millions of rows (with long `files`/`file_urls` columns) and sits on
+the shared location. Reading it all on every machine at startup is slow and uses a lot of RAM.
+The store keeps just the columns `ch_ocr_runner.work` needs in an SQLite database, indexed
+by machine and batch, so loading a machine's work is an index range scan.
+
+Build (or rebuild) the store after changing the allocation CSV:
+
+    python -m ch_ocr_runner.allocation_store
+
+The store records the size and modification time of the CSV it was built from (and the
+store's layout version). `work.fetch` falls back to the CSV if the store is missing or
+out of date.
+"""
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+import ch_ocr_runner as cor
+import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.setup_logging
+from ch_ocr_runner.utils.decorators import log
+
+CSV_READ_CHUNKSIZE = 100 * 1000
+
+# Changed when the columns stored change, older stores are out of date
+STORE_VERSION = 2
+
+config = cor.utils.configuration.get_config()
+logger = logging.getLogger(__name__)
+
+
+def _csv_signature(allocation_filepath):
+    stat = os.stat(allocation_filepath)
+    return f"version={STORE_VERSION},size={stat.st_size},mtime_ns={stat.st_mtime_ns}"
+
+
+@log()
+def build(allocation_filepath, store_filepath):
+    """
+    Builds the store from the allocation CSV.
+
+    The store is written to a temporary file and moved into place, so machines reading
+    the old store aren't affected while it is rebuilt.
+
+    Args:
+        allocation_filepath: Batch allocation CSV file
+        store_filepath: SQLite file to create
+    """
+    # Imported here as work uses this module
+    from ch_ocr_runner.work import Cols, with_checksums
+
+    tmp_filepath = f"{store_filepath}.tmp"
+    if os.path.exists(tmp_filepath):
+        os.remove(tmp_filepath)
+
+    signature = _csv_signature(allocation_filepath)
+
+    conn = sqlite3.connect(tmp_filepath)
+    conn.execute(
+        "CREATE TABLE allocation "
+        "(machine_allocation TEXT, batch_id INTEGER, path TEXT, pages INTEGER, "
+        "checksum TEXT)"
+    )
+    conn.execute("CREATE TABLE source (signature TEXT)")
+    conn.execute("INSERT INTO source (signature) VALUES (?)", (signature,))
+
+    rows = 0
+    for df in pd.read_csv(
+        allocation_filepath,
+        usecols=lambda col: col in Cols.ALL + Cols.OPTIONAL,
+        chunksize=CSV_READ_CHUNKSIZE,
+    ):
+        df = with_checksums(df)
+        pages = df[Cols.pages] if Cols.pages in df else pd.Series(None, index=df.index)
+        checksums = (
+            df[Cols.checksum]
+            if Cols.checksum in df
+            else pd.Series(None, index=df.index, dtype=object)
+        )
+
+        pd.DataFrame(
+            {
+                "machine_allocation": df[Cols.machine_allocation],
+                "batch_id": df[Cols.batch_id],
+                "path": df[Cols.path],
+                "pages": pd.to_numeric(pages, errors="coerce").round().astype("Int64"),
+                "checksum": checksums,
+            }
+        ).to_sql("allocation", conn, if_exists="append", index=False)
+        rows += len(df)
+
+    # Rows for a machine are read in batch order
+    conn.execute(
+        "CREATE INDEX allocation_machine_batch "
+        "ON allocation (machine_allocation, batch_id)"
+    )
+    conn.commit()
+    conn.close()
+
+    os.replace(tmp_filepath, store_filepath)
+    logger.info(f"Stored {rows:,} allocation rows in {store_filepath}")
+
+
+def is_current(store_filepath, allocation_filepath):
+    """True if the store exists and was built from the current allocation CSV"""
+    if not os.path.exists(store_filepath):
+        return False
+
+    if not os.path.exists(allocation_filepath):
+        # Nothing to compare against, the store is all there is
+        return True
+
+    conn = sqlite3.connect(f"file:{store_filepath}?mode=ro", uri=True)
+    try:
+        (signature,) = conn.execute("SELECT signature FROM source").fetchone()
+    finally:
+        conn.close()
+
+    return signature == _csv_signature(allocation_filepath)
+
+
+def load_machine_rows(store_filepath, machine_id):
+    """
+    Loads the allocation rows for a machine.
+
+    Returns:
+        pd.DataFrame: Same columns as `work` reads from the allocation CSV
+    """
+    return _query(store_filepath, "machine_allocation = ?", (machine_id,))
+
+
+def load_other_machine_rows(store_filepath, machine_id):
+    """Loads the allocation rows for every machine except `machine_id`"""
+    return _query(
+        store_filepath,
+        "machine_allocation IS NOT ? OR machine_allocation IS NULL",
+        (machine_id,),
+    )
+
+
+def _query(store_filepath, where, params):
+    conn = sqlite3.connect(f"file:{store_filepath}?mode=ro", uri=True)
+    try:
+        df = pd.read_sql_query(
+            "SELECT machine_allocation, batch_id, path, pages, checksum FROM allocation "
+            f"WHERE {where} ORDER BY batch_id, rowid",
+            conn,
+            params=params,
+        )
+    finally:
+        conn.close()
+
+    return df
+
+
+if __name__ == "__main__":
+    logger = cor.utils.setup_logging.setup_logging()
+
+    build(
+        config.WORK_BATCH_ALLOCATION_FILEPATH,
+        config.WORK_BATCH_ALLOCATION_STORE_FILEPATH,
+    )
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the files in the PDF directories, to check which PDFs exist without a
+round trip to the shared store for every file.
+
+Each directory is listed once with `os.scandir`, directories are listed concurrently by
+a pool of threads. Listings are kept for the rest of the run and saved to
+`config.FILE_INDEX_FILEPATH` (keep it on local disk) for later runs.
+
+A saved listing is reused if the directory modification time hasn't changed
+(adding or removing a file changes it). Listings taken within `RACY_SECONDS` of the
+directory being modified are listed again, as the change may be within the timestamp
+resolution of the file system.
+"""
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+import ch_ocr_runner.utils.configuration as configuration
+
+RACY_SECONDS = 2
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+_file_index = None
+
+
+class DirListing(object):
+    """Files in a directory when it was listed"""
+
+    def __init__(self, mtime_ns, listed_at, filenames):
+        self.mtime_ns = mtime_ns
+        self.listed_at = listed_at
+        self.filenames = frozenset(filenames)
+
+    def is_racy(self):
+        """True if the directory may have changed without its mtime changing"""
+        return self.listed_at - self.mtime_ns / 1e9 < RACY_SECONDS
+
+
+class FileIndex(object):
+    """
+    Directory listings used to check whether files exist.
+
+    Directories listed (or checked against their saved listing) during this run are not
+    checked again, create a new index to pick up changes.
+    """
+
+    def __init__(self, filepath=None, max_workers=None):
+        self.filepath = filepath
+        self.max_workers = max_workers or config.FILE_INDEX_THREADS
+
+        self._listings = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+
+        if filepath is not None:
+            self._load()
+
+    def missing(self, filepaths):
+        """
+        Finds the files which don't exist.
+
+        Args:
+            filepaths: Full paths of files
+
+        Returns:
+            set: Paths in `filepaths` which aren't files
+        """
+        by_dir = collections.defaultdict(list)
+        for filepath in filepaths:
+            dirpath, filename = os.path.split(filepath)
+            by_dir[dirpath].append((filepath, filename))
+
+        self._refresh([dirpath for dirpath in by_dir if dirpath not in self._checked])
+
+        missing = set()
+        for dirpath, files in by_dir.items():
+            listing = self._listings.get(dirpath)
+            filenames = listing.filenames if listing is not None else frozenset()
+
+            missing.update(
+                filepath for filepath, filename in files if filename not in filenames
+            )
+
+        return missing
+
+    def _refresh(self, dirpaths):
+        if not dirpaths:
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            listings = list(executor.map(self._list_if_changed, dirpaths))
+
+        relisted = 0
+        with self._lock:
+            for dirpath, (listing, changed) in zip(dirpaths, listings):
+                self._checked.add(dirpath)
+                relisted += changed
+
+                if listing is None:
+                    self._listings.pop(dirpath, None)
+                else:
+                    self._listings[dirpath] = listing
+
+        logger.info(
+            f"File index: checked {len(dirpaths):,} directories, listed {relisted:,}"
+        )
+
+        if relisted and self.filepath is not None:
+            self._save()
+
+    def _list_if_changed(self, dirpath):
+        """Returns (listing or None if no directory, True if the directory was listed)"""
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except FileNotFoundError:
+            return None, False
+
+        saved = self._listings.get(dirpath)
+        if saved is not None and saved.mtime_ns == mtime_ns and not saved.is_racy():
+            return saved, False
+
+        listed_at = time.time()
+        try:
+            with os.scandir(dirpath) as entries:
+                filenames = [entry.name for entry in entries if entry.is_file()]
+        except FileNotFoundError:
+            return None, True
+
+        return DirListing(mtime_ns, listed_at, filenames), True
+
+    def _load(self):
+        if not os.path.exists(self.filepath):
+            return
+
+        try:
+            with open(self.filepath, encoding="utf-8") as f:
+                saved = json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring unreadable file index {self.filepath}")
+            return
+
+        self._listings = {
+            dirpath: DirListing(mtime_ns, listed_at, filenames)
+            for dirpath, (mtime_ns, listed_at, filenames) in saved.items()
+        }
+
+    def _save(self):
+        index_dir = os.path.dirname(self.filepath)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+
+        with self._lock:
+            saved = {
+                dirpath: [
+                    listing.mtime_ns,
+                    listing.listed_at,
+                    sorted(listing.filenames),
+                ]
+                for dirpath, listing in self._listings.items()
+            }
+
+        tmp_filepath = f"{self.filepath}.{os.getpid()}.tmp"
+        with open(tmp_filepath, "w", encoding="utf-8") as f:
+            json.dump(saved, f)
+        os.replace(tmp_filepath, self.filepath)
+
+
+def get_file_index():
+    """The file index for this run, or None if turned off"""
+    global _file_index
+
+    if not config.FILE_INDEX_ENABLED:
+        return None
+
+    if _file_index is None:
+        _file_index = FileIndex(config.FILE_INDEX_FILEPATH)
+
+    return _file_index
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Detection of blank and near-empty pages, which are not sent to Tesseract.
+
+Used when `config.SKIP_BLANK_PAGES` is set. Works on the binarised, denoised page from
+`preprocessing.preprocess_image` (0 for ink). A page is blank if both:
+
+* at most `config.BLANK_PAGE_MAX_INK` of its pixels are ink
+* it has at most `config.BLANK_PAGE_MAX_COMPONENTS` connected blobs of ink of at least
+  `config.BLANK_PAGE_MIN_COMPONENT_AREA` pixels
+
+Besides blank backs and scanner noise, the defaults skip a page with only a page number
+or a stamp on it (up to 3 blobs). A short line of text such as "Page 2" or a company
+number has more blobs and is kept, as its text would be dropped from the output.
+
+A blank page isn't saved as an image for OCR. A small marker file is saved in its place
+(`{image file}.blank.json`, holding the page size) and the page gets a single
+Tesseract style page row (level 1, no text) in the output, like a page Tesseract
+found no text on.
+"""
+import glob
+import json
+import os
+
+import cv2
+import numpy as np
+
+import ch_ocr_runner.utils.configuration as configuration
+
+BLANK_PAGE_SUFFIX = ".blank.json"
+
+PAGE_LEVEL = 1
+
+config = configuration.get_config()
+
+
+def ink_fraction(page: np.ndarray):
+    """Fraction of the pixels of a binarised page (0 for ink) which are ink"""
+    return 1 - cv2.countNonZero(page) / page.size
+
+
+def ink_components(page: np.ndarray):
+    """Number of blobs of ink of at least `config.BLANK_PAGE_MIN_COMPONENT_AREA` pixels"""
+    ink = np.equal(page, 0).view(np.uint8)
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    # The first component is the background
+    areas = stats[1:, cv2.CC_STAT_AREA]
+
+    return int(np.count_nonzero(areas >= config.BLANK_PAGE_MIN_COMPONENT_AREA))
+
+
+def is_blank(page: np.ndarray):
+    """
+    True if a page is blank or near-empty, see the module docs.
+
+    Args:
+        page: Binarised page, 2D uint8 array with 0 for ink
+    """
+    ink = ink_fraction(page)
+    # A page of one colour (e.g. a rendered blank back) binarises to all ink, as its only
+    # grey level is the Otsu threshold
+    if ink == 1:
+        return True
+
+    if ink > config.BLANK_PAGE_MAX_INK:
+        return False
+
+    return ink_components(page) <= config.BLANK_PAGE_MAX_COMPONENTS
+
+
+def marker_filepath(image_filepath):
+    return f"{image_filepath}{BLANK_PAGE_SUFFIX}"
+
+
+def save_marker(image_filepath, width, height):
+    """Records a blank page in place of its image file"""
+    with open(marker_filepath(image_filepath), "w", encoding="utf-8") as f:
+        json.dump({"width": width, "height": height}, f)
+
+
+def find_blank_pages(image_dir):
+    """
+    Blank pages recorded in a directory of preprocessed images.
+
+    Returns:
+        dict: {image filepath the page would have had: (width, height)}
+    """
+    blank_pages = {}
+    for filepath in glob.glob(os.path.join(image_dir, f"*{BLANK_PAGE_SUFFIX}")):
+        with open(filepath, encoding="utf-8") as f:
+            size = json.load(f)
+
+        image_filepath = filepath[: -len(BLANK_PAGE_SUFFIX)]
+        blank_pages[image_filepath] = (size["width"], size["height"])
+
+    return blank_pages
+
+
+def tsv_rows(width, height):
+    """TSV rows for a blank page, as Tesseract writes for a page without text"""
+    return [f"{PAGE_LEVEL}\t1\t0\t0\t0\t0\t0\t0\t{width}\t{height}\t-1\t\n"]
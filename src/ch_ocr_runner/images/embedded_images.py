@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Fast path for scanned PDFs: extract the embedded bitmap instead of rasterising the page.
+
+Most filings are scans with a single image per page. Rasterising them with poppler at
+`config.OCR_DPI` resamples the scan and costs CPU. For pages which are just one image
+we extract the native bitmap with `pdfimages` and keep its native resolution.
+
+A page only takes the fast path if all of these hold (otherwise it is rasterised):
+
+* it has exactly one image and no soft masks or stencils
+* the image covers the whole page and the page isn't rotated
+* the page has no text (so nothing is drawn over the image)
+* the image resolution is at least `config.EMBEDDED_IMAGE_MIN_PPI`
+
+Uses the poppler command line tools (`pdfimages`, `pdfinfo`, `pdftotext`).
+"""
+import glob
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict
+
+import PIL.Image
+
+import ch_ocr_runner.utils.configuration as configuration
+
+# Allowed difference between the image size and the page size, as a fraction of the page
+COVERAGE_TOLERANCE = 0.03
+
+PAGE_SIZE_PATTERN = re.compile(r"^Page\s+(\d+)\s+size:\s+([\d.]+) x ([\d.]+) pts")
+PAGE_ROTATION_PATTERN = re.compile(r"^Page\s+(\d+)\s+rot:\s+(\d+)")
+EXTRACTED_FILE_PATTERN = re.compile(r"-(\d+)-(\d+)\.tif$")
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+
+class EmbeddedImage(object):
+    """An image listed by `pdfimages -list`"""
+
+    def __init__(self, page, num, image_type, width, height, x_ppi, y_ppi):
+        self.page = page
+        self.num = num
+        self.image_type = image_type
+        self.width = width
+        self.height = height
+        self.x_ppi = x_ppi
+        self.y_ppi = y_ppi
+
+    def __repr__(self):
+        return (
+            f"EmbeddedImage(page={self.page}, num={self.num}, type={self.image_type})"
+        )
+
+
+def single_image_pages(pdf_filepath, first_page, last_page):
+    """
+    Finds the pages which are a single embedded image.
+
+    Args:
+        pdf_filepath: PDF to check
+        first_page: First page to check (starts at 1)
+        last_page: Last page to check (inclusive)
+
+    Returns:
+        dict: {page number: EmbeddedImage} for pages which can use the fast path
+    """
+    images_by_page = defaultdict(list)
+    for image in _list_images(pdf_filepath, first_page, last_page):
+        images_by_page[image.page].append(image)
+
+    page_sizes, page_rotations = _page_geometry(pdf_filepath, first_page, last_page)
+    page_has_text = _pages_with_text(pdf_filepath, first_page, last_page)
+
+    fast_pages = {}
+    for page, images in images_by_page.items():
+        if len(images) != 1 or images[0].image_type != "image":
+            continue
+
+        image = images[0]
+
+        if page_rotations.get(page, 0) % 360 != 0 or page_has_text.get(page, True):
+            continue
+
+        if min(image.x_ppi, image.y_ppi) < config.EMBEDDED_IMAGE_MIN_PPI:
+            continue
+
+        if page in page_sizes and _covers_page(image, *page_sizes[page]):
+            fast_pages[page] = image
+
+    return fast_pages
+
+
+def extract_images(pdf_filepath, pages, output_dir, keep=True):
+    """
+    Extracts the embedded images of the given pages at their native resolution.
+
+    One `pdfimages` call covers the range of pages, images of pages in between which
+    weren't asked for are thrown away.
+
+    Args:
+        pdf_filepath: PDF to extract from
+        pages (dict): {page number: EmbeddedImage} as returned by `single_image_pages`
+        output_dir: Directory to write the extracted TIFF files to
+        keep: If False the extracted files are removed once loaded
+
+    Returns:
+        dict: {page number: PIL.Image}
+    """
+    if not pages:
+        return {}
+
+    name = f"{os.path.basename(pdf_filepath)}-embedded"
+
+    # Tasks for other page ranges of the PDF may be extracting at the same time,
+    # each call works in its own directory and only moves out the pages it was given
+    extract_dir = tempfile.mkdtemp(prefix=f"{name}-", dir=output_dir)
+    try:
+        subprocess.run(
+            [
+                "pdfimages",
+                "-tiff",
+                "-p",
+                "-f",
+                str(min(pages)),
+                "-l",
+                str(max(pages)),
+                pdf_filepath,
+                os.path.join(extract_dir, name),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        images = {}
+        for filepath in glob.glob(os.path.join(glob.escape(extract_dir), "*.tif")):
+            match = EXTRACTED_FILE_PATTERN.search(filepath)
+            page = int(match.group(1)) if match else None
+            if page not in pages:
+                continue
+
+            if keep:
+                output_filepath = os.path.join(output_dir, os.path.basename(filepath))
+                os.replace(filepath, output_filepath)
+                filepath = output_filepath
+
+            with PIL.Image.open(filepath) as im:
+                im.load()
+                images[page] = im
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+    return images
+
+
+def _covers_page(image, page_width_pts, page_height_pts):
+    image_width_inches = image.width / image.x_ppi
+    image_height_inches = image.height / image.y_ppi
+
+    page_width_inches = page_width_pts / 72
+    page_height_inches = page_height_pts / 72
+
+    return (
+        abs(image_width_inches - page_width_inches)
+        <= COVERAGE_TOLERANCE * page_width_inches
+        and abs(image_height_inches - page_height_inches)
+        <= COVERAGE_TOLERANCE * page_height_inches
+    )
+
+
+def _list_images(pdf_filepath, first_page, last_page):
+    output = _run_poppler(
+        [
+            "pdfimages",
+            "-list",
+            "-f",
+            str(first_page),
+            "-l",
+            str(last_page),
+            pdf_filepath,
+        ]
+    )
+
+    # Columns: page num type width height color comp bpc enc interp object ID x-ppi y-ppi size ratio
+    images = []
+    for line in output.splitlines()[2:]:
+        fields = line.split()
+        if len(fields) < 14:
+            continue
+
+        images.append(
+            EmbeddedImage(
+                page=int(fields[0]),
+                num=int(fields[1]),
+                image_type=fields[2],
+                width=int(fields[3]),
+                height=int(fields[4]),
+                x_ppi=int(fields[12]),
+                y_ppi=int(fields[13]),
+            )
+        )
+
+    return images
+
+
+def _page_geometry(pdf_filepath, first_page, last_page):
+    output = _run_poppler(
+        ["pdfinfo", "-f", str(first_page), "-l", str(last_page), pdf_filepath]
+    )
+
+    sizes = {}
+    rotations = {}
+    for line in output.splitlines():
+        size_match = PAGE_SIZE_PATTERN.match(line)
+        if size_match:
+            page, width, height = size_match.groups()
+            sizes[int(page)] = (float(width), float(height))
+
+        rotation_match = PAGE_ROTATION_PATTERN.match(line)
+        if rotation_match:
+            page, rotation = rotation_match.groups()
+            rotations[int(page)] = int(rotation)
+
+    return sizes, rotations
+
+
+def _pages_with_text(pdf_filepath, first_page, last_page):
+    output = _run_poppler(
+        ["pdftotext", "-f", str(first_page), "-l", str(last_page), pdf_filepath, "-"]
+    )
+
+    # pdftotext ends every page with a form feed
+    page_texts = output.split("\f")
+
+    return {
+        page: bool(text.strip())
+        for page, text in zip(range(first_page, last_page + 1), page_texts)
+    }
+
+
+def _run_poppler(args):
+    completed = subprocess.run(
+        args, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    return completed.stdout.decode("utf-8", errors="replace")
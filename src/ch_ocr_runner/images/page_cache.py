@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of Tesseract output for previously seen pages.
+
+Many filings share pages which are identical once binarised (cover sheets, blank
+continuation pages, refiled documents). Pages are keyed by a hash of their pixels
+after preprocessing and their resolution, along with the Tesseract settings, and the TSV
+rows for the page are stored against the key.
+
+The cache is an SQLite database so it can be shared by all the processes on a machine.
+It should be kept on local disk (SQLite locking is unreliable over NFS).
+Least recently used pages are evicted once the stored rows exceed `config.OCR_CACHE_MAX_BYTES`.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+import PIL.Image
+import numpy as np
+
+import ch_ocr_runner.utils.configuration as configuration
+from ch_ocr_runner.images.tesseract_options import TesseractOptions
+
+SQLITE_TIMEOUT_SECONDS = 60
+EVICTION_SCAN_SIZE = 256
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+_page_cache = None
+
+
+def engine_signature():
+    """Anything which changes the Tesseract output for a given image"""
+    # The command includes the language, OEM, PSM and tessdata settings
+    command_template = TesseractOptions.from_config().command_template()
+
+    return f"{command_template}|dpi={config.OCR_DPI}"
+
+
+def page_key(pixels: np.ndarray, dpi):
+    """
+    Cache key for a preprocessed page.
+
+    Args:
+        pixels: Preprocessed page
+        dpi: Resolution the page is sent to Tesseract at, which changes its output.
+            Embedded images (`config.EXTRACT_EMBEDDED_IMAGES`) have their own, so the same
+            pixels can come at different resolutions. None if the image has none.
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(engine_signature().encode("utf-8"))
+    h.update(f"|page_dpi={_round_dpi(dpi)}".encode("utf-8"))
+    h.update(str(pixels.shape).encode("utf-8"))
+    h.update(pixels.data)
+
+    return h.hexdigest()
+
+
+def image_file_key(filepath):
+    """Cache key for a preprocessed page saved to an image file"""
+    with PIL.Image.open(filepath) as im:
+        pixels = np.asarray(im.convert("L"))
+        dpi = im.info.get("dpi")
+
+    return page_key(pixels, dpi[0] if dpi else None)
+
+
+def _round_dpi(dpi):
+    # A TIFF stores its resolution as a fraction, e.g. 300 reads back as 299.9994
+    return None if dpi is None else int(round(float(dpi)))
+
+
+class PageCache(object):
+    """
+    Size bounded LRU store of TSV rows for pages, backed by SQLite.
+
+    Connections are opened per process, so an instance can be passed to pool workers.
+    """
+
+    def __init__(self, filepath, max_bytes):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+
+        self._connection = None
+        self._pid = None
+
+    def get(self, key):
+        """Returns the TSV rows (lines) cached for a page, or None"""
+        conn = self._connect()
+
+        row = conn.execute("SELECT rows FROM pages WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        return row[0].decode("utf-8").splitlines(keepends=True)
+
+    def put(self, key, rows):
+        """Stores the TSV rows (lines) for a page, evicting old pages if over size"""
+        data = "".join(rows).encode("utf-8")
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO pages (key, rows, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            ).rowcount
+
+            if inserted:
+                conn.execute(
+                    "UPDATE stats SET total_bytes = total_bytes + ?", (len(data),)
+                )
+                self._evict(conn)
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn):
+        (total_bytes,) = conn.execute("SELECT total_bytes FROM stats").fetchone()
+
+        while total_bytes > self.max_bytes:
+            oldest = conn.execute(
+                "SELECT key, size FROM pages ORDER BY last_used LIMIT ?",
+                (EVICTION_SCAN_SIZE,),
+            ).fetchall()
+
+            if not oldest:
+                break
+
+            evicted = []
+            for key, size in oldest:
+                if total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total_bytes -= size
+
+            conn.executemany("DELETE FROM pages WHERE key = ?", evicted)
+            logger.debug(f"Evicted {len(evicted)} pages from the page cache")
+
+        conn.execute("UPDATE stats SET total_bytes = ?", (total_bytes,))
+
+    def _connect(self):
+        # SQLite connections must not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            cache_dir = os.path.dirname(self.filepath)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+
+            conn = sqlite3.connect(
+                self.filepath, timeout=SQLITE_TIMEOUT_SECONDS, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages "
+                "(key TEXT PRIMARY KEY, rows BLOB, size INTEGER, last_used REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats "
+                "(id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER)"
+            )
+            conn.execute("INSERT OR IGNORE INTO stats (id, total_bytes) VALUES (0, 0)")
+
+            self._connection = conn
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+
+def get_page_cache():
+    """The page cache for this process, or None if caching is turned off"""
+    global _page_cache
+
+    if not config.OCR_CACHE_ENABLED:
+        return None
+
+    if _page_cache is None:
+        _page_cache = PageCache(
+            config.OCR_CACHE_FILEPATH, max_bytes=config.OCR_CACHE_MAX_BYTES
+        )
+
+    return _page_cache
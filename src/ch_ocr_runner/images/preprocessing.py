@@ -3,6 +3,9 @@ import functools
 import logging
 import multiprocessing
 import os
+import queue
+import threading
+import time
 
 import PIL.Image
 import cv2
@@ -11,6 +14,12 @@ import pdf2image
 import skimage.filters
 
 import ch_ocr_runner.utils.configuration as configuration
+import ch_ocr_runner.utils.metrics as metrics
+import ch_ocr_runner.utils.pools as pools
+import ch_ocr_runner.utils.profiling as profiling
+from ch_ocr_runner import readahead
+from ch_ocr_runner.images import blank_pages
+from ch_ocr_runner.images import embedded_images
 from ch_ocr_runner.utils.decorators import log
 
 logger = logging.getLogger(__name__)
@@ -19,52 +28,630 @@ config = configuration.get_config()
 PDF2IMAGE_THREAD_COUNT = 1  # Maximise throughput by avoiding contention
 NUM_PROCESSES = multiprocessing.cpu_count()
 
+DENOISE_KERNEL = np.ones((2, 2), np.uint8)
+
 
 @log()
-def preprocess_pdfs_for_ocr(batch, working_dir):
-    """Turn PDFs into image files, run some preprocessing on the images"""
+def preprocess_pdfs_for_ocr(batch, working_dir, ahead=None, processes=None):
+    """
+    Turn PDFs into image files, run some preprocessing on the images
+
+    Args:
+        batch (ch_ocr_runner.work.WorkBatch): Batch of PDFs to process
+        working_dir (ch_ocr_runner.main.WorkingDir): Working directory for the batch
+        ahead (RenderAhead): Preprocessing of the batch already started, if any
+        processes: Number of workers, see `ch_ocr_runner.utils.pools.worker_pool`
+    """
+    manifest = working_dir.manifest
+
+    with pools.worker_pool(processes) as pool:
+        if ahead is not None:
+            logger.info("Collecting PDFs preprocessed ahead of the batch")
+            work, results = ahead.work(), ahead.results()
+            reader = readahead.NoReadAhead()
+        else:
+            work = plan_tasks(batch, map_f=pool.map)
+            work = _not_rendered(work, manifest)
+
+            reader = readahead.for_batch(batch, [t.pdf_filepath for t in work])
+
+            logger.info("Submitting PDF files for preprocessing")
+            results = pool.imap_unordered(preprocess_function(working_dir), work)
+
+        page_counts = PageCounts()
+        with reader:
+            for i, (task, result) in enumerate(results, 1):
+                reader.done(task.pdf_filepath)
+
+                if manifest is not None:
+                    manifest.mark_rendered(task.key, result.image_files)
+
+                page_counts.add(result)
+                record_metrics(task, result)
+
+                if i % config.PREPROCESS_REPORT_FREQUENCY == 0:
+                    logger.info(f"Preprocessed {i} of {len(work)} tasks")
+
+    page_counts.report()
+
+
+def preprocess_function(working_dir, page_queue=None, ahead=False):
+    """
+    `preprocess_task` for a batch's working directory, profiled as "preprocess".
+
+    Args:
+        working_dir (ch_ocr_runner.main.WorkingDir): Working directory for the batch
+        page_queue: Passed to `preprocess_pdf`
+        ahead: True if the batch isn't the batch in progress, so it's profiled
+            into its own directory
+    """
+    return profiling.profiled(
+        "preprocess",
+        functools.partial(
+            preprocess_task,
+            working_dir.image_raw_dir,
+            working_dir.image_processed_dir,
+            page_queue=page_queue,
+        ),
+        batch_dir=working_dir.batch_dir if ahead else None,
+    )
+
+
+def _not_rendered(work, manifest):
+    """Tasks not recorded as done in the manifest of a resumed batch"""
+    if manifest is None:
+        return work
+
+    rendered = manifest.rendered()
+    work = [task for task in work if task.key not in rendered]
+    logger.info(f"{len(rendered)} tasks already preprocessed, {len(work)} to go")
+
+    return work
+
+
+class RenderAhead(object):
+    """
+    Preprocesses the next batch in the background while the current batch is in OCR.
+
+    Planning and submitting the tasks happens in a thread. At most `max_in_flight` tasks
+    are queued on the pool at a time, so work for the current batch later submitted to
+    the same pool (e.g. writing its output) isn't stuck behind the whole next batch.
+    The thread also runs the batch's PDF read-ahead, if enabled, until every task is done.
+    Pass to `preprocess_pdfs_for_ocr` when the batch is processed to collect the results.
+    """
+
+    def __init__(self, batch, working_dir, pool, max_in_flight=None):
+        self.batch = batch
+        self.working_dir = working_dir
+        self.pool = pool
+        self.max_in_flight = max_in_flight or NUM_PROCESSES
+
+        self._work = None
+        self._error = None
+        self._planned = threading.Event()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._feed, name=f"render-ahead-{batch.batch_id}", daemon=True
+        )
+
+    def start(self):
+        logger.info(f"Preprocessing {self.batch} ahead")
+        self._thread.start()
+        return self
+
+    def work(self):
+        """Tasks being preprocessed, waits until they are planned"""
+        self._planned.wait()
+        if self._error is not None:
+            raise self._error
+
+        return self._work
+
+    def results(self):
+        """Yields (task, PreprocessedPdf) as tasks finish, raises if one failed"""
+        for _ in self.work():
+            result = self._results.get()
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+
+    def _feed(self):
+        try:
+            work = plan_tasks(self.batch, map_f=self.pool.map)
+            self._work = _not_rendered(work, self.working_dir.manifest)
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._planned.set()
+
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        def finished(result):
+            if not isinstance(result, BaseException):
+                task, _ = result
+                reader.done(task.pdf_filepath)
+
+            self._results.put(result)
+            in_flight.release()
+
+        try:
+            preprocess_f = preprocess_function(self.working_dir, ahead=True)
+            reader = readahead.for_batch(
+                self.batch, [task.pdf_filepath for task in self._work]
+            )
+
+            with reader:
+                for task in self._work:
+                    in_flight.acquire()
+                    self.pool.apply_async(
+                        preprocess_f,
+                        (task,),
+                        callback=finished,
+                        error_callback=finished,
+                    )
+
+                # Keeps the read-ahead until the last task is done
+                for _ in range(self.max_in_flight):
+                    in_flight.acquire()
+        except Exception as e:
+            # Raised by `results` rather than leaving it waiting
+            self._results.put(e)
+
+    def __repr__(self):
+        return f"RenderAhead(batch={self.batch})"
+
+
+class PageRangeTask(object):
+    """
+    Pages of a PDF to preprocess as one unit of work.
+
+    Long PDFs are split into several tasks so they can be spread over the workers.
+    """
+
+    def __init__(self, pdf_filepath, first_page=1, last_page=None, num_pages=None):
+        self.pdf_filepath = pdf_filepath
+        self.first_page = first_page
+        # None means up to the end of the PDF
+        self.last_page = last_page
+        # Pages in the task if known, used to schedule long tasks first
+        self.num_pages = num_pages
+
+    @property
+    def key(self):
+        """Identifies the task in the batch manifest, the filepath for a whole PDF"""
+        if self.first_page == 1 and self.last_page is None:
+            return self.pdf_filepath
+
+        return f"{self.pdf_filepath}#pages={self.first_page}-{self.last_page or ''}"
+
+    def __repr__(self):
+        return f"PageRangeTask(key={self.key})"
+
+
+def plan_tasks(batch, map_f=map):
+    """
+    Splits a batch into preprocessing tasks, longest first.
+
+    PDFs with more than `config.SPLIT_PDF_PAGES` pages are split into tasks of that many
+    pages. Page counts come from the allocation file, PDFs without one are probed.
+
+    Args:
+        batch (ch_ocr_runner.work.WorkBatch): Batch of PDFs to process
+        map_f: Map function used to probe page counts (e.g. `Pool.map`)
+
+    Returns:
+        list[PageRangeTask]
+    """
+    page_counts = list(batch.page_counts())
+
+    if config.SPLIT_PDF_PAGES:
+        unknown = [pdf for pdf, num_pages in page_counts if num_pages is None]
+        if unknown:
+            logger.info(f"Probing page counts of {len(unknown):,} PDFs")
+            probed = dict(zip(unknown, map_f(_probe_page_count, unknown)))
+            page_counts = [
+                (pdf, probed.get(pdf) if num_pages is None else num_pages)
+                for pdf, num_pages in page_counts
+            ]
+
+    tasks = []
+    for pdf_filepath, num_pages in page_counts:
+        tasks.extend(_split_pdf(pdf_filepath, num_pages))
+
+    if len(tasks) > len(page_counts):
+        logger.info(f"Split {len(page_counts):,} PDFs into {len(tasks):,} tasks")
+
+    # Stable, so PDFs without a page count keep their order at the end
+    return sorted(tasks, key=lambda task: task.num_pages or 0, reverse=True)
+
+
+def _split_pdf(pdf_filepath, num_pages):
+    max_pages = config.SPLIT_PDF_PAGES
+
+    if not max_pages or num_pages is None or num_pages <= max_pages:
+        return [PageRangeTask(pdf_filepath, num_pages=num_pages)]
+
+    tasks = []
+    for first_page in range(1, num_pages + 1, max_pages):
+        last_page = first_page + max_pages - 1
+        tasks.append(
+            PageRangeTask(
+                pdf_filepath,
+                first_page=first_page,
+                # The page count may be out of date, the last task runs to the end
+                last_page=last_page if last_page < num_pages else None,
+                num_pages=min(max_pages, num_pages - first_page + 1),
+            )
+        )
+
+    return tasks
+
+
+def _probe_page_count(pdf_filepath):
+    try:
+        return pdf2image.pdfinfo_from_path(pdf_filepath)["Pages"]
+    except Exception as e:
+        logger.warning(f"Unable to count pages of {pdf_filepath}: {e}")
+        return None
+
+
+class RenderedPage(object):
+    """A page image ready for preprocessing, along with its resolution"""
+
+    def __init__(self, image, dpi, extracted=False):
+        self.image = image
+        self.dpi = dpi
+        # True if the embedded image was used rather than rasterising the page
+        self.extracted = extracted
+
+
+class PreprocessedPdf(object):
+    """Result of preprocessing a PDF"""
+
+    def __init__(
+        self,
+        pdf_filepath,
+        image_files,
+        extracted_pages,
+        page_seconds=(),
+        blank_files=(),
+    ):
+        self.pdf_filepath = pdf_filepath
+        # Pages to OCR
+        self.image_files = image_files
+        self.extracted_pages = extracted_pages
+        # Time taken to render, preprocess and save each page
+        self.page_seconds = page_seconds
+        # Blank pages, named as their image files would have been (see `blank_pages`)
+        self.blank_files = blank_files
+
+    @property
+    def rasterised_pages(self):
+        return len(self.image_files) + len(self.blank_files) - self.extracted_pages
+
+    def __repr__(self):
+        return f"PreprocessedPdf(pdf_filepath={self.pdf_filepath}, pages={len(self.image_files)})"
+
+
+class PageCounts(object):
+    """Counts pages by how they were turned into images"""
+
+    def __init__(self):
+        self.extracted = 0
+        self.rasterised = 0
+        self.blank = 0
 
-    logger.info("Creating pool of workers")
-    pool = multiprocessing.Pool(processes=NUM_PROCESSES)
+    def add(self, result):
+        self.extracted += result.extracted_pages
+        self.rasterised += result.rasterised_pages
+        self.blank += len(result.blank_files)
 
-    preprocess_f = functools.partial(preprocess_pdf, working_dir.image_raw_dir, working_dir.image_processed_dir)
+    def report(self):
+        logger.info(
+            f"Pages: {self.extracted:,} embedded images extracted, "
+            f"{self.rasterised:,} rasterised, {self.blank:,} blank (not sent to Tesseract)"
+        )
 
-    work = (pdf for pdf in batch.filepaths())
 
-    logger.info("Submitting PDF files for preprocessing")
-    pool.map(preprocess_f, work)
+def record_metrics(task, result):
+    """Records the pages of a finished task in the batch metrics"""
+    if task.first_page == 1:
+        metrics.inc("pdfs_rendered")
 
-    pool.close()
-    pool.join()
+    metrics.inc("pages_rendered", len(result.image_files) + len(result.blank_files))
+    metrics.inc("pages_extracted", result.extracted_pages)
+    metrics.inc("pages_blank", len(result.blank_files))
 
+    for seconds in result.page_seconds:
+        metrics.observe("preprocess_page_seconds", seconds)
 
-def preprocess_pdf(image_raw_dir, image_processed_dir, pdf_filepath):
 
-    pdf_output_file = os.path.basename(pdf_filepath)
+def preprocess_task(image_raw_dir, image_processed_dir, task, page_queue=None):
+    """
+    Runs `preprocess_pdf` for a `PageRangeTask`, returns (task, PreprocessedPdf)
+
+    The PDF is read from its local read-ahead copy if there is one, see `readahead`.
+    """
+    result = preprocess_pdf(
+        image_raw_dir,
+        image_processed_dir,
+        task.pdf_filepath,
+        page_queue=page_queue,
+        first_page=task.first_page,
+        last_page=task.last_page,
+        source_filepath=readahead.local_copy(task.pdf_filepath),
+    )
+
+    return task, result
+
+
+def preprocess_pdf(
+    image_raw_dir,
+    image_processed_dir,
+    pdf_filepath,
+    page_queue=None,
+    first_page=1,
+    last_page=None,
+    source_filepath=None,
+):
+    """
+    Renders a PDF to images, preprocesses each page and saves it for OCR.
+
+    Pages are rendered `config.RENDER_PAGE_WINDOW` at a time, so memory use doesn't grow
+    with the length of the PDF.
+
+    Args:
+        image_raw_dir: Directory for the images rendered by poppler
+        image_processed_dir: Directory to save the preprocessed images to
+        pdf_filepath: PDF to process
+        page_queue: Optional queue, the path of each preprocessed image is put
+            on it as soon as the image is saved (used by the streaming pipeline).
+            Blank pages (with `config.SKIP_BLANK_PAGES`) aren't put on the queue.
+        first_page: First page to process (starts at 1)
+        last_page: Last page to process (inclusive), None for the end of the PDF
+        source_filepath: Copy of the PDF to read (with the same filename),
+            `pdf_filepath` if None
+
+    Returns:
+        PreprocessedPdf: Filepaths of the preprocessed images and page counts
+    """
+    pages = render_pdf(
+        image_raw_dir, source_filepath or pdf_filepath, first_page, last_page
+    )
+
+    filepaths = []
+    blank_files = []
+    extracted_pages = 0
+    page_seconds = []
+    started = time.perf_counter()
+    for i, page in enumerate(pages, first_page - 1):
+        image_filename = processed_image_filename(pdf_filepath, i)
+        filepath = os.path.join(image_processed_dir, image_filename)
+
+        processed = preprocess_image(page.image)
+        page.image.close()
+        extracted_pages += page.extracted
+
+        is_blank = config.SKIP_BLANK_PAGES and blank_pages.is_blank(
+            np.asarray(processed)
+        )
+        if is_blank:
+            blank_pages.save_marker(filepath, *processed.size)
+            blank_files.append(filepath)
+        else:
+            save_processed_image(processed, filepath, page.dpi)
+            filepaths.append(filepath)
+
+        finished = time.perf_counter()
+        page_seconds.append(finished - started)
+
+        if page_queue is not None and not is_blank:
+            page_queue.put(filepath)
+
+        # Time waiting on a full queue isn't counted against the next page
+        started = time.perf_counter()
+
+    return PreprocessedPdf(
+        pdf_filepath, filepaths, extracted_pages, page_seconds, blank_files
+    )
+
+
+def save_processed_image(image, filepath, dpi):
+    """
+    Saves a preprocessed page for OCR.
+
+    With `config.PROCESSED_IMAGE_BILEVEL` the page (only 0 and 255 after `_denoise`) is
+    saved 1-bit, compressed with `config.PROCESSED_IMAGE_COMPRESSION` if it's a TIFF.
+    Group 4 shrinks a 300 DPI page from megabytes to tens of kilobytes.
+    """
+    if not config.PROCESSED_IMAGE_BILEVEL:
+        image.save(filepath, dpi=dpi)
+        return
+
+    options = {}
+    is_tiff = os.path.splitext(filepath)[1].lower() in (".tif", ".tiff")
+    if is_tiff and config.PROCESSED_IMAGE_COMPRESSION:
+        options["compression"] = config.PROCESSED_IMAGE_COMPRESSION
+
+    bilevel = image.convert("1", dither=PIL.Image.Dither.NONE)
+    bilevel.save(filepath, dpi=dpi, **options)
+
+
+def render_pdf(image_raw_dir, pdf_filepath, first_page=1, last_page=None):
+    """
+    Turns the pages of a PDF into images, a window of pages at a time.
+
+    Pages are rasterised with poppler at `config.OCR_DPI`. If `config.EXTRACT_EMBEDDED_IMAGES`
+    is set, pages which are a single scanned image use that image at its native resolution.
+
+    Yields:
+        RenderedPage: One per page, in page order
+    """
+    num_pages = pdf2image.pdfinfo_from_path(pdf_filepath)["Pages"]
+
+    if last_page is None or last_page > num_pages:
+        last_page = num_pages
+
+    for window_first in range(first_page, last_page + 1, config.RENDER_PAGE_WINDOW):
+        window_last = min(window_first + config.RENDER_PAGE_WINDOW - 1, last_page)
+
+        yield from _render_pages(image_raw_dir, pdf_filepath, window_first, window_last)
+
+
+def _render_pages(image_raw_dir, pdf_filepath, first_page, last_page):
+    pages = {}
+    if config.EXTRACT_EMBEDDED_IMAGES:
+        pages = _extract_pages(image_raw_dir, pdf_filepath, first_page, last_page)
+
+    other_pages = [p for p in range(first_page, last_page + 1) if p not in pages]
+    for first, last in _consecutive_ranges(other_pages):
+        rasterised = _rasterise(image_raw_dir, pdf_filepath, first, last)
+        pages.update(zip(range(first, last + 1), rasterised))
+
+    return [pages[page] for page in sorted(pages)]
+
+
+def _extract_pages(image_raw_dir, pdf_filepath, first_page, last_page):
+    try:
+        embedded = embedded_images.single_image_pages(
+            pdf_filepath, first_page, last_page
+        )
+        extracted = embedded_images.extract_images(
+            pdf_filepath, embedded, image_raw_dir, keep=config.SAVE_RAW_IMAGES
+        )
+    except Exception as e:
+        logger.warning(
+            f"Unable to extract embedded images from {pdf_filepath}, rasterising: {e}"
+        )
+        return {}
+
+    return {
+        page: RenderedPage(
+            image, dpi=(embedded[page].x_ppi, embedded[page].y_ppi), extracted=True
+        )
+        for page, image in extracted.items()
+    }
+
+
+def _rasterise(image_raw_dir, pdf_filepath, first_page, last_page):
+    if config.SAVE_RAW_IMAGES:
+        output = dict(output_folder=image_raw_dir, fmt=config.IMAGE_FORMAT)
+    else:
+        # Without an output folder poppler writes the pages to a pipe, PPM is the
+        # cheapest format to parse
+        output = dict(output_folder=None, fmt="ppm")
 
     images = pdf2image.convert_from_path(
         pdf_filepath,
         dpi=config.OCR_DPI,
+        first_page=first_page,
+        last_page=last_page,
         thread_count=PDF2IMAGE_THREAD_COUNT,
-        output_folder=image_raw_dir,
-        fmt=config.IMAGE_FORMAT,
-        output_file=pdf_output_file,
+        output_file=raw_image_prefix(pdf_filepath, first_page, last_page),
+        **output,
     )
 
-    preprocessed_images = map(preprocess_image, images)
+    return [
+        RenderedPage(image, dpi=(config.OCR_DPI, config.OCR_DPI)) for image in images
+    ]
 
-    for i, image in enumerate(preprocessed_images):
-        image_filename = f"{pdf_output_file}_{i}{config.IMAGE_SUFFIX}"
-        filepath = os.path.join(image_processed_dir, image_filename)
 
-        image.save(filepath, dpi=(config.OCR_DPI, config.OCR_DPI))
+def raw_image_prefix(pdf_filepath, first_page, last_page):
+    """
+    Filename prefix of the raw images of a range of pages.
+
+    pdf2image loads back every file in the output folder starting with the prefix, so
+    each window, run of pages and range task of a PDF needs its own.
+    """
+    return f"{os.path.basename(pdf_filepath)}-{first_page}-{last_page}-"
+
+
+def _consecutive_ranges(pages):
+    """Groups sorted page numbers into (first, last) runs of consecutive pages"""
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+
+    return [tuple(r) for r in ranges]
+
+
+def processed_image_filename(pdf_filepath, page_index):
+    """Filename for a preprocessed page, `_create_final_output` relies on this format"""
+    return f"{os.path.basename(pdf_filepath)}_{page_index}{config.IMAGE_SUFFIX}"
+
+
+def parse_processed_image_filename(image_filepath):
+    """
+    Inverse of `processed_image_filename`.
+
+    Returns:
+        tuple: (PDF basename, page index)
+    """
+    filename = os.path.basename(image_filepath)
+
+    if filename.endswith(config.IMAGE_SUFFIX):
+        filename = filename[: -len(config.IMAGE_SUFFIX)]
+
+    basefile, _, page_index = filename.rpartition("_")
+
+    if not basefile or not page_index.isdigit():
+        raise ValueError(f"Not a preprocessed image filename: {image_filepath}")
+
+    return basefile, int(page_index)
 
 
 def preprocess_image(im: PIL.Image):
-    im = _grayscale(im)
-    im = _binarize(im)
-    im = _denoise(im)
-    return im
+    """
+    Converts a page to grayscale, binarises it and removes small specks.
+
+    Gives exactly the same pixels as `_grayscale` -> `_binarize` -> `_denoise`,
+    but after the grayscale conversion all the work is done in place in one uint8 array.
+    """
+    gray = np.array(_grayscale(im))
+
+    return PIL.Image.fromarray(binarize_and_denoise(gray, out=gray))
+
+
+def binarize_and_denoise(gray: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Otsu binarisation followed by denoising of a uint8 grayscale page.
+
+    Args:
+        gray: 2D uint8 array
+        out: uint8 array to write the result to, can be `gray` itself
+
+    Returns:
+        np.ndarray: Page with 0 for ink and 255 for background
+    """
+    thresh = _otsu_threshold(gray)
+
+    _, out = cv2.threshold(gray, float(thresh), 255, cv2.THRESH_BINARY, dst=out)
+
+    # Opening the page is the same as inverting, closing and inverting back
+    return cv2.morphologyEx(out, cv2.MORPH_OPEN, DENOISE_KERNEL, dst=out)
+
+
+def _otsu_threshold(gray: np.ndarray):
+    """Same threshold as `skimage.filters.threshold_otsu(gray)` from one uint8 histogram"""
+    counts = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+
+    occupied = np.flatnonzero(counts)
+    lowest, highest = occupied[0], occupied[-1]
+
+    if lowest == highest:
+        return lowest
+
+    return skimage.filters.threshold_otsu(
+        hist=(counts[lowest : highest + 1], np.arange(lowest, highest + 1))
+    )
+
+
+# The functions below are the original, unfused preprocessing steps.
+# They are the reference for `preprocess_image` (see tests and benchmarks).
 
 
 def _grayscale(im: PIL.Image) -> PIL.Image:
@@ -81,8 +668,7 @@ def _binarize(im: PIL.Image) -> np.array:
 def _denoise(im: np.array) -> PIL.Image:
     im = skimage.util.invert(im)
 
-    kernel = np.ones((2, 2), np.uint8)
-    im = cv2.morphologyEx(im.astype(np.uint8), cv2.MORPH_CLOSE, kernel)
+    im = cv2.morphologyEx(im.astype(np.uint8), cv2.MORPH_CLOSE, DENOISE_KERNEL)
 
     im = skimage.util.invert(im)
 
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+In-process Tesseract backend using the Tesseract C API through ctypes.
+
+The CLI backend (see `tesseract_wrapper`) starts a `tesseract` process per chunk,
+which reloads the traineddata each time and reads every page back from a TIFF file.
+Here each worker process keeps one initialised Tesseract API instance for its lifetime
+and preprocessed numpy arrays are passed straight in.
+
+Output is written as a chunk (one per PDF) with the same TSV format as the CLI,
+so `_create_final_output` works the same for both backends.
+
+Needs libtesseract (`libtesseract-dev` on Ubuntu), `is_available` checks it can be loaded.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+
+import numpy as np
+
+import ch_ocr_runner.images.blank_pages as blank_pages
+import ch_ocr_runner.images.page_cache as page_cache
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+import ch_ocr_runner.readahead as readahead
+import ch_ocr_runner.utils.configuration as configuration
+from ch_ocr_runner.images.tesseract_options import TesseractOptions
+from ch_ocr_runner.images.tesseract_wrapper import Chunk
+
+# Tesseract's default OCR engine mode, as used by the CLI without --oem
+OEM_DEFAULT = 3
+
+LIBRARY_NAMES = ("libtesseract.so.5", "libtesseract.so.4", "libtesseract.so")
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+_engine = None
+
+
+class TesseractEngineError(RuntimeError):
+    pass
+
+
+def _load_library():
+    """Loads libtesseract and declares the signatures of the functions used"""
+    names = list(LIBRARY_NAMES)
+    if config.TESSERACT_LIBRARY_PATH:
+        names.insert(0, config.TESSERACT_LIBRARY_PATH)
+
+    found = ctypes.util.find_library("tesseract")
+    if found:
+        names.append(found)
+
+    lib = None
+    for name in names:
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+
+    if lib is None:
+        raise TesseractEngineError(f"Could not load libtesseract, tried {names}")
+
+    lib.TessBaseAPICreate.restype = ctypes.c_void_p
+    lib.TessBaseAPICreate.argtypes = []
+
+    lib.TessBaseAPIInit2.restype = ctypes.c_int
+    lib.TessBaseAPIInit2.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+        ctypes.c_int,
+    ]
+
+    lib.TessBaseAPISetPageSegMode.restype = None
+    lib.TessBaseAPISetPageSegMode.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.TessBaseAPISetImage.restype = None
+    lib.TessBaseAPISetImage.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+    ]
+
+    lib.TessBaseAPISetSourceResolution.restype = None
+    lib.TessBaseAPISetSourceResolution.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.TessBaseAPIRecognize.restype = ctypes.c_int
+    lib.TessBaseAPIRecognize.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+    # char* rather than c_char_p so the string can be freed with TessDeleteText
+    lib.TessBaseAPIGetTsvText.restype = ctypes.POINTER(ctypes.c_char)
+    lib.TessBaseAPIGetTsvText.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    lib.TessDeleteText.restype = None
+    lib.TessDeleteText.argtypes = [ctypes.POINTER(ctypes.c_char)]
+
+    lib.TessBaseAPIClear.restype = None
+    lib.TessBaseAPIClear.argtypes = [ctypes.c_void_p]
+
+    lib.TessBaseAPIEnd.restype = None
+    lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+
+    lib.TessBaseAPIDelete.restype = None
+    lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+
+    return lib
+
+
+def is_available():
+    """True if libtesseract can be loaded on this machine"""
+    try:
+        _load_library()
+    except TesseractEngineError as e:
+        logger.warning(str(e))
+        return False
+
+    return True
+
+
+class TesseractEngine(object):
+    """An initialised Tesseract API instance, the language model is loaded once"""
+
+    def __init__(self, options=None):
+        """
+        Args:
+            options (TesseractOptions): Language, OEM, PSM and tessdata, from config if None
+        """
+        options = options or TesseractOptions.from_config()
+
+        self._lib = _load_library()
+        self._api = self._lib.TessBaseAPICreate()
+
+        datapath = (
+            options.tessdata_dir.encode("utf-8") if options.tessdata_dir else None
+        )
+        oem = OEM_DEFAULT if options.oem is None else options.oem
+
+        if self._lib.TessBaseAPIInit2(
+            self._api, datapath, options.lang.encode("utf-8"), oem
+        ):
+            self.close()
+            raise TesseractEngineError(f"Failed to initialise Tesseract with {options}")
+
+        if options.psm is not None:
+            self._lib.TessBaseAPISetPageSegMode(self._api, options.psm)
+
+        self.pid = os.getpid()
+
+    def tsv(self, image: np.ndarray, page_index, dpi):
+        """
+        Runs OCR over a single 8-bit grayscale image.
+
+        Args:
+            image: 2D uint8 array
+            page_index: Zero based index of the page, Tesseract writes `page_index + 1`
+                to the page_num column
+            dpi: Resolution of the image
+
+        Returns:
+            str: TSV rows for the page, without a header
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape
+
+        self._lib.TessBaseAPISetImage(
+            self._api, image.ctypes.data, width, height, 1, image.strides[0]
+        )
+        self._lib.TessBaseAPISetSourceResolution(self._api, int(dpi))
+
+        if self._lib.TessBaseAPIRecognize(self._api, None):
+            raise TesseractEngineError(f"Tesseract failed on page {page_index}")
+
+        text_pointer = self._lib.TessBaseAPIGetTsvText(self._api, page_index)
+        if not text_pointer:
+            self._lib.TessBaseAPIClear(self._api)
+            raise TesseractEngineError(
+                f"Tesseract returned no TSV for page {page_index}"
+            )
+
+        try:
+            text = ctypes.string_at(text_pointer).decode("utf-8")
+        finally:
+            self._lib.TessDeleteText(text_pointer)
+            self._lib.TessBaseAPIClear(self._api)
+
+        return text
+
+    def close(self):
+        if self._api is not None:
+            self._lib.TessBaseAPIEnd(self._api)
+            self._lib.TessBaseAPIDelete(self._api)
+            self._api = None
+
+
+def get_engine():
+    """The Tesseract engine for this process, created on first use"""
+    global _engine
+
+    # A forked worker must not reuse an engine created by its parent
+    if _engine is None or _engine.pid != os.getpid():
+        _engine = TesseractEngine()
+
+    return _engine
+
+
+def ocr_pdf(
+    image_raw_dir, image_processed_dir, chunk_dir, tsv_dir, chunk_id, pdf_filepath
+):
+    """
+    Renders, preprocesses and runs OCR over every page of a PDF within this process.
+
+    Processed images are not saved, `image_processed_dir` is only used to name the
+    pages in the chunk file so they match the output of the CLI backend.
+
+    Blank pages (with `config.SKIP_BLANK_PAGES`) get a page row without running OCR.
+    The PDF is read from its local read-ahead copy if there is one.
+
+    Returns:
+        tuple: (Chunk for the PDF with its TSV written to `tsv_dir`,
+            page cache hits, pages OCRed)
+    """
+    engine = get_engine()
+    cache = page_cache.get_page_cache()
+
+    filepaths = []
+    page_rows = {}
+    hits = 0
+    misses = 0
+    source_filepath = readahead.local_copy(pdf_filepath)
+    for i, page in enumerate(preprocessing.render_pdf(image_raw_dir, source_filepath)):
+        filepath = os.path.join(
+            image_processed_dir, preprocessing.processed_image_filename(pdf_filepath, i)
+        )
+        filepaths.append(filepath)
+
+        array = np.asarray(preprocessing.preprocess_image(page.image))
+        page.image.close()
+
+        if config.SKIP_BLANK_PAGES and blank_pages.is_blank(array):
+            height, width = array.shape
+            page_rows[filepath] = blank_pages.tsv_rows(width, height)
+            continue
+
+        key = None
+        if cache is not None:
+            key = page_cache.page_key(array, page.dpi[0])
+            page_rows[filepath] = cache.get(key)
+
+        if page_rows.get(filepath) is not None:
+            hits += 1
+            continue
+
+        # Page numbers are rewritten when the chunk TSV is written
+        rows = engine.tsv(array, page_index=0, dpi=page.dpi[0])
+        misses += 1
+        page_rows[filepath] = rows.splitlines(keepends=True)
+
+        if cache is not None:
+            cache.put(key, page_rows[filepath])
+
+    chunk = Chunk(filepaths=filepaths, chunk_id=chunk_id, chunk_dir=chunk_dir)
+
+    tesseract_wrapper._write_chunk_tsv(chunk, tsv_dir, page_rows)
+
+    return chunk, hits, misses
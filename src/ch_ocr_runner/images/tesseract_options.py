@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Settings passed to Tesseract, shared by the CLI and C API backends and the page cache.
+
+Defaults come from config:
+
+* `TESSERACT_LANG`: language(s), e.g. "eng" or "eng+fra"
+* `TESSERACT_OEM`: OCR engine mode (0-3), None for Tesseract's default
+* `TESSERACT_PSM`: page segmentation mode (0-13), None for Tesseract's default
+* `TESSDATA_DIR`: directory of the traineddata files (e.g. a copy of tessdata_fast),
+  None for the tessdata installed with Tesseract
+
+See `tesseract_tuning` to compare settings on a sample of pages.
+"""
+import shlex
+
+import ch_ocr_runner.utils.configuration as configuration
+
+config = configuration.get_config()
+
+
+class TesseractOptions(object):
+    """Tesseract settings which change its output"""
+
+    KEYS = ["lang", "oem", "psm", "tessdata_dir"]
+
+    def __init__(self, lang="eng", oem=None, psm=None, tessdata_dir=None):
+        self.lang = lang
+        self.oem = None if oem is None else int(oem)
+        self.psm = None if psm is None else int(psm)
+        self.tessdata_dir = tessdata_dir or None
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            lang=config.TESSERACT_LANG,
+            oem=config.TESSERACT_OEM,
+            psm=config.TESSERACT_PSM,
+            tessdata_dir=config.TESSDATA_DIR,
+        )
+
+    @classmethod
+    def parse(cls, text, base=None):
+        """
+        Options from e.g. "psm=6,oem=1", anything not given is taken from `base`.
+
+        Args:
+            text: Comma separated key=value pairs, keys from `TesseractOptions.KEYS`
+            base (TesseractOptions): Defaults, from config if None
+        """
+        base = base or cls.from_config()
+        values = {key: getattr(base, key) for key in cls.KEYS}
+
+        for pair in filter(None, text.split(",")):
+            key, sep, value = pair.partition("=")
+            key = key.strip()
+            if not sep or key not in cls.KEYS:
+                raise ValueError(f"Expected key=value with a key in {cls.KEYS}: {pair}")
+
+            value = value.strip()
+            values[key] = None if value.lower() in ("", "none", "default") else value
+
+        return cls(**values)
+
+    def cli_args(self):
+        """Arguments for the tesseract command, before the output config"""
+        args = []
+        if self.tessdata_dir:
+            args += ["--tessdata-dir", self.tessdata_dir]
+
+        args += ["-l", self.lang]
+
+        if self.oem is not None:
+            args += ["--oem", str(self.oem)]
+        if self.psm is not None:
+            args += ["--psm", str(self.psm)]
+
+        return args
+
+    def command_template(self):
+        """tesseract command with `{chunk_path}` and `{tsv_path}` placeholders"""
+        args = " ".join(shlex.quote(arg) for arg in self.cli_args())
+        return f"tesseract {{chunk_path}} {{tsv_path}} {args} tsv"
+
+    def config_lines(self):
+        """The settings as config file lines"""
+        return [
+            f"TESSERACT_LANG: {self.lang}",
+            f"TESSERACT_OEM: {_yaml_value(self.oem)}",
+            f"TESSERACT_PSM: {_yaml_value(self.psm)}",
+            f"TESSDATA_DIR: {_yaml_value(self.tessdata_dir)}",
+        ]
+
+    def __eq__(self, other):
+        return isinstance(other, TesseractOptions) and all(
+            getattr(self, key) == getattr(other, key) for key in self.KEYS
+        )
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self.KEYS))
+
+    def __repr__(self):
+        settings = ", ".join(
+            f"{key}={getattr(self, key)}"
+            for key in self.KEYS
+            if getattr(self, key) is not None
+        )
+        return f"TesseractOptions({settings})"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def _yaml_value(value):
+    return "null" if value is None else value
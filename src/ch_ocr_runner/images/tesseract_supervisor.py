@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the tesseract command for chunks of pages from a single process with asyncio.
+
+Tesseract does the work in its own processes, so rather than a pool of workers each
+blocked waiting on one, an event loop in a background thread starts up to
+`max_processes` tesseract subprocesses and starts the next chunk as soon as one finishes.
+
+* stderr of each process is logged line by line as it is written
+* a chunk is killed after `config.TESSERACT_PAGE_TIMEOUT_SECONDS` per page and retried
+  up to `config.TESSERACT_RETRIES` times, then `TesseractTimeoutError` is raised
+* a chunk where tesseract exits with an error or writes no TSV is retried the same way,
+  then `TesseractFailedError` is raised
+
+Usage:
+
+    with TesseractSupervisor() as supervisor:
+        future = supervisor.submit(chunk, tsv_dir)
+        result = future.result()
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shlex
+import threading
+
+import ch_ocr_runner as cor
+import ch_ocr_runner.images.tesseract_options
+import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.metrics
+from ch_ocr_runner.utils.timing import Timer
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+logger = logging.getLogger(__name__)
+config = cor.utils.configuration.get_config()
+
+
+class TesseractTimeoutError(RuntimeError):
+    """A chunk ran over its time limit on every attempt"""
+
+
+class TesseractFailedError(RuntimeError):
+    """Tesseract failed on a chunk on every attempt (the last attempt didn't time out)"""
+
+
+class ChunkResult(object):
+    """Outcome of running Tesseract over a chunk"""
+
+    def __init__(self, chunk, seconds, returncode, attempts, stdout, tsv_filepath):
+        """
+        Args:
+            chunk (ch_ocr_runner.images.tesseract_wrapper.Chunk): Chunk run
+            seconds: Wall time of the attempt
+            returncode: Exit status of tesseract
+            attempts: Number of times tesseract was started
+            stdout: Output of tesseract (bytes), the TSV goes to a file
+            tsv_filepath: TSV file tesseract writes for the chunk
+        """
+        self.chunk = chunk
+        self.seconds = seconds
+        self.returncode = returncode
+        self.attempts = attempts
+        self.stdout = stdout
+        self.tsv_filepath = tsv_filepath
+
+    @property
+    def succeeded(self):
+        """True if tesseract exited cleanly and wrote the chunk's TSV"""
+        return self.returncode == 0 and os.path.exists(self.tsv_filepath)
+
+    def __repr__(self):
+        return (
+            f"ChunkResult(chunk={self.chunk}, seconds={round(self.seconds, 2)}, "
+            f"returncode={self.returncode}, attempts={self.attempts})"
+        )
+
+
+class TesseractSupervisor(object):
+    """Starts and watches tesseract subprocesses from an event loop in a background thread"""
+
+    def __init__(
+        self, max_processes=None, timeout_per_page=None, retries=None, options=None
+    ):
+        """
+        Args:
+            max_processes: Tesseract processes run at once, one per core if None
+            timeout_per_page: Seconds allowed per page of a chunk,
+                `config.TESSERACT_PAGE_TIMEOUT_SECONDS` if None (which may be None for no limit)
+            retries: Attempts after a timeout, `config.TESSERACT_RETRIES` if None
+            options (ch_ocr_runner.images.tesseract_options.TesseractOptions): Settings,
+                from config if None
+        """
+        self.max_processes = max_processes or NUM_PROCESSES
+        self.timeout_per_page = (
+            config.TESSERACT_PAGE_TIMEOUT_SECONDS
+            if timeout_per_page is None
+            else timeout_per_page
+        )
+        self.retries = config.TESSERACT_RETRIES if retries is None else retries
+        self.options = (
+            options or cor.images.tesseract_options.TesseractOptions.from_config()
+        )
+
+        self._loop = None
+        self._thread = None
+        # Created on the event loop
+        self._slots = None
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="tesseract-supervisor", daemon=True
+        )
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Kills any tesseract processes still running, e.g. after an error
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def submit(self, chunk, tsv_dir):
+        """
+        Queues a chunk to run when a process slot is free.
+
+        Returns:
+            concurrent.futures.Future: Resolves to a `ChunkResult`
+        """
+        tsv_path = chunk.tsv_filepath_no_suffix(tsv_dir)
+        return asyncio.run_coroutine_threadsafe(
+            self._run_chunk(chunk, tsv_path), self._loop
+        )
+
+    def timeout(self, chunk):
+        """Time limit for a chunk in seconds, None for no limit"""
+        if not self.timeout_per_page:
+            return None
+
+        return self.timeout_per_page * len(chunk.filepaths)
+
+    async def _run_chunk(self, chunk, tsv_path):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_processes)
+
+        cmd = self.options.command_template().format(
+            chunk_path=chunk.path, tsv_path=tsv_path
+        )
+
+        attempts = self.retries + 1
+        async with self._slots:
+            for attempt in range(1, attempts + 1):
+                timed_out = False
+                try:
+                    with Timer() as timer:
+                        returncode, stdout = await self._run_process(cmd, chunk)
+
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    cor.utils.metrics.inc("tesseract_timeouts")
+                    logger.warning(
+                        f"Tesseract ran over {self.timeout(chunk)}s on {chunk} "
+                        f"(attempt {attempt} of {attempts}), killed"
+                    )
+                    continue
+
+                result = ChunkResult(
+                    chunk, timer.elapsed, returncode, attempt, stdout, f"{tsv_path}.tsv"
+                )
+                if result.succeeded:
+                    return result
+
+                cor.utils.metrics.inc("tesseract_failures")
+                logger.warning(
+                    f"Tesseract exited with {returncode} on {chunk} "
+                    f"(attempt {attempt} of {attempts}), "
+                    f"TSV written: {os.path.exists(result.tsv_filepath)}"
+                )
+
+        if timed_out:
+            raise TesseractTimeoutError(
+                f"Tesseract timed out on every attempt at {chunk}: {chunk.filepaths}"
+            )
+
+        raise TesseractFailedError(
+            f"Tesseract failed on every attempt at {chunk}: {chunk.filepaths}"
+        )
+
+    async def _run_process(self, cmd, chunk):
+        process = await asyncio.create_subprocess_exec(
+            *shlex.split(cmd),
+            env=os.environ.copy(),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+
+        try:
+            stdout, _, returncode = await asyncio.wait_for(
+                asyncio.gather(
+                    process.stdout.read(),
+                    _log_lines(process.stderr, chunk),
+                    process.wait(),
+                ),
+                timeout=self.timeout(chunk),
+            )
+        finally:
+            # Timed out, or cancelled when the supervisor is closed
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+        return returncode, stdout
+
+    async def _cancel_all(self):
+        tasks = [
+            task
+            for task in asyncio.all_tasks(self._loop)
+            if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __repr__(self):
+        return (
+            f"TesseractSupervisor(max_processes={self.max_processes}, "
+            f"timeout_per_page={self.timeout_per_page}, retries={self.retries})"
+        )
+
+
+async def _log_lines(stream, chunk):
+    """Logs the lines of a process's output stream as they arrive"""
+    async for line in stream:
+        logger.debug(f"{chunk}: {line.decode('utf-8', errors='replace').rstrip()}")
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Compares Tesseract settings on a sample of pages, to choose the fastest acceptable setting.
+
+Every setting OCRs the same sample with the CLI backend, using all the cores
+(as `run_ocr` does). For each setting this reports:
+
+* pages/second
+* mean confidence of the words found
+* agreement with the reference setting: how closely the words on each page match those
+  found with the reference (1.0 is identical), averaged over the pages
+
+The fastest setting within `--min-agreement` of the reference, and with a mean confidence
+no more than `--max-conf-drop` below it, is recommended.
+
+Usage:
+    python -m ch_ocr_runner.images.tesseract_tuning (--images DIR | --pdf-dir DIR)
+        [--sample 50] [--reference ""] [--candidate "psm=6"] ...
+        [--min-agreement 0.95] [--max-conf-drop 5] [--output results.json]
+
+`--images` takes a directory of preprocessed pages, e.g. a batch's `images/processed`.
+`--pdf-dir` renders and preprocesses the PDFs under it first.
+
+Settings are comma separated `key=value` pairs of lang, oem, psm and tessdata_dir,
+e.g. "oem=1,tessdata_dir=/opt/tessdata_fast". Anything not given is taken from config,
+so the default reference is the current config. Without `--candidate` a few page
+segmentation modes are tried.
+"""
+import argparse
+import difflib
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import random
+import tempfile
+
+import ch_ocr_runner as cor
+import ch_ocr_runner.images.preprocessing
+import ch_ocr_runner.images.tesseract_wrapper
+import ch_ocr_runner.images.tsv_reader
+import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.setup_logging
+from ch_ocr_runner.images.tesseract_options import TesseractOptions
+from ch_ocr_runner.utils.timing import Timer
+
+# Page segmentation modes tried when no candidates are given:
+# 4 single column of text, 6 single block of text, 11 sparse text
+DEFAULT_CANDIDATES = ["psm=4", "psm=6", "psm=11"]
+
+WORD_LEVEL = 5
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+config = cor.utils.configuration.get_config()
+logger = logging.getLogger(__name__)
+
+
+class TrialResult(object):
+    """Speed and output of one setting over the sample"""
+
+    def __init__(self, options, seconds, page_words):
+        """
+        Args:
+            options (TesseractOptions): Setting tried
+            seconds: Wall time to OCR the sample
+            page_words: {image file: (words, word confidences)} in reading order
+        """
+        self.options = options
+        self.seconds = seconds
+        self.page_words = page_words
+
+        confs = [conf for _, page_confs in page_words.values() for conf in page_confs]
+        self.words = len(confs)
+        self.mean_conf = sum(confs) / len(confs) if confs else 0.0
+
+        # Set by `compare_to_reference`
+        self.agreement = None
+
+    @property
+    def pages_per_second(self):
+        return len(self.page_words) / self.seconds if self.seconds > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            "options": {
+                key: getattr(self.options, key) for key in TesseractOptions.KEYS
+            },
+            "pages": len(self.page_words),
+            "seconds": self.seconds,
+            "pages_per_second": self.pages_per_second,
+            "words": self.words,
+            "mean_conf": self.mean_conf,
+            "agreement": self.agreement,
+        }
+
+    def __repr__(self):
+        return f"TrialResult(options={self.options}, seconds={round(self.seconds, 2)})"
+
+
+def sample_pages(sample_size, work_dir, image_dir=None, pdf_dir=None, seed=0):
+    """
+    Picks a random sample of preprocessed pages.
+
+    Returns:
+        list[str]: Image files, named as `preprocess_pdf` names them
+    """
+    rng = random.Random(seed)
+
+    if image_dir is not None:
+        image_files = sorted(
+            glob.glob(os.path.join(image_dir, f"*{config.IMAGE_SUFFIX}"))
+        )
+        return sorted(rng.sample(image_files, min(sample_size, len(image_files))))
+
+    pdf_filepaths = sorted(
+        glob.glob(os.path.join(pdf_dir, "**", "*.pdf"), recursive=True)
+    )
+    rng.shuffle(pdf_filepaths)
+
+    raw_dir = os.path.join(work_dir, "raw")
+    processed_dir = os.path.join(work_dir, "processed")
+    os.makedirs(raw_dir, exist_ok=True)
+    os.makedirs(processed_dir, exist_ok=True)
+
+    # Render PDFs until there are enough pages, then sample from them
+    image_files = []
+    for pdf_filepath in pdf_filepaths:
+        if len(image_files) >= sample_size:
+            break
+
+        result = cor.images.preprocessing.preprocess_pdf(
+            raw_dir, processed_dir, pdf_filepath
+        )
+        image_files.extend(result.image_files)
+
+    return sorted(rng.sample(image_files, min(sample_size, len(image_files))))
+
+
+def run_trial(options, image_files, work_dir, repeats=1, processes=None):
+    """
+    OCRs the sample with the given settings.
+
+    Returns:
+        TrialResult: The fastest of `repeats` runs
+    """
+    trial_dir = tempfile.mkdtemp(dir=work_dir, prefix="trial-")
+    chunk_dir = os.path.join(trial_dir, "chunks")
+    tsv_dir = os.path.join(trial_dir, "tsv")
+    os.makedirs(chunk_dir)
+    os.makedirs(tsv_dir)
+
+    chunks = cor.images.tesseract_wrapper._create_chunks(image_files, chunk_dir)
+    params = [
+        (chunk.path, chunk.tsv_filepath_no_suffix(tsv_dir), options) for chunk in chunks
+    ]
+
+    timings = []
+    with multiprocessing.Pool(processes=processes or NUM_PROCESSES) as pool:
+        for _ in range(repeats):
+            with Timer() as timer:
+                outputs = pool.starmap(
+                    cor.images.tesseract_wrapper._run_tesseract_on_file,
+                    params,
+                    chunksize=1,
+                )
+            timings.append(timer.elapsed)
+
+    page_words = {}
+    for chunk, (_, stderr) in zip(chunks, outputs):
+        tsv_filepath = f"{chunk.tsv_filepath_no_suffix(tsv_dir)}.tsv"
+        if not os.path.exists(tsv_filepath):
+            raise RuntimeError(
+                f"Tesseract failed with {options}: {stderr.decode('utf-8').strip()}"
+            )
+
+        page_words.update(read_page_words(chunk, tsv_filepath))
+
+    return TrialResult(options, min(timings), page_words)
+
+
+def read_page_words(chunk, tsv_filepath):
+    """
+    Words Tesseract found on each page of a chunk.
+
+    Returns:
+        dict: {image file: (words, word confidences)} for every page in the chunk
+    """
+    tsv_df = cor.images.tsv_reader.read_tsv(tsv_filepath)
+    words_df = tsv_df[(tsv_df["level"] == WORD_LEVEL) & (tsv_df["conf"] >= 0)]
+
+    page_words = {filepath: ([], []) for filepath in chunk.filepaths}
+    for page_num, text, conf in zip(
+        words_df["page_num"], words_df["text"], words_df["conf"]
+    ):
+        if 1 <= page_num <= len(chunk.filepaths) and isinstance(text, str):
+            words, confs = page_words[chunk.filepaths[page_num - 1]]
+            words.append(text)
+            confs.append(float(conf))
+
+    return page_words
+
+
+def agreement(reference_words, words):
+    """Similarity of two word sequences, 1.0 if identical (both empty counts as identical)"""
+    if not reference_words and not words:
+        return 1.0
+
+    return difflib.SequenceMatcher(None, reference_words, words, autojunk=False).ratio()
+
+
+def compare_to_reference(reference, results):
+    """Sets the mean per page agreement of each result with the reference"""
+    for result in results:
+        scores = [
+            agreement(words, result.page_words.get(filepath, ([], []))[0])
+            for filepath, (words, _) in reference.page_words.items()
+        ]
+        result.agreement = sum(scores) / len(scores) if scores else 1.0
+
+
+def choose(reference, results, min_agreement, max_conf_drop):
+    """
+    The fastest result close enough to the reference.
+
+    Returns:
+        TrialResult: The reference itself if no other setting is acceptable
+    """
+    acceptable = [
+        result
+        for result in results
+        if result.agreement >= min_agreement
+        and result.mean_conf >= reference.mean_conf - max_conf_drop
+    ]
+
+    return max(acceptable + [reference], key=lambda result: result.pages_per_second)
+
+
+def report(reference, results, chosen):
+    print(
+        f"{'setting':<48} {'pages/s':>8} {'speedup':>8} {'conf':>6} {'agree':>6} {'words':>7}"
+    )
+    for result in results:
+        marker = " <- chosen" if result is chosen else ""
+        label = str(result.options) + (" (reference)" if result is reference else "")
+        print(
+            f"{label:<48} {result.pages_per_second:8.2f} "
+            f"{result.pages_per_second / reference.pages_per_second:7.2f}x "
+            f"{result.mean_conf:6.1f} {result.agreement:6.3f} {result.words:7,}{marker}"
+        )
+
+    print("\nConfig for the chosen setting:")
+    for line in chosen.options.config_lines():
+        print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="Directory of preprocessed pages")
+    source.add_argument("--pdf-dir", help="Directory of PDFs to sample pages from")
+    parser.add_argument("--sample", type=int, default=50, help="Pages to OCR")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--reference", default="", help="Reference setting, the current config if empty"
+    )
+    parser.add_argument(
+        "--candidate", action="append", help="Setting to try, may be repeated"
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--min-agreement", type=float, default=0.95)
+    parser.add_argument("--max-conf-drop", type=float, default=5.0)
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    reference_options = TesseractOptions.parse(args.reference)
+    candidate_options = [
+        TesseractOptions.parse(candidate, base=reference_options)
+        for candidate in (args.candidate or DEFAULT_CANDIDATES)
+    ]
+    candidate_options = [
+        options for options in candidate_options if options != reference_options
+    ]
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_files = sample_pages(
+            args.sample,
+            work_dir,
+            image_dir=args.images,
+            pdf_dir=args.pdf_dir,
+            seed=args.seed,
+        )
+        if not image_files:
+            parser.error("No pages found to sample")
+        logger.info(f"Sampled {len(image_files)} pages")
+
+        results = []
+        for options in [reference_options] + candidate_options:
+            logger.info(f"Running Tesseract with {options}")
+            results.append(run_trial(options, image_files, work_dir, args.repeats))
+
+    reference = results[0]
+    compare_to_reference(reference, results)
+    chosen = choose(reference, results[1:], args.min_agreement, args.max_conf_drop)
+
+    report(reference, results, chosen)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "pages": len(image_files),
+                    "results": [result.to_dict() for result in results],
+                    "chosen": chosen.to_dict(),
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    logger = cor.utils.setup_logging.setup_logging()
+
+    main()
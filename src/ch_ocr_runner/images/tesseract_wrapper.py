@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
-import csv
+import collections
+import concurrent.futures
 import glob
 import logging
-import multiprocessing
 import os
 import shlex
 import subprocess
@@ -11,12 +11,37 @@ import numpy as np
 import pandas as pd
 
 import ch_ocr_runner as cor
+import ch_ocr_runner.images.blank_pages
+import ch_ocr_runner.images.page_cache
+import ch_ocr_runner.images.preprocessing
+import ch_ocr_runner.images.tesseract_supervisor
+import ch_ocr_runner.images.tesseract_options
+import ch_ocr_runner.images.tsv_reader
+import ch_ocr_runner.leases
+import ch_ocr_runner.output
 import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.metrics
+import ch_ocr_runner.utils.pools
 from ch_ocr_runner.utils.decorators import log
 
-TESSERACT_COMMAND_TEMPLATE = "tesseract {chunk_path} {tsv_path} -l eng tsv"
-
-NUM_PROCESSES = multiprocessing.cpu_count()
+TSV_COLUMNS = [
+    "level",
+    "page_num",
+    "block_num",
+    "par_num",
+    "line_num",
+    "word_num",
+    "left",
+    "top",
+    "width",
+    "height",
+    "conf",
+    "text",
+]
+
+TSV_HEADER = "\t".join(TSV_COLUMNS) + "\n"
+
+BLANK_CHUNK_ID = "blank"
 
 logger = logging.getLogger(__name__)
 config = cor.utils.configuration.get_config()
@@ -31,6 +56,14 @@ class Chunk(object):
     def __init__(self, filepaths, chunk_id, chunk_dir):
         self.filepaths = tuple(sorted(filepaths))
         self.chunk_id = chunk_id
+
+        # PDF and page of each image, decoded once here rather than for every word
+        pages = [
+            cor.images.preprocessing.parse_processed_image_filename(filepath)
+            for filepath in self.filepaths
+        ]
+        self.basefiles = tuple(basefile for basefile, _ in pages)
+        self.page_indices = np.array([page for _, page in pages], dtype=np.int64)
         self.path = os.path.join(
             chunk_dir, f"{Chunk.CHUNK_PREFIX}{self.chunk_id}{Chunk.CHUNK_SUFFIX}"
         )
@@ -62,8 +95,112 @@ class Chunk(object):
         return self.__repr__()
 
 
+class CachedPages(object):
+    """
+    Looks pages up in the page cache, collecting the hits into a single chunk.
+
+    Only the misses need to be sent to Tesseract, repeats of a missed page within
+    the batch are left out too. Once the misses have been processed `store` adds
+    their output to the cache.
+    """
+
+    CHUNK_ID = "cached"
+
+    def __init__(self, cache, chunk_dir, tsv_dir):
+        self.cache = cache
+        self.chunk_dir = chunk_dir
+        self.tsv_dir = tsv_dir
+
+        self._keys = {}
+        self._rows = {}
+        self._repeats = {}
+
+    def misses(self, image_files, map_f=map):
+        """
+        Returns the image files which need to be sent to Tesseract.
+
+        Args:
+            image_files: Preprocessed images
+            map_f: Used to compute the cache keys, e.g. `pool.map` to load images in parallel
+        """
+        keys = list(map_f(cor.images.page_cache.image_file_key, image_files))
+
+        missed_keys = {key: image_file for image_file, key in self._keys.items()}
+
+        misses = []
+        for image_file, key in zip(image_files, keys):
+            if key in missed_keys:
+                self._repeats[image_file] = missed_keys[key]
+                continue
+
+            rows = self.cache.get(key)
+
+            if rows is None:
+                self._keys[image_file] = key
+                missed_keys[key] = image_file
+                misses.append(image_file)
+            else:
+                self._rows[image_file] = rows
+
+        return misses
+
+    def store(self, chunks):
+        """Add the Tesseract output for pages which missed the cache"""
+        missed_rows = {}
+
+        for chunk in chunks:
+            page_rows = _read_tsv_rows_by_page(
+                f"{chunk.tsv_filepath_no_suffix(self.tsv_dir)}.tsv"
+            )
+
+            for page_num, image_file in enumerate(chunk.filepaths, 1):
+                key = self._keys.get(image_file)
+
+                if key is not None and page_num in page_rows:
+                    self.cache.put(key, page_rows[page_num])
+                    missed_rows[image_file] = page_rows[page_num]
+
+        for image_file, original_file in self._repeats.items():
+            if original_file in missed_rows:
+                self._rows[image_file] = missed_rows[original_file]
+
+    def chunk(self):
+        """Chunk with a TSV made up of cached and repeated pages, None if there are none"""
+        if not self._rows:
+            return None
+
+        chunk = Chunk(
+            filepaths=self._rows.keys(),
+            chunk_id=self.CHUNK_ID,
+            chunk_dir=self.chunk_dir,
+        )
+        _write_chunk_tsv(chunk, self.tsv_dir, self._rows)
+
+        return chunk
+
+    def log_stats(self):
+        repeats = len(self._repeats)
+        hits = len(self._rows) - sum(f in self._rows for f in self._repeats)
+        misses = len(self._keys)
+        total = hits + repeats + misses
+        hit_rate = (hits + repeats) / total if total else 0.0
+
+        logger.info(
+            f"Page cache: {hits:,} hits, {repeats:,} repeated pages, {misses:,} misses "
+            f"({hit_rate:.1%} of pages not sent to Tesseract)"
+        )
+
+
 @log()
-def run_ocr(image_dir, chunk_dir, tsv_dir, output_dir):
+def run_ocr(
+    image_dir,
+    chunk_dir,
+    tsv_dir,
+    output_dir,
+    manifest=None,
+    batch_id=None,
+    max_processes=None,
+):
     """
     Starts multiple Tesseract subprocesses to run OCR over all images of a specific type in a directory.
 
@@ -74,17 +211,99 @@ def run_ocr(image_dir, chunk_dir, tsv_dir, output_dir):
         chunk_dir: Stores the input files to Tesseract (txt file lists of paths to images)
         tsv_dir: Tesseract will save tsv files here
         output_dir: Directory to save the final output to
+        manifest (ch_ocr_runner.manifest.BatchManifest): If given, chunks finished in a
+            previous run are reused and progress is recorded
+        batch_id: Batch the images are from, needed for Parquet output
+        max_processes: Tesseract processes run at once, one per core if None
     """
     _omp_check()
 
     image_files = glob.glob(f"{image_dir}/*{config.IMAGE_SUFFIX}")
     logger.info(f"{len(image_files)} to process")
 
-    chunks = _create_chunks(image_files, chunk_dir=chunk_dir)
+    done_chunks = []
+    if manifest is not None:
+        done_chunks = _done_chunks(manifest, chunk_dir=chunk_dir)
+        done_files = {f for chunk in done_chunks for f in chunk.filepaths}
+
+        image_files = [f for f in image_files if f not in done_files]
+        logger.info(f"{len(done_files)} already processed, {len(image_files)} to go")
+
+    cache = cor.images.page_cache.get_page_cache()
+
+    if cache is not None:
+        cached_pages = CachedPages(cache, chunk_dir=chunk_dir, tsv_dir=tsv_dir)
+
+        with cor.utils.pools.worker_pool() as pool:
+            image_files = cached_pages.misses(image_files, map_f=pool.map)
+
+    chunks = _create_chunks(
+        image_files, chunk_dir=chunk_dir, first_chunk_id=_next_chunk_id(done_chunks)
+    )
+
+    _run_tesseract(
+        chunks, tsv_dir=tsv_dir, manifest=manifest, max_processes=max_processes
+    )
+
+    if cache is not None:
+        cached_pages.store(chunks)
+        cached_pages.log_stats()
+
+        cached_chunk = cached_pages.chunk()
+        if cached_chunk is not None:
+            chunks.append(cached_chunk)
+
+    blank_chunk = create_blank_chunk(image_dir, chunk_dir=chunk_dir, tsv_dir=tsv_dir)
+    if blank_chunk is not None:
+        chunks.append(blank_chunk)
+
+    _create_final_output(
+        done_chunks + chunks,
+        tsv_dir=tsv_dir,
+        output_dir=output_dir,
+        manifest=manifest,
+        batch_id=batch_id,
+    )
+
+
+def create_blank_chunk(image_dir, chunk_dir, tsv_dir):
+    """
+    Chunk with a page row for each blank page (see `blank_pages`), None if there are none.
+
+    Blank pages aren't sent to Tesseract, this gives them a page entry in the output.
+    """
+    sizes = cor.images.blank_pages.find_blank_pages(image_dir)
+    if not sizes:
+        return None
+
+    logger.info(f"{len(sizes):,} blank pages not sent to Tesseract")
+
+    chunk = Chunk(filepaths=sizes.keys(), chunk_id=BLANK_CHUNK_ID, chunk_dir=chunk_dir)
+    _write_chunk_tsv(
+        chunk,
+        tsv_dir,
+        {
+            filepath: cor.images.blank_pages.tsv_rows(width, height)
+            for filepath, (width, height) in sizes.items()
+        },
+    )
+
+    return chunk
+
+
+def _done_chunks(manifest, chunk_dir):
+    """Chunks recorded in the manifest as finished by Tesseract"""
+    return [
+        Chunk(filepaths=filepaths, chunk_id=chunk_id, chunk_dir=chunk_dir)
+        for chunk_id, filepaths in manifest.ocr_done().items()
+    ]
 
-    _run_tesseract(chunks, tsv_dir=tsv_dir)
 
-    _create_final_output(chunks, tsv_dir=tsv_dir, output_dir=output_dir)
+def _next_chunk_id(chunks):
+    """First numeric chunk id not used by `chunks`"""
+    return (
+        max((c.chunk_id for c in chunks if isinstance(c.chunk_id, int)), default=-1) + 1
+    )
 
 
 def _omp_check():
@@ -102,58 +321,93 @@ def _omp_check():
         )
 
 
-def _create_chunks(image_files, chunk_dir):
+def _create_chunks(image_files, chunk_dir, pages_per_chunk=None, first_chunk_id=0):
     """
-    Splits a list of files into `num_chunks` and saves each list to a numbered text file.
+    Splits a list of files into small chunks and saves each list to a numbered text file.
 
     Tesseract can take a txt file with a list of images to process.
     This is more efficient than starting a new Tesseract process for each image.
 
+    Chunks are kept small (`config.TESSERACT_PAGES_PER_CHUNK` pages) and handed out to
+    workers as they become free, so a chunk of slow pages doesn't hold up the batch.
+
     Args:
-        output_dir:
-        image_files:
-        num_chunks:
+        image_files: Image files to run OCR over
+        chunk_dir: Directory to save the chunk files to
+        pages_per_chunk: Maximum number of images in each chunk
+        first_chunk_id: Chunks are numbered from here
+
+    Returns:
+        list[Chunk]: Chunks in sorted filename order
     """
-    split_files = np.array_split(sorted(image_files), NUM_PROCESSES)
+    if pages_per_chunk is None:
+        pages_per_chunk = config.TESSERACT_PAGES_PER_CHUNK
+
+    sorted_files = sorted(image_files)
 
     chunks = [
-        Chunk(filepaths=chunk_files.tolist(), chunk_id=chunk_id, chunk_dir=chunk_dir)
-        for chunk_id, chunk_files in enumerate(split_files)
+        Chunk(
+            filepaths=sorted_files[start : start + pages_per_chunk],
+            chunk_id=chunk_id,
+            chunk_dir=chunk_dir,
+        )
+        for chunk_id, start in enumerate(
+            range(0, len(sorted_files), pages_per_chunk), first_chunk_id
+        )
     ]
 
     return chunks
 
 
-def _run_tesseract(chunks, tsv_dir):
-    """Run Tesseract for each chunk"""
-    tesseract_params = [
-        (chunk.path, chunk.tsv_filepath_no_suffix(tsv_dir)) for chunk in chunks
-    ]
+def _run_tesseract(chunks, tsv_dir, manifest=None, max_processes=None):
+    """Run Tesseract for each chunk, a new process starts as soon as one finishes"""
+    logger.info("Starting Tesseract supervisor")
+    logger.info(f"Tesseract command: {tesseract_command_template()}")
+    logger.info(
+        f"{len(chunks)} chunks of up to {config.TESSERACT_PAGES_PER_CHUNK} pages"
+    )
+
+    supervisor = cor.images.tesseract_supervisor.TesseractSupervisor(
+        max_processes=max_processes
+    )
+    with supervisor:
+        futures = [supervisor.submit(chunk, tsv_dir) for chunk in chunks]
 
-    logger.info("Starting Tesseract process pool")
-    logger.info(f"Tesseract command: {TESSERACT_COMMAND_TEMPLATE}")
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            record_chunk_metrics(result.chunk, result.seconds)
 
-    for chunk_path, tsv_path in tesseract_params:
-        logger.info(f"chunk_path={chunk_path}, tsv_path={tsv_path}")
+            logger.debug(f"Output from {result}: {result.stdout.decode('utf-8')}")
 
-    pool = multiprocessing.Pool(processes=NUM_PROCESSES)
+            if manifest is not None and result.succeeded:
+                manifest.mark_ocr_done(result.chunk)
 
-    output = pool.starmap(_run_tesseract_on_file, tesseract_params)
 
-    pool.close()
-    pool.join()
+def record_chunk_metrics(chunk, seconds):
+    """Records a chunk finished by Tesseract in the batch metrics"""
+    cor.utils.metrics.observe("tesseract_chunk_seconds", seconds)
+    cor.utils.metrics.inc("ocr_pages", len(chunk.filepaths))
 
-    for (stdout, stderr), (chunk_path, tsv_path) in zip(output, tesseract_params):
-        logger.debug(
-            f"Logging output from chunk_path={chunk_path}, tsv_path={tsv_path} Tesseract call"
-        )
-        logger.debug(stdout.decode("utf-8"))
-        logger.debug(stderr.decode("utf-8"))
+
+def tesseract_command_template(options=None):
+    """
+    The tesseract command run for each chunk, with `{chunk_path}` and `{tsv_path}` placeholders.
+
+    Args:
+        options (ch_ocr_runner.images.tesseract_options.TesseractOptions): Settings,
+            from config if None
+    """
+    if options is None:
+        options = cor.images.tesseract_options.TesseractOptions.from_config()
+
+    return options.command_template()
 
 
-def _run_tesseract_on_file(chunk_path, tsv_path):
+def _run_tesseract_on_file(chunk_path, tsv_path, options=None):
     """Start a tesseract process to run OCR on a chunk of image files"""
-    cmd = TESSERACT_COMMAND_TEMPLATE.format(chunk_path=chunk_path, tsv_path=tsv_path)
+    cmd = tesseract_command_template(options).format(
+        chunk_path=chunk_path, tsv_path=tsv_path
+    )
 
     env = os.environ.copy()
 
@@ -167,63 +421,97 @@ def _run_tesseract_on_file(chunk_path, tsv_path):
     return stdout, stderr
 
 
-def _create_final_output(chunks, tsv_dir, output_dir):
-    """Link tsv output to original filenames and write out to a CSV per input PDF"""
+def _read_tsv_rows_by_page(tsv_filepath):
+    """Returns the raw lines of a Tesseract TSV file grouped by page_num"""
+    page_rows = collections.defaultdict(list)
+
+    with open(tsv_filepath, encoding="utf-8") as f:
+        next(f, None)  # Header
+
+        for line in f:
+            page_num = int(line.split("\t", 2)[1])
+            page_rows[page_num].append(line)
+
+    return page_rows
+
+
+def _write_chunk_tsv(chunk, tsv_dir, rows_by_filepath):
+    """
+    Writes the TSV file for a chunk from TSV rows already produced for each page.
+
+    The page_num column is renumbered to match each page's position in the chunk.
+    """
+    with open(
+        f"{chunk.tsv_filepath_no_suffix(tsv_dir)}.tsv", "w", encoding="utf-8"
+    ) as f:
+        f.write(TSV_HEADER)
+
+        for page_num, filepath in enumerate(chunk.filepaths, 1):
+            for row in rows_by_filepath[filepath]:
+                level, _, rest = row.split("\t", 2)
+                f.write(f"{level}\t{page_num}\t{rest}")
 
-    def extract_original_file_names(df):
-        """Removes suffix from image file names to recover the original PDF name"""
-        basefiles = (
-            df.filename.str.split(os.sep)  # Split by separator
-            .str[-1]  # Take last
-            .str.replace(f"_[0-9]+{config.IMAGE_SUFFIX}", "")  # Remove image suffix
-        )
-        return basefiles
-
-    def extract_page_numbers(df):
-        """Extracts the page number from the image file suffix"""
-        page_nums = (
-            df.filename.str.split("/")
-            .str[-1]
-            .str.replace(config.IMAGE_SUFFIX, "")
-            .str.split("_")
-            .str[-1]
-        )
-        return page_nums
 
-    filenamed_tsv_dfs = [
-        _link_tsv_to_filename(chunk, tsv_dir=tsv_dir) for chunk in chunks
+def _create_final_output(chunks, tsv_dir, output_dir, manifest=None, batch_id=None):
+    """
+    Link tsv output to original filenames and write out in `config.OUTPUT_FORMAT`.
+
+    By default that is a CSV per input PDF, see `ch_ocr_runner.output`.
+    If a manifest is given, output already written in a previous run is skipped.
+    """
+    basefiles = sorted({basefile for chunk in chunks for basefile in chunk.basefiles})
+    basefile_codes = {basefile: code for code, basefile in enumerate(basefiles)}
+
+    linked_tsv_dfs = [
+        _link_tsv_to_pages(chunk, tsv_dir=tsv_dir, basefile_codes=basefile_codes)
+        for chunk in chunks
     ]
 
-    all_tsv_df = pd.concat(filenamed_tsv_dfs)
+    all_tsv_df = pd.concat(linked_tsv_dfs, ignore_index=True)
 
-    all_tsv_df["basefile"] = extract_original_file_names(all_tsv_df)
-    all_tsv_df["page_num"] = extract_page_numbers(all_tsv_df)
+    all_tsv_df["basefile"] = pd.Categorical.from_codes(
+        all_tsv_df["basefile"], categories=basefiles
+    )
 
-    for key, group_df in all_tsv_df.groupby("basefile"):
+    cor.utils.metrics.inc("pages_output", sum(len(chunk.filepaths) for chunk in chunks))
 
-        outfilepath = os.path.join(output_dir, f"{key}_output.csv")
-        output_df = group_df.sort_values("page_num").drop(
-            columns=["filename", "basefile"]
-        )
+    # Only the machine holding the batch's lease writes its output
+    cor.leases.check()
 
-        output_df.to_csv(outfilepath, index=False)
+    cor.output.write_output(
+        all_tsv_df,
+        output_dir=output_dir,
+        batch_id=batch_id,
+        manifest=manifest,
+    )
 
 
-def _link_tsv_to_filename(chunk: Chunk, tsv_dir):
+def _link_tsv_to_pages(chunk: Chunk, tsv_dir, basefile_codes):
+    """
+    Reads the TSV for a chunk and replaces Tesseract's page number with the PDF and page.
 
-    tesseract_df = pd.read_csv(
-        os.path.join(tsv_dir, f"{chunk.tsv_filename_no_suffix}.tsv"),
-        sep="\t",
-        engine="python",
-        quotechar=None,
-        quoting=csv.QUOTE_NONE,
-        encoding="utf-8",
+    Returns:
+        pd.DataFrame: TSV rows with `page_num` set to the page index in the PDF and
+            `basefile` holding the code of the PDF in `basefile_codes`
+    """
+    tesseract_df = cor.images.tsv_reader.read_tsv(
+        os.path.join(tsv_dir, f"{chunk.tsv_filename_no_suffix}.tsv")
     )
 
-    filename_df = pd.DataFrame(
-        {"filename": chunk.filepaths, "page_num": range(1, len(chunk.filepaths) + 1)}
+    # Tesseract numbers the pages of a chunk from 1 in chunk order
+    positions = tesseract_df["page_num"].to_numpy() - 1
+
+    in_chunk = (positions >= 0) & (positions < len(chunk.filepaths))
+    if not in_chunk.all():
+        tesseract_df = tesseract_df[in_chunk]
+        positions = positions[in_chunk]
+
+    chunk_codes = np.array(
+        [basefile_codes[basefile] for basefile in chunk.basefiles], dtype=np.int32
     )
 
-    merged_df = pd.merge(filename_df, tesseract_df, on="page_num")
+    linked_df = tesseract_df.drop(columns=["page_num"])
+    linked_df.insert(0, "page_num", chunk.page_indices[positions])
+    linked_df["basefile"] = chunk_codes[positions]
 
-    return merged_df
+    return linked_df
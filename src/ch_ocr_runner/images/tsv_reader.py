@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Reads Tesseract TSV output into a DataFrame.
+
+Tesseract doesn't quote or escape the `text` field, so quote characters are read as
+ordinary characters (quoting is turned off). Tabs and newlines can't appear in a word.
+
+Reads the same values as the original `pd.read_csv(..., engine="python", quoting=QUOTE_NONE)`
+call (including which words are read as NaN, e.g. "NA" or "null"), except that `text` is
+always read as strings. The original inferred its type, so a chunk whose words were all
+numbers gave floats (2019.0 for "2019") and lost leading zeros. Reads with either:
+
+* "c": the pandas C parser with explicit dtypes (default)
+* "pyarrow": the multithreaded pyarrow CSV reader (needs `pip install pyarrow`)
+"""
+import csv
+import logging
+
+import numpy as np
+import pandas as pd
+
+import ch_ocr_runner.utils.configuration as configuration
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+# Every column except `conf` is always an integer. `conf` is an integer in Tesseract 4
+# and a float in Tesseract 5, it is left to type inference so output matches either.
+INT_COLUMNS = [
+    "level",
+    "page_num",
+    "block_num",
+    "par_num",
+    "line_num",
+    "word_num",
+    "left",
+    "top",
+    "width",
+    "height",
+]
+TEXT_COLUMN = "text"
+
+# dtype the C parser gives `text`: object before pandas 3, the NaN backed string dtype after
+TEXT_DTYPE = pd.Series([], dtype="str").dtype
+
+# Strings pandas reads as NaN by default, used to give pyarrow the same behaviour
+NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+
+def read_tsv(tsv_filepath, engine=None):
+    """
+    Reads a Tesseract TSV file.
+
+    Args:
+        tsv_filepath: TSV file written by Tesseract
+        engine: "c" or "pyarrow", defaults to `config.TSV_READER`
+
+    Returns:
+        pd.DataFrame: One row per TSV line with the Tesseract columns
+    """
+    engine = engine or config.TSV_READER
+
+    if engine == "pyarrow":
+        if pyarrow is not None:
+            return _read_tsv_pyarrow(tsv_filepath)
+
+        logger.warning("pyarrow is not installed, reading TSV with the C parser")
+
+    elif engine != "c":
+        raise ValueError(f"Unknown TSV reader: {engine}")
+
+    return _read_tsv_c(tsv_filepath)
+
+
+def _read_tsv_c(tsv_filepath):
+    dtypes = {column: "int64" for column in INT_COLUMNS}
+    dtypes[TEXT_COLUMN] = "str"
+
+    return pd.read_csv(
+        tsv_filepath,
+        sep="\t",
+        engine="c",
+        dtype=dtypes,
+        quoting=csv.QUOTE_NONE,
+        encoding="utf-8",
+    )
+
+
+def _read_tsv_pyarrow(tsv_filepath):
+    column_types = {column: pyarrow.int64() for column in INT_COLUMNS}
+    column_types[TEXT_COLUMN] = pyarrow.string()
+
+    table = pyarrow.csv.read_csv(
+        tsv_filepath,
+        parse_options=pyarrow.csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=column_types,
+            null_values=NA_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+
+    df = table.to_pandas()
+    df[TEXT_COLUMN] = _text_as_c_parser(df[TEXT_COLUMN])
+
+    return df
+
+
+def _text_as_c_parser(text: pd.Series):
+    """
+    Gives a `text` column from pyarrow the C parser's dtype, with NaN for missing words.
+
+    Before pandas 3 pyarrow gives an object column holding None, which `astype("str")`
+    would turn into the word "None".
+    """
+    text = text.astype(object)
+
+    return text.where(text.notna(), np.nan).astype(TEXT_DTYPE)
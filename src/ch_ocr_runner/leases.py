@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Leases on batches, so machines can share out batches through the shared `WORKING_DIR`.
+
+Used when `config.ALLOCATION_MODE` is "dynamic". A machine holds a lease on a batch while
+it processes it, a lease is a file created atomically next to the batch `.lock` file:
+
+    {WORKING_DIR}/batch_{batch_id}.lease
+
+While the batch is processed a thread updates the lease modification time every
+`config.LEASE_HEARTBEAT_SECONDS`. A lease which hasn't been updated for
+`config.LEASE_EXPIRY_SECONDS` (e.g. the machine died) is stale and can be taken over.
+To take over, the stale lease is renamed out of the way (only one machine can succeed)
+before creating a new one.
+
+If the lease is taken over anyway (e.g. this machine stalled past the expiry time),
+`check` raises `LeaseLostError` at the next stage of the batch, before any output or the
+`.lock` file is written, so only the new holder writes them. A new holder which doesn't
+resume removes the batch directory, so the stage in progress may fail first (e.g. with
+FileNotFoundError), `stage_errors_if_lost` turns that error into `LeaseLostError` too.
+
+Expiry compares file times on the shared store with the local clock,
+so machines need their clocks synchronised (e.g. NTP) to well within the expiry time.
+"""
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import ch_ocr_runner.utils.configuration as configuration
+
+LEASE_SUFFIX = ".lease"
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+# Lease on the batch in progress, None when not using leases
+_held = None
+
+
+class LeaseLostError(RuntimeError):
+    """The lease on the batch in progress was taken over by another machine"""
+
+
+def lease_file_path(batch_id):
+    return os.path.join(config.WORKING_DIR, f"batch_{batch_id:02}{LEASE_SUFFIX}")
+
+
+def check():
+    """Raises `LeaseLostError` if the lease on the batch in progress has been lost"""
+    if _held is not None and _held.lost.is_set():
+        raise LeaseLostError(
+            f"Lease on batch {_held.batch_id} was taken over by another machine"
+        )
+
+
+def is_lost():
+    """
+    True if the lease on the batch in progress has been lost.
+
+    Reads the lease file rather than waiting for the next heartbeat.
+    """
+    if _held is None:
+        return False
+
+    if not _held._is_ours():
+        _held.lost.set()
+
+    return _held.lost.is_set()
+
+
+@contextlib.contextmanager
+def stage_errors_if_lost():
+    """Raises `LeaseLostError` instead of an error from a batch whose lease was lost"""
+    try:
+        yield
+    except LeaseLostError:
+        raise
+    except Exception as e:
+        if not is_lost():
+            raise
+
+        raise LeaseLostError(
+            f"Lease on batch {_held.batch_id} was taken over by another machine ({e!r})"
+        ) from e
+
+
+class Lease(object):
+    """
+    A lease held by this process on a batch.
+
+    Use `Lease.acquire` to get one, and as a context manager around processing the
+    batch, which makes it the lease `check`ed and releases it when done.
+    """
+
+    def __init__(self, batch_id, path, token):
+        self.batch_id = batch_id
+        self.path = path
+        self.token = token
+
+        # Set if another machine takes over the lease
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+
+    @classmethod
+    def acquire(cls, batch_id):
+        """
+        Tries to take the lease on a batch.
+
+        Returns:
+            Lease: The lease, with its heartbeat running, or None if held by another machine
+        """
+        path = lease_file_path(batch_id)
+        token = uuid.uuid4().hex
+
+        if not _create_lease_file(path, token):
+            if not _remove_if_stale(path):
+                return None
+
+            if not _create_lease_file(path, token):
+                return None
+
+        lease = cls(batch_id, path, token)
+        lease._heartbeat.start()
+
+        return lease
+
+    def release(self):
+        self._stop.set()
+        self._heartbeat.join()
+
+        if self._is_ours():
+            os.remove(self.path)
+
+        if self.lost.is_set():
+            logger.warning(
+                f"Lease on batch {self.batch_id} was taken over by another machine"
+            )
+
+    def _beat(self):
+        while not self._stop.wait(config.LEASE_HEARTBEAT_SECONDS):
+            if not self._is_ours():
+                self.lost.set()
+                return
+
+            try:
+                os.utime(self.path)
+            except OSError as e:
+                # Removed or replaced since we checked
+                logger.warning(f"Unable to renew lease on batch {self.batch_id}: {e}")
+                self.lost.set()
+                return
+
+    def _is_ours(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f).get("token") == self.token
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def __enter__(self):
+        global _held
+        _held = self
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _held
+        _held = None
+
+        self.release()
+
+    def __repr__(self):
+        return f"Lease(batch_id={self.batch_id})"
+
+
+def _create_lease_file(path, token):
+    """Atomically creates the lease file, returns False if it already exists"""
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+
+    holder = {
+        "token": token,
+        "machine": os.getenv(config.MACHINE_ENV_VAR),
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "acquired": time.time(),
+    }
+
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(holder, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return True
+
+
+def _remove_if_stale(path):
+    """Moves a stale lease out of the way, returns True if this process did so"""
+    try:
+        age_seconds = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        # Released since we tried to create it
+        return True
+
+    if age_seconds < config.LEASE_EXPIRY_SECONDS:
+        return False
+
+    # Only one machine can rename the stale lease, the others get FileNotFoundError
+    stale_path = f"{path}.stale-{uuid.uuid4().hex}"
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return False
+
+    # Another machine may have taken over and created a new lease since we checked
+    if time.time() - os.stat(stale_path).st_mtime < config.LEASE_EXPIRY_SECONDS:
+        try:
+            os.link(stale_path, path)  # Unlike rename, doesn't replace an existing file
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+
+    logger.warning(
+        f"Taking over stale lease {path} ({round(age_seconds)} seconds old): "
+        f"{_read_holder(stale_path)}"
+    )
+    os.remove(stale_path)
+
+    return True
+
+
+def _read_holder(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
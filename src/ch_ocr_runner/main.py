@@ -16,18 +16,29 @@ Directory locations (and many other aspects of the system) are configurable
 
 The system is designed to run on multiple machines which can all read from a single shared location.
 """
+import functools
 import multiprocessing
 import os
 import shutil
 
 import ch_ocr_runner as cor
 import ch_ocr_runner.images.preprocessing
+import ch_ocr_runner.images.tesseract_engine
 import ch_ocr_runner.images.tesseract_wrapper
+import ch_ocr_runner.leases
+import ch_ocr_runner.manifest
+import ch_ocr_runner.output
+import ch_ocr_runner.pipeline
+import ch_ocr_runner.scratch
 import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.metrics
+import ch_ocr_runner.utils.pools
+import ch_ocr_runner.utils.profiling
 import ch_ocr_runner.utils.setup_logging
 import ch_ocr_runner.work
 from ch_ocr_runner.images.preprocessing import preprocess_pdfs_for_ocr
 from ch_ocr_runner.utils.decorators import log
+from ch_ocr_runner.utils.timing import Timer
 
 NUM_PROCESSES = multiprocessing.cpu_count()
 
@@ -38,19 +49,56 @@ logger = cor.utils.setup_logging.setup_logging()
 class WorkingDir(object):
     """Manages directory for work in progress.
 
-    NOTE: Clears out directory on initialisation
+    NOTE: Clears out directory on initialisation, unless resuming.
+    When resuming, work already done is kept and recorded in `self.manifest`.
+
+    With `config.SCRATCH_DIR` set, transient directories may be placed in a
+    RAM-backed scratch space instead, see the `scratch` module.
     """
 
-    def __init__(self, batch_id):
+    def __init__(self, batch_id, resume=False, pages=0):
+        """
+        Args:
+            batch_id: Batch being processed
+            resume: Keep the work done by a previous run of the batch
+            pages: Pages in the batch, to size the transient directories
+        """
         self.batch_id = batch_id
 
         self.batch_dir = os.path.join(config.WORKING_DIR, f"batch_{batch_id:02}")
 
-        WorkingDir.__remove_if_exists(self.batch_dir)
-
-        os.mkdir(self.batch_dir)
-
-        self.__create_sub_dirs()
+        resuming = resume and os.path.exists(self.batch_dir)
+        if resuming:
+            logger.info(f"Working directory {self.batch_dir} exists, resuming")
+            self.scratch_dir, scratch_dirs = cor.scratch.load_placement(self.batch_dir)
+        else:
+            WorkingDir.__remove_if_exists(self.batch_dir)
+            os.mkdir(self.batch_dir)
+            self.scratch_dir, scratch_dirs = None, []
+
+        self.manifest = None
+        if resume:
+            self.manifest = cor.manifest.BatchManifest(self.batch_dir)
+
+        if self.scratch_dir is not None and not os.path.exists(self.scratch_dir):
+            logger.warning(
+                f"Scratch directory {self.scratch_dir} was lost, redoing work not output"
+            )
+            self.manifest.forget_intermediates()
+            self.scratch_dir, scratch_dirs = None, []
+            resuming = False
+
+        if self.scratch_dir is not None and resuming:
+            cor.scratch.reserve(self.scratch_dir, pages, scratch_dirs)
+
+        if config.SCRATCH_DIR and not resuming:
+            self.scratch_dir = cor.scratch.batch_scratch_dir(batch_id)
+            cor.scratch.remove(self.scratch_dir)
+            scratch_dirs = cor.scratch.plan(pages, config.SCRATCH_DIR, self.scratch_dir)
+            cor.scratch.save_placement(self.batch_dir, self.scratch_dir, scratch_dirs)
+            logger.info(f"Placing {scratch_dirs} in scratch {self.scratch_dir}")
+
+        self.__create_sub_dirs(scratch_dirs)
 
     @staticmethod
     def __create(parent, basename):
@@ -61,7 +109,7 @@ class WorkingDir(object):
             str: Full path to directory
         """
         dirpath = os.path.join(parent, basename)
-        os.mkdir(dirpath)
+        os.makedirs(dirpath, exist_ok=True)
         return dirpath
 
     @staticmethod
@@ -74,14 +122,23 @@ class WorkingDir(object):
             logger.info(f"Working directory {path} exists, clearing out")
             shutil.rmtree(path)
 
-    def __create_sub_dirs(self):
+    def __create_sub_dirs(self, scratch_dirs):
+        def transient(name):
+            parent = self.scratch_dir if name in scratch_dirs else self.batch_dir
+            return WorkingDir.__create(parent, cor.scratch.TRANSIENT_DIRS[name])
+
         self.image_dir = WorkingDir.__create(self.batch_dir, "images")
-        self.image_raw_dir = WorkingDir.__create(self.image_dir, "raw")
-        self.image_processed_dir = WorkingDir.__create(self.image_dir, "processed")
-        self.chunk_dir = WorkingDir.__create(self.batch_dir, "chunks")
-        self.tsv_dir = WorkingDir.__create(self.batch_dir, "tsv")
+        self.image_raw_dir = transient("raw")
+        self.image_processed_dir = transient("processed")
+        self.chunk_dir = transient("chunks")
+        self.tsv_dir = transient("tsv")
         self.output_dir = WorkingDir.__create(self.batch_dir, "output")
 
+    def remove_scratch(self):
+        """Frees the scratch space of a finished batch"""
+        if self.scratch_dir is not None:
+            cor.scratch.remove(self.scratch_dir)
+
 
 @log()
 def main():
@@ -90,42 +147,203 @@ def main():
 
     work = cor.work.fetch(allocation_filepath=config.WORK_BATCH_ALLOCATION_FILEPATH)
 
-    for i, batch in enumerate(work):
-        logger.info(f"Processed {i} batches this run")
+    with cor.utils.pools.run_pool():
+        if config.ALLOCATION_MODE == "static":
+            ahead = None
+            for i, (batch, next_batch) in enumerate(cor.work.prefetch(work)):
+                logger.info(f"Processed {i} batches this run")
+
+                ahead = process(batch, next_batch=next_batch, ahead=ahead)
+
+        elif config.ALLOCATION_MODE == "dynamic":
+            processed = process_with_leases(work)
+
+            logger.info(
+                "Allocated batches done, taking over batches from other machines"
+            )
+            process_with_leases(
+                cor.work.fetch_other_machines(
+                    allocation_filepath=config.WORK_BATCH_ALLOCATION_FILEPATH
+                ),
+                processed=processed,
+            )
+
+        else:
+            raise ValueError(f"Unknown ALLOCATION_MODE: {config.ALLOCATION_MODE}")
+
+
+def process_with_leases(work, processed=0):
+    """
+    Processes each batch not finished or leased by another machine.
+
+    Batches aren't preprocessed ahead, as that would need the lease on the next batch.
+
+    Returns:
+        int: Number of batches processed this run
+    """
+    for batch, _ in cor.work.prefetch(work):
+        if is_lockfile_present(batch):
+            continue
+
+        lease = cor.leases.Lease.acquire(batch.batch_id)
+        if lease is None:
+            logger.info(f"{batch} is leased by another machine, skipping")
+            continue
+
+        with lease:
+            logger.info(f"Processed {processed} batches this run")
+
+            try:
+                process(batch)
+            except cor.leases.LeaseLostError as e:
+                logger.warning(f"Abandoning {batch}: {e}")
+                continue
 
-        process(batch)
+            processed += 1
+
+    return processed
 
 
 @log()
-def process(batch: ch_ocr_runner.work.WorkBatch):
+def process(batch: ch_ocr_runner.work.WorkBatch, next_batch=None, ahead=None):
     """Runs Tesseract on batches of PDFs
 
     All files generated along the way are stored in a working directory.
 
     NOTE: Will skip processing if the lock file for this batch is present.
+    With `config.RESUME_BATCHES` set, only work missing from a previous run is done.
+
+    Args:
+        batch: Batch to process
+        next_batch: Batch processed after this one, preprocessed ahead with
+            `config.RENDER_AHEAD` (staged pipeline only)
+        ahead (ch_ocr_runner.images.preprocessing.RenderAhead): Preprocessing of this
+            batch started while the previous batch was processed
+
+    Returns:
+        RenderAhead: Preprocessing of `next_batch` if started, pass it on when
+            processing `next_batch`
     """
     if is_lockfile_present(batch):
         logger.info(f"{batch} already processed, skipping")
-        return
+        return None
+
+    # Fail before doing any work if the output can't be written
+    cor.output.check_output_format()
 
-    working_dir = WorkingDir(batch_id=batch.batch_id)
+    if ahead is not None and ahead.batch.batch_id == batch.batch_id:
+        working_dir = ahead.working_dir
+    else:
+        ahead = None
+        working_dir = create_working_dir(batch)
 
     # Save missing data from the batch
     batch.missing_df.to_csv(
         os.path.join(working_dir.batch_dir, "missing_data.csv"), index=False
     )
 
-    preprocess_pdfs_for_ocr(batch, working_dir)
+    start_next = None
+    if config.RENDER_AHEAD and next_batch is not None:
+        start_next = functools.partial(render_ahead, next_batch)
 
-    cor.images.tesseract_wrapper.run_ocr(
-        image_dir=working_dir.image_processed_dir,
-        chunk_dir=working_dir.chunk_dir,
-        tsv_dir=working_dir.tsv_dir,
-        output_dir=working_dir.output_dir,
-    )
+    cor.utils.metrics.start_batch()
+    cor.utils.profiling.start_batch(working_dir.batch_dir)
+    try:
+        with Timer() as timer, cor.leases.stage_errors_if_lost():
+            next_ahead = run_pipeline(
+                batch, working_dir, ahead=ahead, start_next=start_next
+            )
+
+        # Another machine owns the batch now, it writes the lockfile
+        cor.leases.check()
+    except cor.leases.LeaseLostError:
+        working_dir.remove_scratch()
+        raise
+
+    cor.utils.metrics.finish_batch(working_dir.batch_dir, batch.batch_id, timer.elapsed)
+    cor.utils.profiling.finish_batch()
 
     create_lockfile(batch)
 
+    working_dir.remove_scratch()
+
+    return next_ahead
+
+
+def create_working_dir(batch):
+    return WorkingDir(
+        batch_id=batch.batch_id,
+        resume=config.RESUME_BATCHES,
+        pages=cor.scratch.batch_pages(batch) if config.SCRATCH_DIR else 0,
+    )
+
+
+def render_ahead(batch):
+    """
+    Starts preprocessing a batch in the background on the run pool.
+
+    Returns:
+        RenderAhead: None if the batch is already processed or there is no run pool
+    """
+    pool = cor.utils.pools.get_run_pool()
+    if pool is None or is_lockfile_present(batch):
+        return None
+
+    return cor.images.preprocessing.RenderAhead(
+        batch, create_working_dir(batch), pool
+    ).start()
+
+
+def run_pipeline(batch, working_dir, ahead=None, start_next=None):
+    """
+    Runs the pipeline chosen by `config.PIPELINE_MODE` and `config.TESSERACT_BACKEND`
+
+    Args:
+        batch: Batch to process
+        working_dir (WorkingDir): Working directory for the batch
+        ahead (RenderAhead): Preprocessing of the batch already started, if any
+        start_next: Called once the batch is preprocessed to start on the next batch,
+            only in the staged pipeline
+
+    Returns:
+        What `start_next` returned, None if not called
+    """
+    if config.TESSERACT_BACKEND == "capi" and _tesseract_engine_available():
+        cor.pipeline.run_in_process(batch, working_dir)
+
+    elif config.PIPELINE_MODE == "streaming":
+        cor.pipeline.run_streaming(batch, working_dir)
+
+    elif config.PIPELINE_MODE == "staged":
+        preprocess_pdfs_for_ocr(batch, working_dir, ahead=ahead)
+        cor.leases.check()
+
+        next_ahead = start_next() if start_next is not None else None
+
+        cor.images.tesseract_wrapper.run_ocr(
+            image_dir=working_dir.image_processed_dir,
+            chunk_dir=working_dir.chunk_dir,
+            tsv_dir=working_dir.tsv_dir,
+            output_dir=working_dir.output_dir,
+            manifest=working_dir.manifest,
+            batch_id=batch.batch_id,
+        )
+
+        return next_ahead
+
+    else:
+        raise ValueError(f"Unknown PIPELINE_MODE: {config.PIPELINE_MODE}")
+
+    return None
+
+
+def _tesseract_engine_available():
+    if cor.images.tesseract_engine.is_available():
+        return True
+
+    logger.warning("Tesseract C API unavailable, falling back to the tesseract CLI")
+    return False
+
 
 def is_lockfile_present(batch: ch_ocr_runner.work.WorkBatch):
     return os.path.exists(lock_file_path(batch))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Records the progress of a batch so an interrupted batch can be resumed.
+
+The manifest is an append-only JSON lines file in the batch working directory.
+Each line records a piece of completed work:
+
+* `rendered`: a PDF (or a page range of one) has been turned into preprocessed images
+* `ocr_done`: Tesseract has finished a chunk (lists the images in the chunk)
+* `output_written`: the final output for a PDF has been written
+
+Records are only written once the work is complete and are synced to disk,
+a partially written last line (e.g. after a power cut) is dropped when the manifest is opened.
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+RENDERED = "rendered"
+OCR_DONE = "ocr_done"
+OUTPUT_WRITTEN = "output_written"
+
+
+class BatchManifest(object):
+    """Progress record for a batch, stored in the batch working directory"""
+
+    def __init__(self, batch_dir):
+        self.path = os.path.join(batch_dir, MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+
+        self._drop_incomplete_record()
+
+    def mark_rendered(self, task_key, image_files):
+        """Records a preprocessing task as done, see `PageRangeTask.key`"""
+        self._append({"event": RENDERED, "pdf": task_key, "images": image_files})
+
+    def mark_ocr_done(self, chunk):
+        self._append(
+            {
+                "event": OCR_DONE,
+                "chunk_id": chunk.chunk_id,
+                "images": list(chunk.filepaths),
+            }
+        )
+
+    def mark_output_written(self, basefile):
+        self._append({"event": OUTPUT_WRITTEN, "basefile": basefile})
+
+    def rendered(self):
+        """Returns {task key: [image files]} for every finished preprocessing task"""
+        return {record["pdf"]: record["images"] for record in self._records(RENDERED)}
+
+    def ocr_done(self):
+        """Returns {chunk_id: [image files]} for every chunk Tesseract has finished"""
+        return {
+            record["chunk_id"]: record["images"] for record in self._records(OCR_DONE)
+        }
+
+    def outputs_written(self):
+        """Returns the set of basefiles with final output written"""
+        return {record["basefile"] for record in self._records(OUTPUT_WRITTEN)}
+
+    def forget_intermediates(self):
+        """
+        Drops every record but `output_written`, for when the intermediate files are lost.
+
+        The work not yet output is then redone from the start.
+        """
+        records = list(self._records(OUTPUT_WRITTEN))
+
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        line = json.dumps(record) + "\n"
+
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _drop_incomplete_record(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb+") as f:
+            content = f.read()
+
+            if content and not content.endswith(b"\n"):
+                logger.warning(f"Dropping incomplete last record from {self.path}")
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def _records(self, event):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(
+                        f"Ignoring incomplete manifest record in {self.path}"
+                    )
+                    continue
+
+                if record["event"] == event:
+                    yield record
+
+    def __repr__(self):
+        return f"BatchManifest(path={self.path})"
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Writers for the final OCR output of a batch.
+
+`config.OUTPUT_FORMAT` chooses the writer:
+
+* "csv" (default): a CSV per input PDF, `{basefile}_output.csv` in the batch output directory
+* "parquet": one compressed Parquet file per batch in a dataset partitioned by batch,
+  `{config.PARQUET_DATASET_DIR}/batch_id={batch_id}/part-0.parquet`.
+  Needs pyarrow (`pip install -e .[arrow]`).
+"""
+import logging
+import multiprocessing
+import os
+
+import ch_ocr_runner.utils.configuration as configuration
+import ch_ocr_runner.utils.metrics as metrics
+import ch_ocr_runner.utils.pools as pools
+import ch_ocr_runner.utils.profiling as profiling
+from ch_ocr_runner.utils.timing import Timer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+PARQUET_PART_FILENAME = "part-0.parquet"
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+# PDFs sent to a writer process at a time
+CSV_WRITE_CHUNKSIZE = 16
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+
+def parquet_schema():
+    """Column types of the Parquet output"""
+    int32_columns = [
+        "page_num",
+        "level",
+        "block_num",
+        "par_num",
+        "line_num",
+        "word_num",
+        "left",
+        "top",
+        "width",
+        "height",
+    ]
+
+    return pyarrow.schema(
+        [
+            pyarrow.field(
+                "basefile", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+            )
+        ]
+        + [pyarrow.field(column, pyarrow.int32()) for column in int32_columns]
+        + [
+            pyarrow.field("conf", pyarrow.float32()),
+            pyarrow.field("text", pyarrow.string()),
+        ]
+    )
+
+
+def check_output_format():
+    """Raises an error for an unknown `config.OUTPUT_FORMAT` or a missing dependency"""
+    if config.OUTPUT_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown OUTPUT_FORMAT: {config.OUTPUT_FORMAT}")
+
+    if config.OUTPUT_FORMAT == "parquet" and pyarrow is None:
+        raise ImportError("Parquet output needs pyarrow, install the arrow extra")
+
+
+def write_output(output_df, output_dir, batch_id=None, manifest=None):
+    """
+    Writes the OCR output for a batch in `config.OUTPUT_FORMAT`.
+
+    Args:
+        output_df (pd.DataFrame): Tesseract rows with `basefile` and image `page_num`
+        output_dir: Batch output directory, used for CSV output
+        batch_id: Batch the output is for, used to partition Parquet output
+        manifest (ch_ocr_runner.manifest.BatchManifest): If given, CSV output already
+            written is skipped and progress is recorded
+    """
+    check_output_format()
+
+    if config.OUTPUT_FORMAT == "parquet" and batch_id is None:
+        raise ValueError("Parquet output needs a batch_id to partition by")
+
+    with Timer(metric="output_write_seconds"):
+        if config.OUTPUT_FORMAT == "parquet":
+            write_parquet(output_df, config.PARQUET_DATASET_DIR, batch_id)
+        else:
+            write_csv_per_pdf(output_df, output_dir, manifest=manifest)
+
+
+def write_csv_per_pdf(output_df, output_dir, manifest=None, processes=None):
+    """
+    Writes a CSV per input PDF, sorted by page.
+
+    The CSV files are written by a pool of processes (one process if `processes` is 1).
+    """
+    written = manifest.outputs_written() if manifest is not None else set()
+
+    output_df = output_df.sort_values(["basefile", "page_num"], kind="stable")
+
+    groups = (
+        (os.path.join(output_dir, f"{basefile}_output.csv"), basefile, group_df)
+        for basefile, group_df in output_df.groupby(
+            "basefile", sort=False, observed=True
+        )
+        if basefile not in written
+    )
+
+    processes = processes or NUM_PROCESSES
+    if processes == 1:
+        _record_written(map(_write_csv, groups), manifest)
+        return
+
+    with pools.worker_pool(processes) as pool:
+        results = pool.imap_unordered(
+            profiling.profiled("write_output", _write_csv),
+            groups,
+            chunksize=CSV_WRITE_CHUNKSIZE,
+        )
+        _record_written(results, manifest)
+
+
+def _record_written(results, manifest):
+    for basefile, size in results:
+        metrics.inc("output_bytes_written", size)
+
+        if manifest is not None:
+            manifest.mark_output_written(basefile)
+
+
+def _write_csv(params):
+    outfilepath, basefile, group_df = params
+
+    group_df.drop(columns=["basefile"]).to_csv(outfilepath, index=False)
+
+    return basefile, os.path.getsize(outfilepath)
+
+
+def write_parquet(output_df, dataset_dir, batch_id):
+    """
+    Writes the batch as one Parquet file in a dataset partitioned by batch.
+
+    The file is written under a temporary name and renamed, so readers of the dataset
+    never see a partial file and a rerun of the batch replaces its output.
+
+    Returns:
+        str: Path of the Parquet file
+    """
+    schema = parquet_schema()
+
+    df = output_df.sort_values(["basefile", "page_num"], kind="stable")
+
+    table = pyarrow.Table.from_pandas(
+        df[schema.names], schema=schema, preserve_index=False, safe=True
+    )
+
+    partition_dir = os.path.join(dataset_dir, f"batch_id={batch_id}")
+    os.makedirs(partition_dir, exist_ok=True)
+
+    filepath = os.path.join(partition_dir, PARQUET_PART_FILENAME)
+    tmp_filepath = f"{filepath}.tmp"
+
+    pyarrow.parquet.write_table(
+        table, tmp_filepath, compression=config.PARQUET_COMPRESSION
+    )
+    os.replace(tmp_filepath, filepath)
+    metrics.inc("output_bytes_written", os.path.getsize(filepath))
+
+    logger.info(f"Wrote {table.num_rows:,} rows to {filepath}")
+
+    return filepath
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelines which overlap PDF preprocessing with Tesseract OCR.
+
+In the default "staged" mode the whole batch is preprocessed before Tesseract starts.
+Here each page is put on a bounded queue as soon as it is saved by `preprocess_pdf`.
+Pages are grouped into small chunks and handed to the Tesseract supervisor,
+so poppler/OpenCV and Tesseract share the CPU for most of the batch.
+
+Both queues are bounded, if Tesseract falls behind the preprocessing workers block
+(freeing up CPU for Tesseract) rather than filling the working directory.
+
+With the "capi" Tesseract backend each worker renders, preprocesses and runs OCR
+over a whole PDF in process, see `run_in_process`.
+"""
+import functools
+import logging
+import multiprocessing
+import threading
+
+import ch_ocr_runner as cor
+import ch_ocr_runner.images.page_cache
+import ch_ocr_runner.images.preprocessing
+import ch_ocr_runner.images.tesseract_engine
+import ch_ocr_runner.images.tesseract_supervisor
+import ch_ocr_runner.images.tesseract_wrapper
+import ch_ocr_runner.readahead
+import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.utils.metrics
+import ch_ocr_runner.utils.pools
+import ch_ocr_runner.utils.profiling
+from ch_ocr_runner.images.tesseract_wrapper import Chunk
+from ch_ocr_runner.utils.decorators import log
+from ch_ocr_runner.utils.timing import Timer
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+END_OF_PAGES = None
+
+logger = logging.getLogger(__name__)
+config = cor.utils.configuration.get_config()
+
+
+class StageUsage(object):
+    """Accumulates time spent working in a pipeline stage across a pool of workers"""
+
+    def __init__(self, name, num_workers):
+        self.name = name
+        self.num_workers = num_workers
+        self.busy_seconds = 0.0
+        self.tasks = 0
+
+    def add(self, seconds):
+        self.busy_seconds += seconds
+        self.tasks += 1
+
+    def utilisation(self, wall_seconds):
+        """Fraction of the available worker time spent working"""
+        if wall_seconds <= 0:
+            return 0.0
+        return self.busy_seconds / (wall_seconds * self.num_workers)
+
+    def report(self, wall_seconds):
+        logger.info(
+            f"Stage {self.name}: {self.tasks} tasks, "
+            f"{round(self.busy_seconds, 1)} busy seconds across {self.num_workers} workers, "
+            f"utilisation {self.utilisation(wall_seconds):.0%} over {round(wall_seconds, 1)} seconds"
+        )
+
+
+class TesseractDispatcher(object):
+    """Groups pages into chunks and submits them to the Tesseract supervisor"""
+
+    def __init__(
+        self,
+        supervisor,
+        chunk_dir,
+        tsv_dir,
+        chunk_size,
+        max_pending,
+        cached_pages=None,
+        manifest=None,
+        first_chunk_id=0,
+    ):
+        self.supervisor = supervisor
+        self.chunk_dir = chunk_dir
+        self.tsv_dir = tsv_dir
+        self.chunk_size = chunk_size
+        self.cached_pages = cached_pages
+        self.manifest = manifest
+        self.first_chunk_id = first_chunk_id
+        self.usage = StageUsage("tesseract", NUM_PROCESSES)
+
+        self.chunks = []
+        self._futures = []
+        self._pages = []
+        # Bounds the number of chunks queued up for Tesseract
+        self._free_slots = threading.BoundedSemaphore(max_pending)
+
+    def add_page(self, image_file):
+        self._pages.append(image_file)
+
+        if len(self._pages) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Submit any buffered pages as a chunk"""
+        pages = self._pages
+        self._pages = []
+
+        if self.cached_pages is not None:
+            pages = self.cached_pages.misses(pages)
+
+        if not pages:
+            return
+
+        chunk = Chunk(
+            filepaths=pages,
+            chunk_id=self.first_chunk_id + len(self.chunks),
+            chunk_dir=self.chunk_dir,
+        )
+
+        self._free_slots.acquire()
+
+        future = self.supervisor.submit(chunk, self.tsv_dir)
+        future.add_done_callback(self._chunk_finished)
+
+        self.chunks.append(chunk)
+        self._futures.append(future)
+
+    def wait(self):
+        """Wait for all submitted chunks to finish, log the Tesseract output"""
+        for future in self._futures:
+            result = future.result()
+            self.usage.add(result.seconds)
+            cor.images.tesseract_wrapper.record_chunk_metrics(
+                result.chunk, result.seconds
+            )
+
+            logger.debug(f"Output from {result}: {result.stdout.decode('utf-8')}")
+
+        if self.cached_pages is not None:
+            self.cached_pages.store(self.chunks)
+            self.cached_pages.log_stats()
+
+            cached_chunk = self.cached_pages.chunk()
+            if cached_chunk is not None:
+                self.chunks.append(cached_chunk)
+
+    def _chunk_finished(self, future):
+        self._free_slots.release()
+
+        if (
+            self.manifest is not None
+            and not future.cancelled()
+            and not future.exception()
+            and future.result().succeeded
+        ):
+            self.manifest.mark_ocr_done(future.result().chunk)
+
+
+@log()
+def run_streaming(batch, working_dir):
+    """
+    Preprocess PDFs and run Tesseract over the pages concurrently.
+
+    Produces the same final output as running `preprocess_pdfs_for_ocr` followed by `run_ocr`.
+
+    Args:
+        batch (ch_ocr_runner.work.WorkBatch): Batch of PDFs to process
+        working_dir (ch_ocr_runner.main.WorkingDir): Working directory for the batch
+    """
+    cor.images.tesseract_wrapper._omp_check()
+
+    manifest = working_dir.manifest
+
+    logger.info("Starting preprocessing workers and Tesseract supervisor")
+    with cor.utils.pools.worker_pool() as preprocess_pool:
+        with multiprocessing.Manager() as manager:
+            work = cor.images.preprocessing.plan_tasks(batch, map_f=preprocess_pool.map)
+            rendered = {}
+            done_chunks = []
+            if manifest is not None:
+                rendered = manifest.rendered()
+                done_chunks = cor.images.tesseract_wrapper._done_chunks(
+                    manifest, chunk_dir=working_dir.chunk_dir
+                )
+                work = [task for task in work if task.key not in rendered]
+                logger.info(
+                    f"{len(rendered)} tasks already preprocessed, {len(work)} to go"
+                )
+
+            page_queue = manager.Queue(maxsize=config.STREAMING_QUEUE_SIZE)
+
+            preprocess_f = cor.images.preprocessing.preprocess_function(
+                working_dir, page_queue=page_queue
+            )
+            preprocess_usage = StageUsage("preprocess", NUM_PROCESSES)
+
+            cache = cor.images.page_cache.get_page_cache()
+            cached_pages = None
+            if cache is not None:
+                cached_pages = cor.images.tesseract_wrapper.CachedPages(
+                    cache, chunk_dir=working_dir.chunk_dir, tsv_dir=working_dir.tsv_dir
+                )
+
+            reader = cor.readahead.for_batch(
+                batch, [task.pdf_filepath for task in work]
+            )
+
+            def task_rendered(result):
+                _, (task, preprocessed) = result
+                reader.done(task.pdf_filepath)
+                cor.images.preprocessing.record_metrics(task, preprocessed)
+
+                if manifest is not None:
+                    manifest.mark_rendered(task.key, preprocessed.image_files)
+
+            supervisor = cor.images.tesseract_supervisor.TesseractSupervisor()
+            with supervisor, reader, Timer() as timer:
+                dispatcher = TesseractDispatcher(
+                    supervisor,
+                    chunk_dir=working_dir.chunk_dir,
+                    tsv_dir=working_dir.tsv_dir,
+                    chunk_size=config.TESSERACT_PAGES_PER_CHUNK,
+                    max_pending=2 * NUM_PROCESSES,
+                    cached_pages=cached_pages,
+                    manifest=manifest,
+                    first_chunk_id=cor.images.tesseract_wrapper._next_chunk_id(
+                        done_chunks
+                    ),
+                )
+
+                # Pages rendered in a previous run which Tesseract hasn't finished
+                done_files = {f for chunk in done_chunks for f in chunk.filepaths}
+                for image_files in rendered.values():
+                    for image_file in image_files:
+                        if image_file not in done_files:
+                            dispatcher.add_page(image_file)
+
+                results = [
+                    preprocess_pool.apply_async(
+                        _timed_call, (preprocess_f, task), callback=task_rendered
+                    )
+                    for task in work
+                ]
+
+                # All pages are on the queue once every task is done, so the marker is last
+                threading.Thread(
+                    target=_end_queue_when_ready,
+                    args=(results, page_queue),
+                    daemon=True,
+                ).start()
+
+                for image_file in iter(page_queue.get, END_OF_PAGES):
+                    dispatcher.add_page(image_file)
+
+                dispatcher.flush()
+
+                for result in results:
+                    seconds, _ = result.get()
+                    preprocess_usage.add(seconds)
+
+                dispatcher.wait()
+
+    preprocess_usage.report(timer.elapsed)
+    dispatcher.usage.report(timer.elapsed)
+
+    blank_chunk = cor.images.tesseract_wrapper.create_blank_chunk(
+        working_dir.image_processed_dir,
+        chunk_dir=working_dir.chunk_dir,
+        tsv_dir=working_dir.tsv_dir,
+    )
+    if blank_chunk is not None:
+        dispatcher.chunks.append(blank_chunk)
+
+    cor.images.tesseract_wrapper._create_final_output(
+        done_chunks + dispatcher.chunks,
+        tsv_dir=working_dir.tsv_dir,
+        output_dir=working_dir.output_dir,
+        manifest=manifest,
+        batch_id=working_dir.batch_id,
+    )
+
+
+@log()
+def run_in_process(batch, working_dir):
+    """
+    Renders, preprocesses and runs OCR over each PDF in a single worker process.
+
+    Uses the in-process Tesseract engine, so each worker loads the language model once
+    and preprocessed pages are never written to disk.
+
+    Args:
+        batch (ch_ocr_runner.work.WorkBatch): Batch of PDFs to process
+        working_dir (ch_ocr_runner.main.WorkingDir): Working directory for the batch
+    """
+    cor.images.tesseract_wrapper._omp_check()
+
+    manifest = working_dir.manifest
+
+    # Each PDF is a chunk, numbered by its position in the batch
+    work = list(enumerate(batch.filepaths()))
+    done_chunks = []
+    if manifest is not None:
+        done_chunks = cor.images.tesseract_wrapper._done_chunks(
+            manifest, chunk_dir=working_dir.chunk_dir
+        )
+        done_ids = {chunk.chunk_id for chunk in done_chunks}
+        work = [(chunk_id, pdf) for chunk_id, pdf in work if chunk_id not in done_ids]
+        logger.info(f"{len(done_chunks)} PDFs already processed, {len(work)} to go")
+
+    ocr_f = cor.utils.profiling.profiled(
+        "ocr_pdf",
+        functools.partial(
+            cor.images.tesseract_engine.ocr_pdf,
+            working_dir.image_raw_dir,
+            working_dir.image_processed_dir,
+            working_dir.chunk_dir,
+            working_dir.tsv_dir,
+        ),
+    )
+
+    reader = cor.readahead.for_batch(batch, [pdf for _, pdf in work])
+
+    def pdf_finished(pdf_filepath, result):
+        reader.done(pdf_filepath)
+        if manifest is not None:
+            chunk, _, _ = result
+            manifest.mark_ocr_done(chunk)
+
+    with cor.utils.pools.worker_pool() as pool, reader:
+        async_results = [
+            pool.apply_async(
+                ocr_f,
+                (chunk_id, pdf),
+                callback=functools.partial(pdf_finished, pdf),
+            )
+            for chunk_id, pdf in work
+        ]
+        results = [result.get() for result in async_results]
+
+    chunks = done_chunks + [chunk for chunk, _, _ in results]
+    cor.utils.metrics.inc("ocr_pages", sum(misses for _, _, misses in results))
+
+    hits = sum(cache_hits for _, cache_hits, _ in results)
+    misses = sum(cache_misses for _, _, cache_misses in results)
+    if cor.images.page_cache.get_page_cache() is not None:
+        logger.info(f"Page cache: {hits:,} hits, {misses:,} misses")
+
+    if config.SKIP_BLANK_PAGES:
+        blank = sum(len(chunk.filepaths) for chunk, _, _ in results) - hits - misses
+        cor.utils.metrics.inc("pages_blank", blank)
+        logger.info(f"{blank:,} blank pages not sent to Tesseract")
+
+    cor.images.tesseract_wrapper._create_final_output(
+        chunks,
+        tsv_dir=working_dir.tsv_dir,
+        output_dir=working_dir.output_dir,
+        manifest=manifest,
+        batch_id=working_dir.batch_id,
+    )
+
+
+def _timed_call(f, *args):
+    """Call `f` in a worker process, returning the time taken along with the result"""
+    with Timer() as timer:
+        result = f(*args)
+
+    return timer.elapsed, result
+
+
+def _end_queue_when_ready(async_results, page_queue):
+    for async_result in async_results:
+        async_result.wait()
+
+    page_queue.put(END_OF_PAGES)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Local read-ahead copies of the PDFs of a batch, so renderers don't wait on the shared store.
+
+With `config.PDF_READAHEAD_DIR` set (a local disk or RAM-backed directory), the next
+`config.PDF_READAHEAD_FILES` PDFs to be preprocessed are copied there from `PDF_DIR`, in the
+order the tasks are handed to the workers. Copies are made by
+`config.PDF_READAHEAD_THREADS` threads, together limited to
+`config.PDF_READAHEAD_MAX_BYTES_PER_SECOND` (None for no limit).
+
+A renderer uses the local copy of a PDF if it is ready (see `local_copy`), otherwise it
+reads the shared file as before, so a slow copy never holds up a worker. A copy is
+deleted once every task of its PDF has been preprocessed, making room for the next.
+
+If the allocation `files` column gives a checksum for a PDF and it's an MD5, SHA-1 or
+SHA-256 hex digest, the copy is checked against it as it is made. A copy which doesn't
+match is discarded (the PDF is read from the shared store) and counted in the
+`readahead_checksum_mismatches` metric. Other values (e.g. "test") aren't checked.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import string
+import threading
+import time
+
+import ch_ocr_runner.utils.configuration as configuration
+import ch_ocr_runner.utils.metrics as metrics
+
+PART_SUFFIX = ".part"
+COPY_BLOCK_BYTES = 1024 * 1024
+
+# Hash algorithm by length of the hex digest
+DIGEST_ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256"}
+
+# States of a PDF in the read-ahead
+QUEUED = "queued"
+COPYING = "copying"
+READY = "ready"
+DONE = "done"
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+
+def is_enabled():
+    return bool(config.PDF_READAHEAD_DIR)
+
+
+def local_path(pdf_filepath):
+    """Where the local copy of a PDF goes, keeping its filename"""
+    key = hashlib.sha1(pdf_filepath.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(config.PDF_READAHEAD_DIR, key, os.path.basename(pdf_filepath))
+
+
+def local_copy(pdf_filepath):
+    """The local copy of a PDF if it is ready, otherwise the PDF itself"""
+    if not is_enabled():
+        return pdf_filepath
+
+    filepath = local_path(pdf_filepath)
+    return filepath if os.path.exists(filepath) else pdf_filepath
+
+
+def digest_algorithm(checksum):
+    """Hash algorithm for a hex digest checksum, None if the checksum isn't one"""
+    if not isinstance(checksum, str):
+        return None
+
+    checksum = checksum.strip().lower()
+    if not checksum or any(c not in string.hexdigits for c in checksum):
+        return None
+
+    return DIGEST_ALGORITHMS.get(len(checksum))
+
+
+def for_batch(batch, pdf_filepaths):
+    """
+    Read-ahead of the PDFs of a batch's tasks, one which does nothing if it's disabled.
+
+    Args:
+        batch (ch_ocr_runner.work.WorkBatch): Batch the tasks are from, for checksums
+        pdf_filepaths: PDF of each task, in the order the tasks are handed to the workers
+    """
+    if not is_enabled():
+        return NoReadAhead()
+
+    return ReadAhead(pdf_filepaths, batch.checksums())
+
+
+class NoReadAhead(object):
+    """Stands in for `ReadAhead` when it's disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def done(self, pdf_filepath):
+        pass
+
+    def __repr__(self):
+        return "NoReadAhead()"
+
+
+class RateLimiter(object):
+    """Limits the bytes per second shared between threads (a token bucket of one second)"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._available = 0.0
+        self._updated = time.monotonic()
+
+    def take(self, num_bytes):
+        """Waits until `num_bytes` may be transferred"""
+        if not self.bytes_per_second:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.bytes_per_second,
+                self._available + (now - self._updated) * self.bytes_per_second,
+            )
+            self._updated = now
+
+            # Goes into debt, later callers wait for it to be paid off
+            self._available -= num_bytes
+            wait = -self._available / self.bytes_per_second
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def __repr__(self):
+        return f"RateLimiter(bytes_per_second={self.bytes_per_second})"
+
+
+class ReadAhead(object):
+    """
+    Copies the PDFs of a batch's tasks to local scratch ahead of the workers.
+
+    Use as a context manager around handing the tasks to the workers, and call `done`
+    with each finished task.
+    """
+
+    def __init__(self, pdf_filepaths, checksums=None, window=None, threads=None):
+        """
+        Args:
+            pdf_filepaths: PDF of each task, in the order the tasks are handed out
+                (a PDF split into several tasks appears once per task)
+            checksums: {PDF filepath: checksum from the allocation file}
+            window: PDFs copied ahead, `config.PDF_READAHEAD_FILES` if None
+            threads: Copies made at once, `config.PDF_READAHEAD_THREADS` if None
+        """
+        self.checksums = checksums or {}
+        self.window = window or config.PDF_READAHEAD_FILES
+        self.threads = threads or config.PDF_READAHEAD_THREADS
+        self.limiter = RateLimiter(config.PDF_READAHEAD_MAX_BYTES_PER_SECOND)
+
+        self._remaining = collections.Counter(pdf_filepaths)
+        self._order = list(dict.fromkeys(pdf_filepaths))
+        self._state = {pdf: QUEUED for pdf in self._order}
+        self._next = 0
+        # PDFs copying or copied and not yet deleted
+        self._held = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = None
+
+        self.copied = 0
+        self.mismatches = 0
+
+    def __enter__(self):
+        os.makedirs(config.PDF_READAHEAD_DIR, exist_ok=True)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="readahead"
+        )
+
+        with self._lock:
+            self._fill()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+        for pdf, state in self._state.items():
+            if state == READY:
+                _remove_copy(pdf)
+
+        logger.info(
+            f"Read ahead {self.copied:,} of {len(self._order):,} PDFs, "
+            f"{self.mismatches:,} checksum mismatches"
+        )
+
+    def done(self, pdf_filepath):
+        """Records a finished task of a PDF, its copy is deleted after its last task"""
+        with self._lock:
+            self._remaining[pdf_filepath] -= 1
+            if self._remaining[pdf_filepath] > 0:
+                return
+
+            state = self._state.get(pdf_filepath)
+            self._state[pdf_filepath] = DONE
+
+            if state == READY:
+                _remove_copy(pdf_filepath)
+                self._held -= 1
+                self._fill()
+
+            # A copy in progress is deleted when it finishes
+
+    def _fill(self):
+        """Starts copying the next PDFs up to the window, called holding the lock"""
+        while (
+            not self._closed
+            and self._held < self.window
+            and self._next < len(self._order)
+        ):
+            pdf = self._order[self._next]
+            self._next += 1
+
+            # Already preprocessed from the shared store
+            if self._state[pdf] == DONE:
+                continue
+
+            self._state[pdf] = COPYING
+            self._held += 1
+            self._executor.submit(self._copy, pdf)
+
+    def _copy(self, pdf_filepath):
+        try:
+            copied = self._copy_file(pdf_filepath)
+        except Exception as e:
+            logger.warning(f"Unable to read ahead {pdf_filepath}: {e}")
+            _remove_copy(pdf_filepath)
+            copied = False
+
+        with self._lock:
+            if copied:
+                self.copied += 1
+
+            if copied and self._state[pdf_filepath] == COPYING:
+                self._state[pdf_filepath] = READY
+                return
+
+            # Finished with (or failed), free its place for the next PDF
+            if copied:
+                _remove_copy(pdf_filepath)
+            self._held -= 1
+            self._fill()
+
+    def _copy_file(self, pdf_filepath):
+        """Copies a PDF to its local path, returns False if it wasn't copied"""
+        checksum = self.checksums.get(pdf_filepath)
+        algorithm = digest_algorithm(checksum)
+        hasher = hashlib.new(algorithm) if algorithm else None
+
+        filepath = local_path(pdf_filepath)
+        part_filepath = f"{filepath}{PART_SUFFIX}"
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        with open(pdf_filepath, "rb") as src, open(part_filepath, "wb") as dst:
+            while True:
+                if self._closed:
+                    break
+
+                block = src.read(COPY_BLOCK_BYTES)
+                if not block:
+                    break
+
+                self.limiter.take(len(block))
+                dst.write(block)
+                metrics.inc("readahead_bytes_copied", len(block))
+                if hasher is not None:
+                    hasher.update(block)
+
+        if self._closed:
+            _remove_dir(filepath)
+            return False
+
+        if hasher is not None and hasher.hexdigest() != checksum.strip().lower():
+            logger.warning(
+                f"{pdf_filepath} doesn't match its checksum {checksum}, "
+                "reading it from the shared store"
+            )
+            with self._lock:
+                self.mismatches += 1
+            metrics.inc("readahead_checksum_mismatches")
+            _remove_dir(filepath)
+            return False
+
+        # Renderers only ever see a complete copy
+        os.replace(part_filepath, filepath)
+        return True
+
+    def __repr__(self):
+        return f"ReadAhead(pdfs={len(self._order)}, window={self.window})"
+
+
+def _remove_copy(pdf_filepath):
+    _remove_dir(local_path(pdf_filepath))
+
+
+def _remove_dir(filepath):
+    shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
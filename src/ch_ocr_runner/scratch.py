@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+RAM-backed scratch space for the intermediate files of a batch.
+
+With `config.SCRATCH_DIR` set (e.g. a directory under /dev/shm), the transient
+directories of a batch are placed under:
+
+    {SCRATCH_DIR}/batch_{batch_id}/
+
+up to a budget of `config.SCRATCH_MAX_BYTES` (and the free space there). Their size is
+estimated from the pages in the batch before it starts. The budget is shared by the
+batches in progress in the process (a batch preprocessed ahead, see
+`preprocessing.RenderAhead`, runs next to the current one), each reserves its estimate
+until its scratch directory is removed. Directories are placed in the
+order of `TRANSIENT_DIRS`, the most read and written for their size first; one which
+would take the scratch space over budget spills to the batch directory under
+`config.WORKING_DIR`, as without a scratch tier.
+
+The batch directory itself (manifest, metrics, profiles and `output`) is always under
+`WORKING_DIR`. The placement is recorded in the batch directory so a resumed batch finds
+its files. If the scratch files were lost (e.g. the machine restarted) the resumed batch
+only keeps the outputs already written and redoes the rest.
+
+The scratch directory of a batch is removed once the batch is finished.
+"""
+import json
+import logging
+import os
+import shutil
+
+import ch_ocr_runner.utils.configuration as configuration
+
+PLACEMENT_FILENAME = "scratch.json"
+
+# Transient directories, relative to the batch directory, in order of placement
+TRANSIENT_DIRS = {
+    "processed": os.path.join("images", "processed"),
+    "chunks": "chunks",
+    "tsv": "tsv",
+    "raw": os.path.join("images", "raw"),
+}
+
+# Bytes per page at 300 DPI, used when a PDF has no page count
+PAGE_BYTES_8BIT = 8_700_000
+PAGE_BYTES_BILEVEL = 1_100_000
+PAGE_BYTES_GROUP4 = 150_000
+PAGE_BYTES_RGB = 26_000_000
+PAGE_BYTES_TSV = 20_000
+PAGE_BYTES_CHUNK_LIST = 200
+UNKNOWN_PDF_PAGES = 20
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+# Estimated bytes placed in scratch by the batches in progress, {scratch dir: bytes}
+_reserved = {}
+
+
+def batch_scratch_dir(batch_id):
+    return os.path.join(config.SCRATCH_DIR, f"batch_{batch_id:02}")
+
+
+def batch_pages(batch):
+    """Pages in a batch, counting `UNKNOWN_PDF_PAGES` for PDFs without a page count"""
+    return sum(pages or UNKNOWN_PDF_PAGES for _, pages in batch.page_counts())
+
+
+def estimate_bytes(pages):
+    """
+    Estimated size of each transient directory for a number of pages.
+
+    Returns:
+        dict: {transient directory: bytes}, in the order of `TRANSIENT_DIRS`
+    """
+    scale = (config.OCR_DPI / 300) ** 2
+
+    if not config.PROCESSED_IMAGE_BILEVEL:
+        processed = PAGE_BYTES_8BIT
+    elif config.PROCESSED_IMAGE_COMPRESSION:
+        processed = PAGE_BYTES_GROUP4
+    else:
+        processed = PAGE_BYTES_BILEVEL
+
+    # Raw images, rendered or embedded, are only kept with SAVE_RAW_IMAGES. Otherwise
+    # embedded images are only extracted to the raw directory until they're loaded.
+    has_raw = config.SAVE_RAW_IMAGES
+
+    page_bytes = {
+        "processed": processed * scale,
+        "chunks": PAGE_BYTES_CHUNK_LIST,
+        "tsv": PAGE_BYTES_TSV,
+        "raw": PAGE_BYTES_RGB * scale if has_raw else 0,
+    }
+
+    return {name: int(page_bytes[name] * pages) for name in TRANSIENT_DIRS}
+
+
+def plan(pages, scratch_root, scratch_dir):
+    """
+    Chooses which transient directories of a batch go in the scratch space.
+
+    What is placed is reserved against the budget until `remove(scratch_dir)`.
+
+    Args:
+        pages: Pages in the batch
+        scratch_root: `config.SCRATCH_DIR`
+        scratch_dir: Scratch directory of the batch
+
+    Returns:
+        list[str]: Names from `TRANSIENT_DIRS` to place in scratch
+    """
+    os.makedirs(scratch_root, exist_ok=True)
+    # Files other batches have already written are also missing from the free space,
+    # which errs towards spilling to disk
+    reserved = sum(size for path, size in _reserved.items() if path != scratch_dir)
+    budget = min(config.SCRATCH_MAX_BYTES, shutil.disk_usage(scratch_root).free)
+    budget -= reserved
+
+    placed = []
+    used = 0
+    for name, size in estimate_bytes(pages).items():
+        if used + size > budget:
+            logger.info(
+                f"{name} ({size:,} bytes estimated) would exceed the scratch budget "
+                f"({budget - used:,} bytes left), spilling to disk"
+            )
+            continue
+
+        placed.append(name)
+        used += size
+
+    reserve(scratch_dir, pages, placed)
+
+    return placed
+
+
+def reserve(scratch_dir, pages, placed):
+    """Reserves the estimated size of a batch's directories in scratch, see `plan`"""
+    estimates = estimate_bytes(pages)
+    _reserved[scratch_dir] = sum(estimates[name] for name in placed)
+
+
+def save_placement(batch_dir, scratch_dir, placed):
+    with open(os.path.join(batch_dir, PLACEMENT_FILENAME), "w", encoding="utf-8") as f:
+        json.dump({"scratch_dir": scratch_dir, "dirs": placed}, f)
+
+
+def load_placement(batch_dir):
+    """
+    Placement recorded for a batch.
+
+    Returns:
+        tuple: (scratch directory, [names placed there]), (None, []) if nothing recorded
+    """
+    filepath = os.path.join(batch_dir, PLACEMENT_FILENAME)
+    if not os.path.exists(filepath):
+        return None, []
+
+    with open(filepath, encoding="utf-8") as f:
+        placement = json.load(f)
+
+    return placement["scratch_dir"], placement["dirs"]
+
+
+def remove(scratch_dir):
+    """Removes the scratch directory of a batch, releasing its reservation"""
+    # check path is something we should be deleting
+    assert os.path.basename(scratch_dir).startswith("batch_")
+
+    _reserved.pop(scratch_dir, None)
+
+    if os.path.exists(scratch_dir):
+        logger.info(f"Removing scratch directory {scratch_dir}")
+        shutil.rmtree(scratch_dir)
@@ -111,18 +111,148 @@ class Config(metaclass=Singleton):
         self.PDF_DIR = os.path.join(self.DATA_DIR, "pdfs")
         self.WORKING_DIR = os.path.join(self.DATA_DIR, "working")
 
+        # RAM-backed directory (e.g. "/dev/shm/ch_ocr") for the intermediate files of
+        # a batch, up to SCRATCH_MAX_BYTES, the rest spill to WORKING_DIR. None for off.
+        # The budget is shared with the batch preprocessed ahead (RENDER_AHEAD)
+        self.SCRATCH_DIR = None
+        self.SCRATCH_MAX_BYTES = 4 * 1024**3
+        # Local directory the next PDFs to preprocess are copied to ahead of the
+        # workers, None to read them from PDF_DIR
+        self.PDF_READAHEAD_DIR = None
+        # Number of PDFs copied ahead at once, and the threads copying them
+        self.PDF_READAHEAD_FILES = 16
+        self.PDF_READAHEAD_THREADS = 4
+        # Limit on reading from PDF_DIR for the read-ahead, None for no limit
+        self.PDF_READAHEAD_MAX_BYTES_PER_SECOND = None
+
         self.WORK_BATCH_ALLOCATION_FILEPATH = os.path.join(
             self.DATA_DIR, "pdf_batch_allocation.csv"
         )
+        # Indexed copy of the allocation file, see `ch_ocr_runner.allocation_store`
+        self.WORK_BATCH_ALLOCATION_STORE_FILEPATH = os.path.join(
+            self.DATA_DIR, "pdf_batch_allocation.sqlite"
+        )
 
         self.MACHINE_ENV_VAR = "CH_OCR_MACHINE_ID"
 
+        # "static" only processes batches allocated to this machine, "dynamic" leases
+        # batches through WORKING_DIR and takes over other machines' unfinished batches
+        self.ALLOCATION_MODE = "static"
+        self.LEASE_HEARTBEAT_SECONDS = 60
+        self.LEASE_EXPIRY_SECONDS = 15 * 60
+
+        # Check PDFs exist from directory listings, saved between runs (keep on local disk).
+        # A saved listing is reused while its directory's modification time is unchanged,
+        # and a listing is not rechecked during a run, so a PDF added mid run (or hidden
+        # by a network file system caching directory times) is reported missing.
+        # Off by default, when off each PDF is checked with its own stat
+        self.FILE_INDEX_ENABLED = False
+        self.FILE_INDEX_FILEPATH = os.path.join(
+            os.path.expanduser("~"), "cache", "ch_ocr_runner_file_index.json"
+        )
+        self.FILE_INDEX_THREADS = 16
+
         self.OCR_DPI = 300
         self.IMAGE_FORMAT = "tiff"
         self.IMAGE_SUFFIX = ".tif"
 
         self.PREPROCESS_REPORT_FREQUENCY = 50
 
+        # PDFs with more pages than this are split into tasks of this many pages
+        # so they are preprocessed by several workers (0 to turn off)
+        self.SPLIT_PDF_PAGES = 64
+
+        # Pages of a PDF rendered at once, bounds the memory used by each worker
+        self.RENDER_PAGE_WINDOW = 8
+
+        # Keep the pages rendered by poppler (and embedded images, see
+        # EXTRACT_EMBEDDED_IMAGES) as files in images/raw. Otherwise they are
+        # passed from poppler in memory, which avoids writing and reading back a large
+        # uncompressed image per page but holds a whole window of pages in memory
+        self.SAVE_RAW_IMAGES = True
+
+        # Preprocessed pages are black and white, save them 1-bit with this TIFF
+        # compression ("group4", "packbits", "tiff_lzw" or None for uncompressed).
+        # False saves them 8-bit grayscale
+        self.PROCESSED_IMAGE_BILEVEL = True
+        self.PROCESSED_IMAGE_COMPRESSION = "group4"
+
+        # Use the embedded bitmap of scanned pages at its native resolution
+        # instead of rasterising the page at OCR_DPI (needs poppler's pdfimages)
+        self.EXTRACT_EMBEDDED_IMAGES = False
+        self.EMBEDDED_IMAGE_MIN_PPI = 200
+
+        # Don't send blank or near-empty pages to Tesseract, they get a single page row
+        # in the output. Blank means at most BLANK_PAGE_MAX_INK of the pixels are ink and
+        # at most BLANK_PAGE_MAX_COMPONENTS blobs of ink of BLANK_PAGE_MIN_COMPONENT_AREA
+        # pixels or more: a page number ("12", "- 3 -") or a stamp on its own, but not a
+        # short line such as "Page 2" or a company number, see `images.blank_pages`
+        self.SKIP_BLANK_PAGES = False
+        self.BLANK_PAGE_MAX_INK = 0.001
+        self.BLANK_PAGE_MAX_COMPONENTS = 3
+        self.BLANK_PAGE_MIN_COMPONENT_AREA = 30
+
+        # Keep the working directory of an interrupted batch and only redo missing work
+        self.RESUME_BATCHES = False
+
+        # "staged" preprocesses the whole batch before starting Tesseract,
+        # "streaming" queues each page for OCR as soon as it has been preprocessed
+        self.PIPELINE_MODE = "staged"
+        self.STREAMING_QUEUE_SIZE = 256
+
+        # Tesseract workers pull chunks of this many pages from a shared queue
+        self.TESSERACT_PAGES_PER_CHUNK = 8
+
+        # Workers are kept for the whole run and replaced after this many tasks
+        # (None to keep them). With RENDER_AHEAD the staged pipeline starts
+        # preprocessing the next batch while the current one is in OCR
+        self.WORKER_MAX_TASKS = None
+        self.RENDER_AHEAD = False
+
+        # A tesseract process is killed after this many seconds per page of its chunk
+        # (None for no limit) and the chunk retried up to TESSERACT_RETRIES times,
+        # which also applies to a chunk where tesseract fails
+        self.TESSERACT_PAGE_TIMEOUT_SECONDS = 300
+        self.TESSERACT_RETRIES = 1
+
+        # "cli" runs the tesseract command, "capi" keeps a Tesseract instance
+        # in each worker through libtesseract (falls back to "cli" if unavailable)
+        self.TESSERACT_BACKEND = "cli"
+        self.TESSERACT_LIBRARY_PATH = None
+
+        # Tesseract language(s) (e.g. "eng+fra"), OCR engine mode (0-3) and page
+        # segmentation mode (0-13), None for Tesseract's default. TESSDATA_DIR holds the
+        # traineddata (e.g. tessdata_fast), None for the tessdata installed with Tesseract.
+        # Compare settings with `python -m ch_ocr_runner.images.tesseract_tuning`
+        self.TESSERACT_LANG = "eng"
+        self.TESSERACT_OEM = None
+        self.TESSERACT_PSM = None
+        self.TESSDATA_DIR = None
+
+        # "csv" writes a CSV per PDF to the batch output directory, "parquet" writes
+        # each batch to a dataset partitioned by batch (needs the arrow extra)
+        self.OUTPUT_FORMAT = "csv"
+        self.PARQUET_DATASET_DIR = os.path.join(self.DATA_DIR, "ocr_output")
+        self.PARQUET_COMPRESSION = "zstd"
+
+        # Parser for Tesseract TSV files, "c" or "pyarrow" (needs the arrow extra)
+        self.TSV_READER = "c"
+
+        # Cache of Tesseract output keyed by page pixels, keep it on local disk
+        self.OCR_CACHE_ENABLED = False
+        self.OCR_CACHE_FILEPATH = os.path.join(
+            os.path.expanduser("~"), "cache", "ch_ocr_runner_page_cache.sqlite"
+        )
+        self.OCR_CACHE_MAX_BYTES = 2 * 1000 * 1000 * 1000
+
+        # Also write metrics totals for the run here in Prometheus text format, e.g. in
+        # node_exporter's --collector.textfile.directory (metrics.jsonl is always written)
+        self.METRICS_PROMETHEUS_TEXTFILE = None
+
+        # Profile the pool workers with cProfile (also turned on by the environment
+        # variable CH_OCR_PROFILE_WORKERS=1), reports go in the batch's profiles directory
+        self.PROFILE_WORKERS = False
+
         for key, value in Config.config_provider.fetch_config():
 
             if key in self.__dict__ and not _is_under(key):
@@ -136,14 +266,69 @@ class Config(metaclass=Singleton):
         logger.info(f"DATA_DIR: {self.DATA_DIR}")
         logger.info(f"PDF_DIR: {self.PDF_DIR}")
         logger.info(f"WORKING_DIR: {self.WORKING_DIR}")
+        logger.info(f"SCRATCH_DIR: {self.SCRATCH_DIR}")
+        logger.info(f"SCRATCH_MAX_BYTES: {self.SCRATCH_MAX_BYTES}")
+        logger.info(f"PDF_READAHEAD_DIR: {self.PDF_READAHEAD_DIR}")
+        logger.info(f"PDF_READAHEAD_FILES: {self.PDF_READAHEAD_FILES}")
+        logger.info(f"PDF_READAHEAD_THREADS: {self.PDF_READAHEAD_THREADS}")
+        logger.info(
+            f"PDF_READAHEAD_MAX_BYTES_PER_SECOND: {self.PDF_READAHEAD_MAX_BYTES_PER_SECOND}"
+        )
         logger.info(
             f"WORK_BATCH_ALLOCATION_FILEPATH: {self.WORK_BATCH_ALLOCATION_FILEPATH}"
         )
+        logger.info(
+            f"WORK_BATCH_ALLOCATION_STORE_FILEPATH: {self.WORK_BATCH_ALLOCATION_STORE_FILEPATH}"
+        )
         logger.info(f"MACHINE_ENV_VAR: {self.MACHINE_ENV_VAR}")
+        logger.info(f"ALLOCATION_MODE: {self.ALLOCATION_MODE}")
+        logger.info(f"LEASE_HEARTBEAT_SECONDS: {self.LEASE_HEARTBEAT_SECONDS}")
+        logger.info(f"LEASE_EXPIRY_SECONDS: {self.LEASE_EXPIRY_SECONDS}")
+        logger.info(f"FILE_INDEX_ENABLED: {self.FILE_INDEX_ENABLED}")
+        logger.info(f"FILE_INDEX_FILEPATH: {self.FILE_INDEX_FILEPATH}")
+        logger.info(f"FILE_INDEX_THREADS: {self.FILE_INDEX_THREADS}")
         logger.info(f"OCR_DPI: {self.OCR_DPI}")
         logger.info(f"IMAGE_FORMAT: {self.IMAGE_FORMAT}")
         logger.info(f"IMAGE_SUFFIX: {self.IMAGE_SUFFIX}")
         logger.info(f"PREPROCESS_REPORT_FREQUENCY: {self.PREPROCESS_REPORT_FREQUENCY}")
+        logger.info(f"SPLIT_PDF_PAGES: {self.SPLIT_PDF_PAGES}")
+        logger.info(f"RENDER_PAGE_WINDOW: {self.RENDER_PAGE_WINDOW}")
+        logger.info(f"SAVE_RAW_IMAGES: {self.SAVE_RAW_IMAGES}")
+        logger.info(f"PROCESSED_IMAGE_BILEVEL: {self.PROCESSED_IMAGE_BILEVEL}")
+        logger.info(f"PROCESSED_IMAGE_COMPRESSION: {self.PROCESSED_IMAGE_COMPRESSION}")
+        logger.info(f"EXTRACT_EMBEDDED_IMAGES: {self.EXTRACT_EMBEDDED_IMAGES}")
+        logger.info(f"EMBEDDED_IMAGE_MIN_PPI: {self.EMBEDDED_IMAGE_MIN_PPI}")
+        logger.info(f"SKIP_BLANK_PAGES: {self.SKIP_BLANK_PAGES}")
+        logger.info(f"BLANK_PAGE_MAX_INK: {self.BLANK_PAGE_MAX_INK}")
+        logger.info(f"BLANK_PAGE_MAX_COMPONENTS: {self.BLANK_PAGE_MAX_COMPONENTS}")
+        logger.info(
+            f"BLANK_PAGE_MIN_COMPONENT_AREA: {self.BLANK_PAGE_MIN_COMPONENT_AREA}"
+        )
+        logger.info(f"RESUME_BATCHES: {self.RESUME_BATCHES}")
+        logger.info(f"PIPELINE_MODE: {self.PIPELINE_MODE}")
+        logger.info(f"STREAMING_QUEUE_SIZE: {self.STREAMING_QUEUE_SIZE}")
+        logger.info(f"TESSERACT_PAGES_PER_CHUNK: {self.TESSERACT_PAGES_PER_CHUNK}")
+        logger.info(f"WORKER_MAX_TASKS: {self.WORKER_MAX_TASKS}")
+        logger.info(f"RENDER_AHEAD: {self.RENDER_AHEAD}")
+        logger.info(
+            f"TESSERACT_PAGE_TIMEOUT_SECONDS: {self.TESSERACT_PAGE_TIMEOUT_SECONDS}"
+        )
+        logger.info(f"TESSERACT_RETRIES: {self.TESSERACT_RETRIES}")
+        logger.info(f"TESSERACT_BACKEND: {self.TESSERACT_BACKEND}")
+        logger.info(f"TESSERACT_LIBRARY_PATH: {self.TESSERACT_LIBRARY_PATH}")
+        logger.info(f"TESSERACT_LANG: {self.TESSERACT_LANG}")
+        logger.info(f"TESSERACT_OEM: {self.TESSERACT_OEM}")
+        logger.info(f"TESSERACT_PSM: {self.TESSERACT_PSM}")
+        logger.info(f"TESSDATA_DIR: {self.TESSDATA_DIR}")
+        logger.info(f"OUTPUT_FORMAT: {self.OUTPUT_FORMAT}")
+        logger.info(f"PARQUET_DATASET_DIR: {self.PARQUET_DATASET_DIR}")
+        logger.info(f"PARQUET_COMPRESSION: {self.PARQUET_COMPRESSION}")
+        logger.info(f"TSV_READER: {self.TSV_READER}")
+        logger.info(f"OCR_CACHE_ENABLED: {self.OCR_CACHE_ENABLED}")
+        logger.info(f"OCR_CACHE_FILEPATH: {self.OCR_CACHE_FILEPATH}")
+        logger.info(f"OCR_CACHE_MAX_BYTES: {self.OCR_CACHE_MAX_BYTES:,}")
+        logger.info(f"METRICS_PROMETHEUS_TEXTFILE: {self.METRICS_PROMETHEUS_TEXTFILE}")
+        logger.info(f"PROFILE_WORKERS: {self.PROFILE_WORKERS}")
 
 
 def get_config():
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms of the work done in each stage, written out per batch.
+
+Metrics are recorded in this process while a batch runs (a `Timer` with a `metric` name
+records a duration) and written when the batch finishes, with the batch's wall time as
+`batch_seconds`:
+
+* a line appended to `metrics.jsonl` in the batch directory, for comparing runs
+* optionally, totals for the run in Prometheus text format at
+  `config.METRICS_PROMETHEUS_TEXTFILE`, for node_exporter's textfile collector
+
+Pool workers have their own copy of the metrics, so work done in a worker returns its
+timings with its result and the parent process records them.
+"""
+import datetime
+import json
+import logging
+import os
+import re
+import socket
+import threading
+
+import ch_ocr_runner.utils.configuration as configuration
+
+METRICS_FILENAME = "metrics.jsonl"
+PROMETHEUS_PREFIX = "ch_ocr_runner_"
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+
+class Histogram(object):
+    """Distribution of observed values, bucketed like a Prometheus histogram"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        # Observations in each bucket (not cumulative), the last is above BUCKETS[-1]
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        bucket = next(
+            (i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS)
+        )
+        self.bucket_counts[bucket] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+        self.bucket_counts = [
+            a + b for a, b in zip(self.bucket_counts, other.bucket_counts)
+        ]
+
+    def cumulative_buckets(self):
+        """(upper bound, observations <= bound) for each bucket, ending with +Inf"""
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.bucket_counts):
+            cumulative += count
+            yield bound, cumulative
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+            "buckets": {
+                _format_bound(bound): count
+                for bound, count in self.cumulative_buckets()
+            },
+        }
+
+    def __repr__(self):
+        return f"Histogram(count={self.count}, sum={self.sum})"
+
+
+class Metrics(object):
+    """Named counters and histograms, safe to update from several threads"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    def merge(self, other):
+        with self._lock:
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+            for name, histogram in other.histograms.items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def __repr__(self):
+        return (
+            f"Metrics(counters={len(self.counters)}, histograms={len(self.histograms)})"
+        )
+
+
+# Metrics of the batch in progress, and totals for the run
+_batch = Metrics()
+_run = Metrics()
+
+
+def inc(name, value=1):
+    """Adds to a counter of the current batch"""
+    _batch.inc(name, value)
+
+
+def observe(name, value):
+    """Records a value (usually seconds) in a histogram of the current batch"""
+    _batch.observe(name, value)
+
+
+def metric_name(name):
+    """Turns e.g. a function name into a valid metric name"""
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def start_batch():
+    """Clears the metrics of the previous batch"""
+    global _batch
+    _batch = Metrics()
+
+
+def finish_batch(batch_dir, batch_id, seconds):
+    """
+    Writes the metrics of the batch and adds them to the totals for the run.
+
+    Args:
+        batch_dir: Batch working directory, `metrics.jsonl` is appended to there
+        batch_id: Batch the metrics are for
+        seconds: Wall time taken by the batch
+
+    Returns:
+        dict: The record written to `metrics.jsonl`
+    """
+    # Includes pages from the page cache and from before a resume
+    pages = _batch.counters.get("pages_output", 0)
+
+    _batch.observe("batch_seconds", seconds)
+
+    record = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "batch_id": batch_id,
+        "machine": os.getenv(config.MACHINE_ENV_VAR),
+        "host": socket.gethostname(),
+        "seconds": seconds,
+        "pages_per_second": pages / seconds if seconds > 0 else None,
+        **_batch.to_dict(),
+    }
+
+    with open(os.path.join(batch_dir, METRICS_FILENAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+    _run.merge(_batch)
+    _run.inc("batches")
+
+    if config.METRICS_PROMETHEUS_TEXTFILE:
+        write_prometheus_textfile(_run, config.METRICS_PROMETHEUS_TEXTFILE)
+
+    logger.info(
+        f"Batch {batch_id}: {pages:,} pages output in {round(seconds, 1)} seconds "
+        f"({record['pages_per_second'] or 0:.2f} pages/second)"
+    )
+
+    return record
+
+
+def write_prometheus_textfile(metrics, filepath):
+    """
+    Writes metrics in the Prometheus text format.
+
+    Written to a temporary file and renamed, so the collector never reads a partial file.
+    """
+    machine = os.getenv(config.MACHINE_ENV_VAR) or ""
+    labels = f'machine="{_escape_label(machine)}"'
+
+    lines = []
+    for name, value in sorted(metrics.counters.items()):
+        full_name = f"{PROMETHEUS_PREFIX}{metric_name(name)}_total"
+        lines.append(f"# TYPE {full_name} counter")
+        lines.append(f"{full_name}{{{labels}}} {value}")
+
+    for name, histogram in sorted(metrics.histograms.items()):
+        full_name = f"{PROMETHEUS_PREFIX}{metric_name(name)}"
+        lines.append(f"# TYPE {full_name} histogram")
+        for bound, count in histogram.cumulative_buckets():
+            lines.append(
+                f'{full_name}_bucket{{{labels},le="{_format_bound(bound)}"}} {count}'
+            )
+        lines.append(f"{full_name}_sum{{{labels}}} {histogram.sum}")
+        lines.append(f"{full_name}_count{{{labels}}} {histogram.count}")
+
+    textfile_dir = os.path.dirname(filepath)
+    if textfile_dir:
+        os.makedirs(textfile_dir, exist_ok=True)
+
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_filepath, filepath)
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
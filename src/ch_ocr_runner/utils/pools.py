@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Pools of worker processes, kept for a whole run or created for one stage.
+
+`main` processes its batches inside `run_pool`, so every stage of every batch uses the
+same pool of warm workers (modules imported, page cache opened, Tesseract engine loaded)
+instead of starting and tearing down a pool per stage. Outside a run (benchmarks, tools,
+tests) `worker_pool` creates a pool for the block, as before.
+
+Workers of the run pool are replaced after `config.WORKER_MAX_TASKS` tasks
+(None to keep them for the whole run), which bounds any growth in their memory use.
+"""
+import contextlib
+import logging
+import multiprocessing
+
+import ch_ocr_runner.utils.configuration as configuration
+
+NUM_PROCESSES = multiprocessing.cpu_count()
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+# Pool shared by the batches of the run in progress, None outside a run
+_run_pool = None
+
+
+@contextlib.contextmanager
+def run_pool():
+    """Keeps one pool of workers for everything run inside the block"""
+    global _run_pool
+
+    logger.info(f"Starting run pool of {NUM_PROCESSES} workers")
+    pool = multiprocessing.Pool(
+        processes=NUM_PROCESSES, maxtasksperchild=config.WORKER_MAX_TASKS
+    )
+    _run_pool = pool
+    try:
+        with _shutting_down(pool):
+            yield pool
+    finally:
+        _run_pool = None
+
+
+def get_run_pool():
+    """The pool of the run in progress, None outside a run"""
+    return _run_pool
+
+
+@contextlib.contextmanager
+def worker_pool(processes=None):
+    """
+    Pool for a stage: the run pool if there is one, otherwise a new pool for the block.
+
+    Args:
+        processes: Number of workers, one per core if None.
+            A pool of a different size than the run pool is always new.
+    """
+    processes = processes or NUM_PROCESSES
+    if _run_pool is not None and processes == NUM_PROCESSES:
+        yield _run_pool
+        return
+
+    with _shutting_down(multiprocessing.Pool(processes=processes)) as pool:
+        yield pool
+
+
+@contextlib.contextmanager
+def _shutting_down(pool):
+    """Waits for the pool's work to finish on leaving the block, or stops it on an error"""
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
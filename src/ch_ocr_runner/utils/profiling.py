@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in cProfile profiling of the work done in pool workers.
+
+Turn on with `config.PROFILE_WORKERS` or by setting the environment variable
+`CH_OCR_PROFILE_WORKERS=1`. Functions handed to a pool are wrapped with `profiled`, each
+worker keeps a profile per stage and saves it after every call to:
+
+    {batch_dir}/profiles/worker-{stage}-{host}-{pid}.prof
+
+When the batch finishes the worker profiles of each stage are merged into
+`{stage}.prof` (load with `pstats` or e.g. snakeviz) and a text report `{stage}.txt` of
+the functions with the most cumulative and own time.
+"""
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+import socket
+
+import ch_ocr_runner.utils.configuration as configuration
+
+PROFILE_ENV_VAR = "CH_OCR_PROFILE_WORKERS"
+PROFILE_DIRNAME = "profiles"
+WORKER_PREFIX = "worker-"
+
+# Functions listed in each section of the text report
+REPORT_LINES = 40
+
+logger = logging.getLogger(__name__)
+config = configuration.get_config()
+
+# Profile directory of the batch in progress, None when not profiling
+_profile_dir = None
+
+# Profiles kept by this (worker) process, by (profile directory, stage)
+_worker_profilers = {}
+
+
+def is_enabled():
+    return bool(config.PROFILE_WORKERS) or os.getenv(PROFILE_ENV_VAR) == "1"
+
+
+def start_batch(batch_dir):
+    """Starts profiling the workers of a batch if turned on"""
+    global _profile_dir
+
+    _profile_dir = None
+    if is_enabled():
+        _profile_dir = os.path.join(batch_dir, PROFILE_DIRNAME)
+        os.makedirs(_profile_dir, exist_ok=True)
+        logger.info(f"Profiling pool workers to {_profile_dir}")
+
+
+def profiled(stage, f, batch_dir=None):
+    """
+    Wraps a function run by pool workers so each worker profiles it.
+
+    Returns `f` unchanged when not profiling.
+
+    Args:
+        stage: Name of the stage in the profile filenames
+        f: Function to profile
+        batch_dir: Batch the work is for if not the batch in progress (e.g. the next
+            batch preprocessed ahead), its profiles are merged when it finishes
+    """
+    if _profile_dir is None:
+        return f
+
+    profile_dir = _profile_dir
+    if batch_dir is not None:
+        profile_dir = os.path.join(batch_dir, PROFILE_DIRNAME)
+        os.makedirs(profile_dir, exist_ok=True)
+
+    return ProfiledCall(stage, profile_dir, f)
+
+
+class ProfiledCall(object):
+    """Picklable wrapper which runs a function under this process's profiler for a stage"""
+
+    def __init__(self, stage, profile_dir, f):
+        self.stage = stage
+        self.profile_dir = profile_dir
+        self.f = f
+
+    def __call__(self, *args, **kwargs):
+        key = (self.profile_dir, self.stage)
+        if key not in _worker_profilers:
+            _worker_profilers[key] = cProfile.Profile()
+        profiler = _worker_profilers[key]
+
+        profiler.enable()
+        try:
+            return self.f(*args, **kwargs)
+        finally:
+            profiler.disable()
+            # Saved every call as pool workers can exit without running any clean up
+            profiler.dump_stats(self._worker_filepath())
+
+    def _worker_filepath(self):
+        filename = (
+            f"{WORKER_PREFIX}{self.stage}-{socket.gethostname()}-{os.getpid()}.prof"
+        )
+        return os.path.join(self.profile_dir, filename)
+
+    def __repr__(self):
+        return f"ProfiledCall(stage={self.stage}, f={self.f})"
+
+
+def finish_batch():
+    """
+    Merges the worker profiles of each stage of the batch into a profile and a report.
+
+    Returns:
+        list[str]: Stages profiled
+    """
+    global _profile_dir
+
+    profile_dir, _profile_dir = _profile_dir, None
+    if profile_dir is None:
+        return []
+
+    by_stage = {}
+    for filepath in glob.glob(os.path.join(profile_dir, f"{WORKER_PREFIX}*.prof")):
+        stage = os.path.basename(filepath)[len(WORKER_PREFIX) :].split("-")[0]
+        by_stage.setdefault(stage, []).append(filepath)
+
+    for stage, filepaths in sorted(by_stage.items()):
+        merge_profiles(filepaths, os.path.join(profile_dir, stage))
+        logger.info(
+            f"Profile of {stage}: {len(filepaths)} workers merged into "
+            f"{os.path.join(profile_dir, stage)}.prof/.txt"
+        )
+
+    return sorted(by_stage)
+
+
+def merge_profiles(filepaths, output_filepath_no_suffix):
+    """Merges profiles into `{output}.prof` with a text report in `{output}.txt`"""
+    stats = pstats.Stats(*sorted(filepaths))
+    stats.dump_stats(f"{output_filepath_no_suffix}.prof")
+
+    report = io.StringIO()
+    stats.stream = report
+    report.write(f"Merged from {len(filepaths)} worker profiles\n\n")
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_LINES)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(REPORT_LINES)
+
+    with open(f"{output_filepath_no_suffix}.txt", "w", encoding="utf-8") as f:
+        f.write(report.getvalue())
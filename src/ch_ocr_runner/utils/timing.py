@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 """
 A basic stopwatch which can be used as a context manager.
+
+Given a `metric` name, each time the timer is stopped the time since it was started is
+recorded in that histogram of `ch_ocr_runner.utils.metrics`.
 """
 import time
 
+import ch_ocr_runner.utils.metrics as metrics
+
 
 class Timer(object):
-    def __init__(self, func=time.perf_counter):
+    def __init__(self, func=time.perf_counter, metric=None):
         self.elapsed = 0.0
+        self.metric = metric
         self._func = func
         self._start = None
 
@@ -21,10 +27,13 @@ class Timer(object):
         if self._start is None:
             raise RuntimeError("Timer not started")
 
-        end = self._func()
-        self.elapsed += end - self._start
+        interval = self._func() - self._start
+        self.elapsed += interval
         self._start = None
 
+        if self.metric is not None:
+            metrics.observe(self.metric, interval)
+
     def reset(self):
         self.elapsed = 0.0
 
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import ast
+import concurrent.futures
 import logging
 import os
 from typing import Generator
@@ -6,6 +8,8 @@ from typing import Generator
 import pandas as pd
 
 import ch_ocr_runner as cor
+import ch_ocr_runner.allocation_store
+import ch_ocr_runner.file_index
 import ch_ocr_runner.utils.configuration
 import ch_ocr_runner.utils.setup_logging
 
@@ -19,8 +23,13 @@ class Cols(object):
     path = "path"
     batch_id = "batch_id"
     machine_allocation = "machine_allocation"
+    pages = "pages"
+    # List of {"url", "path", "checksum"} for the filing, only its checksum is kept
+    files = "files"
+    checksum = "checksum"
 
     ALL = [machine_allocation, batch_id, path]
+    OPTIONAL = [pages, files]
 
     def __init__(self):
         raise NotImplementedError("Not instantiable")
@@ -39,13 +48,7 @@ class WorkBatch(object):
         self.batch_id = batch_id
         self.data = data.copy()
 
-        filepaths = data[Cols.path].values
-
-        missing_files = set()
-        for filepath in filepaths:
-            full_path = os.path.join(config.PDF_DIR, filepath)
-            if not os.path.isfile(full_path):
-                missing_files.add(filepath)
+        missing_files = _missing_files(data[Cols.path].values)
 
         self.missing_df = data[data[Cols.path].isin(missing_files)]
         if len(self.missing_df) > 0:
@@ -60,6 +63,40 @@ class WorkBatch(object):
             full_path = os.path.join(config.PDF_DIR, filepath)
             yield full_path
 
+    def page_counts(self):
+        """
+        Generator of (full filepath, page count) for work in this batch.
+
+        The page count is None if the allocation file has no (valid) `pages` value.
+        """
+        if Cols.pages in self.data:
+            pages = pd.to_numeric(self.data[Cols.pages], errors="coerce").values
+        else:
+            pages = [None] * len(self.data)
+
+        for full_path, num_pages in zip(self.filepaths(), pages):
+            if num_pages is None or not num_pages > 0:
+                yield full_path, None
+            else:
+                yield full_path, int(num_pages)
+
+    def checksums(self):
+        """
+        Returns {full filepath: checksum} for PDFs with a checksum in the allocation file.
+
+        The checksum is as given in the `files` column, not necessarily a valid digest.
+        """
+        if Cols.checksum not in self.data:
+            return {}
+
+        return {
+            full_path: checksum
+            for full_path, checksum in zip(
+                self.filepaths(), self.data[Cols.checksum].values
+            )
+            if isinstance(checksum, str) and checksum
+        }
+
     def __len__(self):
         return len(self.data)
 
@@ -70,26 +107,173 @@ class WorkBatch(object):
         return self.__repr__()
 
 
-def fetch(allocation_filepath) -> Generator[WorkBatch, None, None]:
+def _missing_files(filepaths):
+    """Filepaths (relative to `config.PDF_DIR`) which don't exist"""
+    full_paths = {
+        os.path.join(config.PDF_DIR, filepath): filepath for filepath in filepaths
+    }
+
+    file_index = cor.file_index.get_file_index()
+
+    if file_index is not None:
+        missing_full_paths = file_index.missing(full_paths)
+    else:
+        missing_full_paths = {
+            full_path for full_path in full_paths if not os.path.isfile(full_path)
+        }
+
+    return {full_paths[full_path] for full_path in missing_full_paths}
+
+
+def fetch(allocation_filepath, store_filepath=None) -> Generator[WorkBatch, None, None]:
     """
     Uses the allocation csv file to define batches of work.
 
-    Assumes CSV has at least the columns defined in `Cols.ALL`
+    Assumes CSV has at least the columns defined in `Cols.ALL`,
+    columns in `Cols.OPTIONAL` are used if present.
+
+    If an up to date allocation store exists (see `ch_ocr_runner.allocation_store`)
+    only the rows for this machine are loaded from it instead of reading the whole CSV.
 
     Args:
         allocation_filepath: Filepath for the allocation csv file
+        store_filepath: Filepath for the allocation store,
+            defaults to `config.WORK_BATCH_ALLOCATION_STORE_FILEPATH`
 
     Yields:
         WorkBatch: The next batch of work
 
     """
-    df = pd.read_csv(allocation_filepath, usecols=Cols.ALL)
+    store_filepath = store_filepath or config.WORK_BATCH_ALLOCATION_STORE_FILEPATH
+
+    if cor.allocation_store.is_current(store_filepath, allocation_filepath):
+        machine_id = os.getenv(config.MACHINE_ENV_VAR)
+
+        df = cor.allocation_store.load_machine_rows(store_filepath, machine_id)
+        logger.info(
+            f"{len(df):,} pdfs allocated to {machine_id} (from {store_filepath})"
+        )
+
+        return _create_batches(df)
+
+    df = _read_allocation_csv(allocation_filepath, store_filepath)
 
     work_batches = _allocation_df_to_batches(df)
 
     return work_batches
 
 
+def fetch_other_machines(
+    allocation_filepath, store_filepath=None
+) -> Generator[WorkBatch, None, None]:
+    """
+    Batches allocated to other machines, used to take over work in dynamic allocation.
+
+    Batches are in reverse order, as the other machine works through them in order.
+
+    Args:
+        allocation_filepath: Filepath for the allocation csv file
+        store_filepath: Filepath for the allocation store,
+            defaults to `config.WORK_BATCH_ALLOCATION_STORE_FILEPATH`
+
+    Yields:
+        WorkBatch: The next batch of work
+    """
+    store_filepath = store_filepath or config.WORK_BATCH_ALLOCATION_STORE_FILEPATH
+    machine_id = os.getenv(config.MACHINE_ENV_VAR)
+
+    if cor.allocation_store.is_current(store_filepath, allocation_filepath):
+        df = cor.allocation_store.load_other_machine_rows(store_filepath, machine_id)
+    else:
+        df = _read_allocation_csv(allocation_filepath, store_filepath)
+        df = df[df[Cols.machine_allocation] != machine_id]
+
+    logger.info(f"{len(df):,} pdfs allocated to other machines")
+
+    return _create_batches(df, reverse=True)
+
+
+def prefetch(batches):
+    """
+    Yields (batch, next batch) pairs, building batches ahead in a background thread.
+
+    Building a `WorkBatch` checks every file in it exists, which can take a while on a
+    shared store. Here the batch after next is built while the current one is processed.
+    The next batch is None for the last batch.
+    """
+    batches = iter(batches)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="prefetch"
+    ) as executor:
+        batch = next(batches, None)
+        upcoming = executor.submit(next, batches, None)
+
+        while batch is not None:
+            next_batch = upcoming.result()
+            if next_batch is not None:
+                upcoming = executor.submit(next, batches, None)
+
+            yield batch, next_batch
+            batch = next_batch
+
+
+def _read_allocation_csv(allocation_filepath, store_filepath):
+    if os.path.exists(store_filepath):
+        logger.warning(
+            f"{store_filepath} is out of date, reading {allocation_filepath} instead"
+        )
+
+    df = pd.read_csv(
+        allocation_filepath, usecols=lambda col: col in Cols.ALL + Cols.OPTIONAL
+    )
+
+    missing_columns = set(Cols.ALL) - set(df.columns)
+    if missing_columns:
+        raise ValueError(f"Allocation file is missing columns: {missing_columns}")
+
+    return with_checksums(df)
+
+
+def with_checksums(df):
+    """Replaces the long `files` column of allocation rows with the PDF's checksum"""
+    if Cols.files not in df:
+        return df
+
+    df = df.drop(columns=[Cols.files]).assign(
+        **{
+            Cols.checksum: [
+                _file_checksum(files, path)
+                for files, path in zip(df[Cols.files].values, df[Cols.path].values)
+            ]
+        }
+    )
+
+    return df
+
+
+def _file_checksum(files, path):
+    """Checksum of the entry for `path` in a `files` value, None if there isn't one"""
+    if not isinstance(files, str) or "checksum" not in files:
+        return None
+
+    try:
+        entries = ast.literal_eval(files)
+    except (ValueError, SyntaxError):
+        return None
+
+    entries = [entry for entry in entries if isinstance(entry, dict)]
+    for entry in entries:
+        if entry.get("path") == path:
+            return entry.get("checksum")
+
+    # The entry's path may be written differently, a lone entry is the PDF
+    if len(entries) == 1:
+        return entries[0].get("checksum")
+
+    return None
+
+
 def _allocation_df_to_batches(allocation_df):
 
     allocated_only_df = _allocated_to_this_machine(allocation_df)
@@ -126,11 +310,16 @@ def _allocated_to_this_machine(df: pd.DataFrame):
     return filtered_df
 
 
-def _create_batches(allocated_df: pd.DataFrame) -> Generator[WorkBatch, None, None]:
+def _create_batches(
+    allocated_df: pd.DataFrame, reverse=False
+) -> Generator[WorkBatch, None, None]:
     """Turns a filtered allocation DataFrame into batches work."""
 
     groups = allocated_df.groupby(Cols.batch_id, sort=True)
 
+    if reverse:
+        groups = reversed(list(groups))
+
     for batch_id, data in groups:
         yield WorkBatch(batch_id, data)
 
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+import ch_ocr_runner.allocation_store as allocation_store
+import ch_ocr_runner.utils.configuration
+import ch_ocr_runner.work as work_fetcher
+
+config = ch_ocr_runner.utils.configuration.get_config()
+
+ALLOCATION_FILEPATH = os.path.join(
+    os.path.dirname(__file__), "resources", "pdf_batch_allocation_test.csv"
+)
+
+
+def _batch_rows(batches):
+    return [
+        (batch.batch_id, sorted(batch.data.path) + sorted(batch.missing_df.path))
+        for batch in batches
+    ]
+
+
+def test_fetch_from_store_matches_csv(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv(config.MACHINE_ENV_VAR, "TEST-MACHINE-01")
+
+    allocation_filepath = str(tmp_path / "allocation.csv")
+    shutil.copy(ALLOCATION_FILEPATH, allocation_filepath)
+    store_filepath = str(tmp_path / "allocation.sqlite")
+
+    from_csv = _batch_rows(work_fetcher.fetch(allocation_filepath, store_filepath))
+
+    # When
+    allocation_store.build(allocation_filepath, store_filepath)
+    rows = allocation_store.load_machine_rows(store_filepath, "TEST-MACHINE-01")
+
+    # Then
+    assert allocation_store.is_current(store_filepath, allocation_filepath)
+    assert rows.pages.tolist() == [3, 3, 3, 3, 3]
+    assert from_csv
+    assert _batch_rows(work_fetcher.fetch(allocation_filepath, store_filepath)) == (
+        from_csv
+    )
+
+
+def test_store_is_out_of_date_when_csv_changes(tmp_path):
+    # Given
+    allocation_filepath = str(tmp_path / "allocation.csv")
+    shutil.copy(ALLOCATION_FILEPATH, allocation_filepath)
+    store_filepath = str(tmp_path / "allocation.sqlite")
+
+    allocation_store.build(allocation_filepath, store_filepath)
+
+    # When
+    with open(allocation_filepath, "a") as f:
+        f.write("\n")
+
+    # Then
+    assert not allocation_store.is_current(store_filepath, allocation_filepath)
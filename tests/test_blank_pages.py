@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+
+import PIL.Image
+import cv2
+import numpy as np
+import pytest
+
+import ch_ocr_runner.images.blank_pages as blank_pages
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+import ch_ocr_runner.utils.configuration as configuration
+
+
+def _page_with_blobs(num_blobs, shape=(400, 300), size=6):
+    """Binarised page (0 for ink) with square blobs of ink in a grid"""
+    page = np.full(shape, 255, dtype=np.uint8)
+    for i in range(num_blobs):
+        top, left = 10 + (i // 20) * 15, 10 + (i % 20) * 14
+        page[top : top + size, left : left + size] = 0
+    return page
+
+
+def test_is_blank(monkeypatch):
+    # Given
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MAX_INK", 0.001)
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MAX_COMPONENTS", 0)
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MIN_COMPONENT_AREA", 30)
+
+    empty = _page_with_blobs(0)
+    specks = _page_with_blobs(20, size=2)  # Some ink, but all below the min area
+    stamp = _page_with_blobs(1, size=80)
+    text = _page_with_blobs(200)
+
+    # Then
+    assert blank_pages.is_blank(empty)
+    assert blank_pages.is_blank(np.zeros((400, 300), dtype=np.uint8))  # One colour
+    assert blank_pages.is_blank(specks)
+    assert not blank_pages.is_blank(stamp)
+    assert not blank_pages.is_blank(text)
+
+
+def test_is_blank_allowing_a_few_blobs(monkeypatch):
+    # Given
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MAX_INK", 0.001)
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MAX_COMPONENTS", 3)
+    monkeypatch.setattr(blank_pages.config, "BLANK_PAGE_MIN_COMPONENT_AREA", 30)
+
+    # Then
+    assert blank_pages.is_blank(_page_with_blobs(2))
+    # Few blobs, but too much ink
+    assert not blank_pages.is_blank(_page_with_blobs(1, size=80))
+
+
+@pytest.fixture
+def default_blank_page_config(monkeypatch):
+    """The default blank page settings, whatever the local config file says"""
+    monkeypatch.setattr(configuration.Config.config_provider, "fetch_config", list)
+    defaults = object.__new__(configuration.Config)
+    configuration.Config.__init__(defaults)
+
+    for name in [
+        "BLANK_PAGE_MAX_INK",
+        "BLANK_PAGE_MAX_COMPONENTS",
+        "BLANK_PAGE_MIN_COMPONENT_AREA",
+    ]:
+        monkeypatch.setattr(blank_pages.config, name, getattr(defaults, name))
+
+
+def _a4_page(text):
+    """An A4 page at 300 DPI with a line of 12pt-ish text near the bottom"""
+    page = np.full((3508, 2480), 255, dtype=np.uint8)
+    cv2.putText(page, text, (1150, 3300), cv2.FONT_HERSHEY_SIMPLEX, 1.5, 0, 4)
+    return page
+
+
+@pytest.mark.parametrize("text", ["2", "12", "- 3 -"])
+def test_page_with_only_a_page_number_is_blank(default_blank_page_config, text):
+    assert blank_pages.is_blank(_a4_page(text))
+
+
+def test_page_with_only_a_stamp_is_blank(default_blank_page_config):
+    # Given
+    page = np.full((3508, 2480), 255, dtype=np.uint8)
+    cv2.circle(page, (1240, 1700), 150, 0, 6)
+
+    # Then
+    assert blank_pages.is_blank(page)
+
+
+@pytest.mark.parametrize("text", ["Page 2", "01234567"])
+def test_page_with_a_short_line_of_text_is_not_blank(default_blank_page_config, text):
+    # Given
+    page = _a4_page(text)
+
+    # Then
+    assert blank_pages.ink_fraction(page) < 0.001
+    assert not blank_pages.is_blank(page)
+
+
+def test_blank_pages_get_a_page_row_without_ocr(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(preprocessing.config, "SKIP_BLANK_PAGES", True)
+    monkeypatch.setattr(preprocessing.config, "EXTRACT_EMBEDDED_IMAGES", False)
+
+    rendered = [
+        PIL.Image.fromarray(_page_with_blobs(0)).convert("RGB"),
+        PIL.Image.fromarray(_page_with_blobs(200)).convert("RGB"),
+    ]
+    monkeypatch.setattr(
+        preprocessing,
+        "render_pdf",
+        lambda *args: (preprocessing.RenderedPage(im, (300, 300)) for im in rendered),
+    )
+
+    image_dir = str(tmp_path)
+
+    # When
+    result = preprocessing.preprocess_pdf("raw", image_dir, "/pdfs/doc.pdf")
+    chunk = tesseract_wrapper.create_blank_chunk(
+        image_dir, chunk_dir=image_dir, tsv_dir=image_dir
+    )
+
+    # Then
+    blank_file = os.path.join(image_dir, "doc.pdf_0.tif")
+    assert result.blank_files == [blank_file]
+    assert result.image_files == [os.path.join(image_dir, "doc.pdf_1.tif")]
+    assert not os.path.exists(blank_file)
+
+    assert chunk.filepaths == (blank_file,)
+    with open(f"{chunk.tsv_filepath_no_suffix(image_dir)}.tsv") as f:
+        rows = f.read().splitlines()[1:]
+    assert rows == ["1\t1\t0\t0\t0\t0\t0\t0\t300\t400\t-1\t"]
+
+
+def test_no_blank_chunk_without_blank_pages(tmp_path):
+    assert (
+        tesseract_wrapper.create_blank_chunk(
+            str(tmp_path), str(tmp_path), str(tmp_path)
+        )
+        is None
+    )
@@ -0,0 +1,109 @@
+import os
+
+import PIL.Image
+
+from ch_ocr_runner.images import embedded_images
+from ch_ocr_runner.images.preprocessing import _consecutive_ranges
+
+PDFIMAGES_LIST = """\
+page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
+--------------------------------------------------------------------------------------------
+   1     0 image    2480  3508  gray    1   8  jpeg   no        10  0   300   300  500K 5.9%
+   2     1 image    2480  3508  gray    1   8  jpeg   no        14  0   300   300  500K 5.9%
+   2     2 smask    2480  3508  gray    1   8  image  no        14  0   300   300  100K 1.1%
+   3     3 image     300   200  rgb     3   8  jpeg   no        18  0    72    72   20K 3.0%
+   4     4 image    2480  3508  gray    1   8  jpeg   no        22  0   300   300  500K 5.9%
+"""
+
+PDFINFO = "".join(
+    f"Page    {page} size: 595.276 x 841.89 pts (A4)\nPage    {page} rot:  0\n"
+    for page in range(1, 5)
+)
+
+# Page 4 has a text layer over the scan
+PDFTOTEXT = "\f\f\fSome text\f"
+
+
+def test_single_image_pages(monkeypatch):
+    outputs = {"pdfimages": PDFIMAGES_LIST, "pdfinfo": PDFINFO, "pdftotext": PDFTOTEXT}
+    monkeypatch.setattr(embedded_images, "_run_poppler", lambda args: outputs[args[0]])
+
+    pages = embedded_images.single_image_pages("test.pdf", 1, 4)
+
+    assert list(pages) == [1]
+    assert (pages[1].x_ppi, pages[1].y_ppi) == (300, 300)
+
+
+def test_consecutive_ranges():
+    assert _consecutive_ranges([1, 2, 3, 5, 7, 8]) == [(1, 3), (5, 5), (7, 8)]
+    assert _consecutive_ranges([]) == []
+
+
+def _fake_pdfimages(written, on_run=None):
+    """Writes a TIFF per page in the -f/-l range, like `pdfimages -tiff -p`"""
+
+    def run(args, **kwargs):
+        first_page = int(args[args.index("-f") + 1])
+        last_page = int(args[args.index("-l") + 1])
+        prefix = args[-1]
+        for page in range(first_page, last_page + 1):
+            filepath = f"{prefix}-{page:03}-000.tif"
+            PIL.Image.new("L", (4, 4), color=page).save(filepath)
+            written.append(filepath)
+
+        if on_run is not None:
+            on_run()
+
+    return run
+
+
+def test_extract_images_of_overlapping_page_ranges(monkeypatch, tmp_path):
+    # Given
+    pages_1 = {1: None, 3: None}
+    pages_2 = {2: None, 3: None}
+    written = []
+    results = {}
+
+    def extract_second_range():
+        # A task for another page range of the PDF runs while the first is extracting
+        monkeypatch.setattr(embedded_images.subprocess, "run", _fake_pdfimages(written))
+        results[2] = embedded_images.extract_images("test.pdf", pages_2, str(tmp_path))
+
+    monkeypatch.setattr(
+        embedded_images.subprocess,
+        "run",
+        _fake_pdfimages(written, on_run=extract_second_range),
+    )
+
+    # When
+    results[1] = embedded_images.extract_images("test.pdf", pages_1, str(tmp_path))
+
+    # Then
+    assert {page: im.getpixel((0, 0)) for page, im in results[1].items()} == {
+        1: 1,
+        3: 3,
+    }
+    assert {page: im.getpixel((0, 0)) for page, im in results[2].items()} == {
+        2: 2,
+        3: 3,
+    }
+    assert sorted(os.listdir(tmp_path)) == [
+        "test.pdf-embedded-001-000.tif",
+        "test.pdf-embedded-002-000.tif",
+        "test.pdf-embedded-003-000.tif",
+    ]
+
+
+def test_extract_images_without_keeping_them(monkeypatch, tmp_path):
+    # Given
+    written = []
+    monkeypatch.setattr(embedded_images.subprocess, "run", _fake_pdfimages(written))
+
+    # When
+    images = embedded_images.extract_images(
+        "test.pdf", {1: None, 2: None}, str(tmp_path), keep=False
+    )
+
+    # Then
+    assert {page: im.getpixel((0, 0)) for page, im in images.items()} == {1: 1, 2: 2}
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+
+import ch_ocr_runner.file_index as file_index
+
+
+def _make_files(dirpath, names, mtime=None):
+    os.makedirs(dirpath, exist_ok=True)
+    for name in names:
+        open(os.path.join(dirpath, name), "w").close()
+
+    if mtime is not None:
+        os.utime(dirpath, (mtime, mtime))
+
+
+def test_missing_files(tmp_path):
+    # Given
+    pdf_dir = str(tmp_path / "pdfs")
+    _make_files(os.path.join(pdf_dir, "full"), ["a.pdf", "b.pdf"])
+    os.makedirs(os.path.join(pdf_dir, "full", "c.pdf"))  # Not a file
+
+    filepaths = [
+        os.path.join(pdf_dir, "full", name) for name in ["a.pdf", "b.pdf", "c.pdf"]
+    ] + [os.path.join(pdf_dir, "no_such_dir", "d.pdf")]
+
+    # When
+    missing = file_index.FileIndex(max_workers=2).missing(filepaths)
+
+    # Then
+    assert missing == set(filepaths[2:])
+
+
+def test_saved_listing_is_reused_until_directory_changes(tmp_path, monkeypatch):
+    # Given
+    pdf_dir = str(tmp_path / "pdfs")
+    index_filepath = str(tmp_path / "index.json")
+    _make_files(pdf_dir, ["a.pdf"], mtime=1e9)
+
+    a, b = os.path.join(pdf_dir, "a.pdf"), os.path.join(pdf_dir, "b.pdf")
+
+    assert file_index.FileIndex(index_filepath).missing([a, b]) == {b}
+
+    # When the directory is unchanged it isn't listed again
+    def scandir_not_allowed(path):
+        raise AssertionError(f"Listed {path}")
+
+    with monkeypatch.context() as m:
+        m.setattr(file_index.os, "scandir", scandir_not_allowed)
+        assert file_index.FileIndex(index_filepath).missing([a, b]) == {b}
+
+    # When a file is added the directory mtime changes
+    _make_files(pdf_dir, ["b.pdf"])
+
+    # Then
+    assert file_index.FileIndex(index_filepath).missing([a, b]) == set()
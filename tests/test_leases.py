@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+import ch_ocr_runner.leases as leases
+
+
+def test_lease_is_held_until_released(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+
+    # When
+    lease = leases.Lease.acquire(3)
+
+    # Then
+    assert lease is not None
+    assert os.path.exists(os.path.join(str(tmp_path), "batch_03.lease"))
+    assert leases.Lease.acquire(3) is None
+
+    lease.release()
+
+    assert not os.path.exists(lease.path)
+    assert not lease.lost.is_set()
+
+    with leases.Lease.acquire(3) as lease:
+        assert os.path.exists(lease.path)
+
+
+def test_stale_lease_is_taken_over(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+    monkeypatch.setattr(leases.config, "LEASE_EXPIRY_SECONDS", 60)
+
+    stale = leases.Lease.acquire(1)
+    stale._stop.set()  # Machine stopped, no more heartbeats
+    old = time.time() - 120
+    os.utime(stale.path, (old, old))
+
+    # When
+    lease = leases.Lease.acquire(1)
+
+    # Then
+    assert lease is not None
+    assert [f.name for f in tmp_path.iterdir()] == ["batch_01.lease"]
+
+    stale.release()  # Doesn't remove the new holder's lease
+
+    assert os.path.exists(lease.path)
+    lease.release()
+
+
+def _wait_for(event, seconds=5):
+    assert event.wait(seconds)
+
+
+def test_lease_taken_over_mid_batch_stops_the_batch(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+    monkeypatch.setattr(leases.config, "LEASE_HEARTBEAT_SECONDS", 0.01)
+
+    with leases.Lease.acquire(2) as lease:
+        leases.check()  # Still ours
+
+        # When
+        # Another machine decided the lease was stale and took it over
+        os.remove(lease.path)
+        assert leases._create_lease_file(lease.path, "other-machine")
+        _wait_for(lease.lost)
+
+        # Then
+        with pytest.raises(leases.LeaseLostError):
+            leases.check()
+
+    assert os.path.exists(lease.path)  # The new holder's lease is kept
+    leases.check()  # No lease in progress
+
+
+def test_lease_removed_while_renewing_is_lost(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+    monkeypatch.setattr(leases.config, "LEASE_HEARTBEAT_SECONDS", 0.01)
+
+    def utime_removed(path):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(leases.os, "utime", utime_removed)
+
+    # When
+    lease = leases.Lease.acquire(4)
+    _wait_for(lease.lost)
+
+    # Then
+    lease._heartbeat.join(1)
+    assert not lease._heartbeat.is_alive()
+    lease.release()
+
+
+def test_error_after_lease_taken_over_is_lease_lost(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+    monkeypatch.setattr(leases.config, "LEASE_HEARTBEAT_SECONDS", 60)
+    batch_dir = tmp_path / "batch_05"
+    batch_dir.mkdir()
+
+    with leases.Lease.acquire(5) as lease:
+        # When
+        # Another machine took over without resuming, removing the batch directory,
+        # before the heartbeat noticed
+        os.remove(lease.path)
+        assert leases._create_lease_file(lease.path, "other-machine")
+        batch_dir.rmdir()
+
+        # Then
+        with pytest.raises(leases.LeaseLostError):
+            with leases.stage_errors_if_lost():
+                open(batch_dir / "metrics.jsonl")
+
+
+def test_error_while_lease_held_is_raised(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(leases.config, "WORKING_DIR", str(tmp_path))
+    monkeypatch.setattr(leases.config, "LEASE_HEARTBEAT_SECONDS", 60)
+
+    with leases.Lease.acquire(6):
+        # Then
+        with pytest.raises(FileNotFoundError):
+            with leases.stage_errors_if_lost():
+                open(tmp_path / "missing")
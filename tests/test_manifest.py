@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import ch_ocr_runner.manifest as manifest
+from ch_ocr_runner.images.tesseract_wrapper import Chunk
+
+
+def test_manifest_records_progress(tmp_path):
+    # Given
+    batch_manifest = manifest.BatchManifest(str(tmp_path))
+    chunk = Chunk(["/img/a.pdf_0.tif"], chunk_id=3, chunk_dir=str(tmp_path))
+
+    # When
+    batch_manifest.mark_rendered("/pdfs/a.pdf", ["/img/a.pdf_0.tif"])
+    batch_manifest.mark_ocr_done(chunk)
+    batch_manifest.mark_output_written("a.pdf")
+
+    # Then
+    reopened = manifest.BatchManifest(str(tmp_path))
+    assert reopened.rendered() == {"/pdfs/a.pdf": ["/img/a.pdf_0.tif"]}
+    assert reopened.ocr_done() == {3: ["/img/a.pdf_0.tif"]}
+    assert reopened.outputs_written() == {"a.pdf"}
+
+
+def test_manifest_drops_incomplete_last_record(tmp_path):
+    # Given
+    batch_manifest = manifest.BatchManifest(str(tmp_path))
+    batch_manifest.mark_output_written("a.pdf")
+
+    with open(batch_manifest.path, "a") as f:
+        f.write('{"event": "output_wri')
+
+    # When
+    reopened = manifest.BatchManifest(str(tmp_path))
+    reopened.mark_output_written("b.pdf")
+
+    # Then
+    assert reopened.outputs_written() == {"a.pdf", "b.pdf"}
+
+
+def test_manifest_forget_intermediates_keeps_outputs(tmp_path):
+    # Given
+    batch_manifest = manifest.BatchManifest(str(tmp_path))
+    chunk = Chunk(["/img/a.pdf_0.tif"], chunk_id=3, chunk_dir=str(tmp_path))
+    batch_manifest.mark_rendered("/pdfs/a.pdf", ["/img/a.pdf_0.tif"])
+    batch_manifest.mark_ocr_done(chunk)
+    batch_manifest.mark_output_written("a.pdf")
+
+    # When
+    batch_manifest.forget_intermediates()
+
+    # Then
+    reopened = manifest.BatchManifest(str(tmp_path))
+    assert reopened.rendered() == {}
+    assert reopened.ocr_done() == {}
+    assert reopened.outputs_written() == {"a.pdf"}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import ch_ocr_runner.utils.metrics as metrics
+from ch_ocr_runner.utils.timing import Timer
+
+
+def test_histogram_buckets_are_cumulative():
+    # Given
+    histogram = metrics.Histogram()
+
+    # When
+    for value in [0.01, 0.2, 0.2, 7200]:
+        histogram.observe(value)
+
+    # Then
+    buckets = dict(histogram.cumulative_buckets())
+    assert buckets[0.05] == 1
+    assert buckets[0.25] == 3
+    assert buckets[3600] == 3
+    assert buckets[float("inf")] == 4
+    assert (histogram.min, histogram.max, histogram.count) == (0.01, 7200, 4)
+
+
+def test_finish_batch_writes_jsonl_and_prometheus(tmp_path, monkeypatch):
+    # Given
+    textfile = str(tmp_path / "textfile" / "ch_ocr_runner.prom")
+    monkeypatch.setattr(metrics.config, "METRICS_PROMETHEUS_TEXTFILE", textfile)
+    monkeypatch.setattr(metrics, "_run", metrics.Metrics())
+
+    # When
+    for _ in range(2):
+        metrics.start_batch()
+        metrics.inc("pages_output", 10)
+        with Timer(metric="chunk_seconds"):
+            pass
+
+        record = metrics.finish_batch(str(tmp_path), batch_id=7, seconds=5.0)
+
+    # Then
+    with open(os.path.join(str(tmp_path), metrics.METRICS_FILENAME)) as f:
+        records = [json.loads(line) for line in f]
+
+    assert len(records) == 2
+    assert records[-1] == record
+    assert record["batch_id"] == 7
+    assert record["pages_per_second"] == 2.0
+    assert record["counters"] == {"pages_output": 10}
+    assert record["histograms"]["chunk_seconds"]["count"] == 1
+    assert record["histograms"]["batch_seconds"]["count"] == 1
+    assert record["histograms"]["batch_seconds"]["sum"] == 5.0
+
+    with open(textfile) as f:
+        text = f.read()
+
+    assert "# TYPE ch_ocr_runner_pages_output_total counter" in text
+    assert 'ch_ocr_runner_pages_output_total{machine="' in text
+    assert "} 20\n" in text
+    assert 'ch_ocr_runner_batch_seconds_bucket{machine="' in text
+    assert 'le="+Inf"} 2\n' in text
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+import ch_ocr_runner.output as output
+
+
+def _output_df():
+    return pd.DataFrame(
+        {
+            "page_num": [1, 0, 0],
+            "level": [5, 1, 5],
+            "block_num": [1, 0, 1],
+            "par_num": [1, 0, 1],
+            "line_num": [1, 0, 1],
+            "word_num": [1, 0, 1],
+            "left": [10, 0, 10],
+            "top": [10, 0, 10],
+            "width": [20, 2480, 20],
+            "height": [20, 3508, 20],
+            "conf": [96, -1, 91],
+            "text": ["Limited", None, "Accounts"],
+            "basefile": pd.Categorical(["a.pdf", "a.pdf", "a.pdf"]),
+        }
+    )
+
+
+def test_write_parquet_partitions_by_batch(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    # When
+    filepath = output.write_parquet(_output_df(), str(tmp_path), batch_id=7)
+
+    # Then
+    assert filepath == str(tmp_path / "batch_id=7" / output.PARQUET_PART_FILENAME)
+
+    table = pq.read_table(filepath)
+    assert table.schema.field("page_num").type == "int32"
+    assert table.column("text").to_pylist() == [None, "Accounts", "Limited"]
+    assert table.column("page_num").to_pylist() == [0, 0, 1]
+
+
+def test_write_csv_per_pdf(tmp_path):
+    # When
+    output.write_csv_per_pdf(_output_df(), str(tmp_path), processes=1)
+
+    # Then
+    df = pd.read_csv(tmp_path / "a.pdf_output.csv")
+    assert "basefile" not in df.columns
+    assert df.page_num.tolist() == [0, 0, 1]
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import os
+
+import PIL.Image
+import numpy as np
+
+import ch_ocr_runner.images.page_cache as page_cache
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+
+
+def _page_rows(page_num, word):
+    return [
+        f"1\t{page_num}\t0\t0\t0\t0\t0\t0\t40\t60\t-1\t\n",
+        f"5\t{page_num}\t1\t1\t1\t1\t10\t10\t20\t20\t96\t{word}\n",
+    ]
+
+
+def test_page_key_depends_on_pixels_and_shape():
+    # Given
+    page = np.zeros((4, 6), dtype=np.uint8)
+    same_page = page.copy()
+    other_page = page.copy()
+    other_page[0, 0] = 255
+
+    # Then
+    assert page_cache.page_key(page, 300) == page_cache.page_key(same_page, 300)
+    assert page_cache.page_key(page, 300) != page_cache.page_key(other_page, 300)
+    assert page_cache.page_key(page, 300) != page_cache.page_key(
+        page.reshape(6, 4), 300
+    )
+
+
+def test_page_key_depends_on_dpi():
+    # Given
+    page = np.zeros((4, 6), dtype=np.uint8)
+
+    # Then
+    assert page_cache.page_key(page, 300) != page_cache.page_key(page, 150)
+    assert page_cache.page_key(page, 300) == page_cache.page_key(page, 299.9994)
+
+
+def test_image_file_key_uses_the_saved_dpi(tmp_path):
+    # Given
+    page = np.zeros((4, 6), dtype=np.uint8)
+    filepath = str(tmp_path / "page.tif")
+
+    # When
+    PIL.Image.fromarray(page).save(filepath, dpi=(150, 150))
+
+    # Then
+    assert page_cache.image_file_key(filepath) == page_cache.page_key(page, 150)
+
+
+def test_page_cache_round_trip(tmp_path):
+    # Given
+    cache = page_cache.PageCache(str(tmp_path / "cache.sqlite"), max_bytes=10000)
+    rows = _page_rows(3, "hello")
+
+    # When
+    cache.put("key", rows)
+
+    # Then
+    assert cache.get("key") == rows
+    assert cache.get("missing") is None
+
+
+def test_page_cache_evicts_least_recently_used(tmp_path):
+    # Given
+    rows = _page_rows(1, "word")
+    row_bytes = len("".join(rows).encode("utf-8"))
+    cache = page_cache.PageCache(
+        str(tmp_path / "cache.sqlite"), max_bytes=2 * row_bytes
+    )
+
+    # When
+    cache.put("first", rows)
+    cache.put("second", rows)
+    cache.get("first")
+    cache.put("third", rows)
+
+    # Then
+    assert cache.get("first") == rows
+    assert cache.get("second") is None
+    assert cache.get("third") == rows
+
+
+def test_cached_pages_only_sends_new_pages_to_tesseract(tmp_path):
+    # Given
+    chunk_dir = str(tmp_path)
+    tsv_dir = str(tmp_path)
+    cache = page_cache.PageCache(str(tmp_path / "cache.sqlite"), max_bytes=10000)
+
+    blank = np.full((60, 40), 255, dtype=np.uint8)
+    text = blank.copy()
+    text[10:20, 10:30] = 0
+
+    image_files = []
+    for name, pixels in [("a.pdf_0", text), ("a.pdf_1", blank), ("b.pdf_0", blank)]:
+        filepath = os.path.join(str(tmp_path), f"{name}.tif")
+        PIL.Image.fromarray(pixels).save(filepath)
+        image_files.append(filepath)
+
+    cache.put(page_cache.image_file_key(image_files[0]), _page_rows(7, "cached"))
+
+    cached_pages = tesseract_wrapper.CachedPages(cache, chunk_dir, tsv_dir)
+
+    # When
+    misses = cached_pages.misses(image_files)
+
+    # Tesseract output for the only page it is sent
+    (chunk,) = tesseract_wrapper._create_chunks(misses, chunk_dir=chunk_dir)
+    with open(f"{chunk.tsv_filepath_no_suffix(tsv_dir)}.tsv", "w") as f:
+        f.write(tesseract_wrapper.TSV_HEADER)
+        f.writelines(_page_rows(1, "blank"))
+
+    cached_pages.store([chunk])
+    cached_chunk = cached_pages.chunk()
+
+    # Then
+    assert misses == [image_files[1]]
+    assert cached_chunk.filepaths == (image_files[0], image_files[2])
+
+    linked_df = tesseract_wrapper._link_tsv_to_pages(
+        cached_chunk, tsv_dir, basefile_codes={"a.pdf": 0, "b.pdf": 1}
+    )
+    words = linked_df[linked_df.level == 5].set_index(["basefile", "page_num"]).text
+    assert words.to_dict() == {(0, 0): "cached", (1, 0): "blank"}
+
+    assert cache.get(page_cache.image_file_key(image_files[1])) == _page_rows(
+        1, "blank"
+    )
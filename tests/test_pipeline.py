@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import json
+import multiprocessing
+import os
+import stat
+import sys
+import types
+
+import PIL.Image
+import pytest
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_engine as tesseract_engine
+import ch_ocr_runner.pipeline as pipeline
+from ch_ocr_runner.manifest import BatchManifest
+
+# Fake tesseract: a page row and a word per image in the chunk, logs each call
+FAKE_TESSERACT = f"""#!{sys.executable}
+import os, sys
+chunk_path, tsv_path = sys.argv[1], sys.argv[2]
+files = [line.strip() for line in open(chunk_path) if line.strip()]
+with open(os.path.join(os.path.dirname(chunk_path), "calls.log"), "a") as f:
+    f.write(chunk_path + "\\n")
+with open(tsv_path + ".tsv", "w") as f:
+    f.write("level\\tpage_num\\tblock_num\\tpar_num\\tline_num\\tword_num\\tleft\\ttop\\twidth\\theight\\tconf\\ttext\\n")
+    for i, filepath in enumerate(files, 1):
+        f.write(f"1\\t{{i}}\\t0\\t0\\t0\\t0\\t0\\t0\\t40\\t60\\t-1\\t\\n")
+        f.write(f"5\\t{{i}}\\t1\\t1\\t1\\t1\\t10\\t10\\t20\\t20\\t96\\t{{os.path.basename(filepath)}}\\n")
+"""
+
+PAGES = {"a.pdf": 3, "b.pdf": 2, "c.pdf": 4}
+
+
+@pytest.fixture
+def fake_tesseract(monkeypatch, tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    filepath = bin_dir / "tesseract"
+    filepath.write_text(FAKE_TESSERACT)
+    filepath.chmod(filepath.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+@pytest.fixture
+def fake_pdfs(monkeypatch):
+    def convert_from_path(pdf_filepath, first_page=None, last_page=None, **kwargs):
+        num_pages = PAGES[os.path.basename(pdf_filepath)]
+        return [
+            PIL.Image.new("RGB", (40, 60), color="white")
+            for _ in range(
+                (first_page or 1) - 1, min(last_page or num_pages, num_pages)
+            )
+        ]
+
+    monkeypatch.setattr(preprocessing.pdf2image, "convert_from_path", convert_from_path)
+    monkeypatch.setattr(
+        preprocessing.pdf2image,
+        "pdfinfo_from_path",
+        lambda pdf_filepath, **kwargs: {"Pages": PAGES[os.path.basename(pdf_filepath)]},
+    )
+    monkeypatch.setattr(pipeline.config, "OUTPUT_FORMAT", "csv")
+    monkeypatch.setattr(pipeline.config, "TESSERACT_PAGES_PER_CHUNK", 2)
+    monkeypatch.setattr(pipeline.config, "SPLIT_PDF_PAGES", 2)
+
+
+class Batch(object):
+    batch_id = 1
+
+    def filepaths(self):
+        return [f"/pdfs/{name}" for name in PAGES]
+
+    def page_counts(self):
+        return [(pdf_filepath, None) for pdf_filepath in self.filepaths()]
+
+
+def _working_dir(tmp_path, resume=False):
+    batch_dir = tmp_path / "batch_01"
+    dirs = {
+        name: str(batch_dir / name)
+        for name in ["image_raw_dir", "image_processed_dir", "chunk_dir", "tsv_dir"]
+    }
+    dirs["output_dir"] = str(batch_dir / "output")
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+
+    return types.SimpleNamespace(
+        batch_id=1,
+        batch_dir=str(batch_dir),
+        manifest=BatchManifest(str(batch_dir)) if resume else None,
+        **dirs,
+    )
+
+
+def _tesseract_calls(working_dir):
+    filepath = os.path.join(working_dir.chunk_dir, "calls.log")
+    if not os.path.exists(filepath):
+        return 0
+
+    with open(filepath) as f:
+        return len(f.readlines())
+
+
+def _output(working_dir):
+    """{output file: [text of each word]}"""
+    output = {}
+    for filename in sorted(os.listdir(working_dir.output_dir)):
+        with open(os.path.join(working_dir.output_dir, filename)) as f:
+            rows = [line.rstrip("\n").split(",") for line in f][1:]
+        output[filename] = [row[-1] for row in rows if row[-1]]
+
+    return output
+
+
+def test_streaming_outputs_every_page(tmp_path, fake_tesseract, fake_pdfs):
+    # Given
+    working_dir = _working_dir(tmp_path)
+
+    # When
+    pipeline.run_streaming(Batch(), working_dir)
+
+    # Then
+    assert _output(working_dir) == {
+        f"{name}_output.csv": [f"{name}_{page}.tif" for page in range(num_pages)]
+        for name, num_pages in PAGES.items()
+    }
+    assert _tesseract_calls(working_dir) == 5  # 9 pages in chunks of 2
+
+
+def test_streaming_resumes_from_manifest(tmp_path, fake_tesseract, fake_pdfs):
+    # Given
+    working_dir = _working_dir(tmp_path, resume=True)
+    pipeline.run_streaming(Batch(), working_dir)
+    expected = _output(working_dir)
+
+    # The previous run stopped before its last chunk was recorded and output written
+    with open(working_dir.manifest.path) as f:
+        records = [json.loads(line) for line in f]
+    last_chunk = max(r["chunk_id"] for r in records if r["event"] == "ocr_done")
+    records = [
+        r
+        for r in records
+        if r["event"] == "rendered"
+        or (r["event"] == "ocr_done" and r["chunk_id"] != last_chunk)
+    ]
+    with open(working_dir.manifest.path, "w") as f:
+        f.writelines(json.dumps(r) + "\n" for r in records)
+    for filename in os.listdir(working_dir.output_dir):
+        os.remove(os.path.join(working_dir.output_dir, filename))
+
+    # When
+    calls = _tesseract_calls(working_dir)
+    pipeline.run_streaming(Batch(), _working_dir(tmp_path, resume=True))
+
+    # Then
+    assert _tesseract_calls(working_dir) == calls + 1
+    assert _output(working_dir) == expected
+
+
+def test_streaming_stops_its_processes_on_error(
+    tmp_path, fake_tesseract, fake_pdfs, monkeypatch
+):
+    # Given
+    def convert_from_path(pdf_filepath, **kwargs):
+        raise ValueError(f"Unable to read {pdf_filepath}")
+
+    monkeypatch.setattr(preprocessing.pdf2image, "convert_from_path", convert_from_path)
+
+    # When
+    with pytest.raises(ValueError):
+        pipeline.run_streaming(Batch(), _working_dir(tmp_path))
+
+    # Then
+    assert multiprocessing.active_children() == []
+
+
+def test_in_process_outputs_every_page(tmp_path, fake_pdfs, monkeypatch):
+    # Given
+    class StubEngine(object):
+        def tsv(self, image, page_index, dpi):
+            return (
+                f"1\t{page_index + 1}\t0\t0\t0\t0\t0\t0\t40\t60\t-1\t\n"
+                f"5\t{page_index + 1}\t1\t1\t1\t1\t10\t10\t20\t20\t96\tword\n"
+            )
+
+    monkeypatch.setattr(tesseract_engine, "get_engine", StubEngine)
+    working_dir = _working_dir(tmp_path, resume=True)
+
+    # When
+    pipeline.run_in_process(Batch(), working_dir)
+
+    # Then
+    assert _output(working_dir) == {
+        f"{name}_output.csv": ["word"] * num_pages for name, num_pages in PAGES.items()
+    }
+    assert sorted(working_dir.manifest.ocr_done()) == [0, 1, 2]
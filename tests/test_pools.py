@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+
+import ch_ocr_runner.utils.pools as pools
+
+
+def _pid(_):
+    return os.getpid()
+
+
+def test_worker_pool_uses_the_run_pool():
+    # When
+    with pools.run_pool() as run_pool:
+        with pools.worker_pool() as first, pools.worker_pool() as second:
+            pids = set(first.map(_pid, range(4)))
+
+    # Then
+    assert first is second is run_pool
+    assert os.getpid() not in pids
+    assert pools.get_run_pool() is None
+
+
+def test_worker_pool_outside_a_run_is_new():
+    # When
+    with pools.worker_pool(processes=2) as pool:
+        results = pool.map(abs, [-1, -2])
+
+    # Then
+    assert pool is not pools.get_run_pool()
+    assert results == [1, 2]
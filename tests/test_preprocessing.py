@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+import multiprocessing.pool
+import os
+import stat
+import sys
+
+import PIL.Image
+import numpy as np
+import pytest
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+
+# Fake poppler: the PDF holds its page count, page N is rendered N + 10 pixels wide
+FAKE_PDFINFO = f"""#!{sys.executable}
+import sys
+print("Pages: " + open(sys.argv[1]).read().strip())
+"""
+
+FAKE_PDFTOCAIRO = f"""#!{sys.executable}
+import sys
+from PIL import Image
+args = sys.argv[1:]
+if "-v" in args:
+    sys.stderr.write("pdftocairo version 22.02.0\\n")
+    sys.exit(0)
+num_pages = int(open(args[2]).read().strip())
+first_page, last_page = int(args[args.index("-f") + 1]), int(args[args.index("-l") + 1])
+for page in range(first_page, last_page + 1):
+    Image.new("L", (page + 10, 20), color=255).save(
+        f"{{args[-1]}}-{{page:0{{len(str(num_pages))}}d}}.tif"
+    )
+"""
+
+
+def _reference_preprocess(im):
+    im = preprocessing._grayscale(im)
+    im = preprocessing._binarize(im)
+    im = preprocessing._denoise(im)
+    return im
+
+
+def _scanned_page(seed, shape=(330, 250)):
+    """Noisy RGB page with some dark 'text' blocks and specks"""
+    rng = np.random.default_rng(seed)
+
+    page = rng.normal(225, 20, size=shape + (3,))
+    for _ in range(30):
+        top, left = rng.integers(0, shape[0] - 10), rng.integers(0, shape[1] - 40)
+        page[top : top + rng.integers(2, 10), left : left + rng.integers(5, 40)] -= 150
+
+    specks = rng.random(shape) < 0.002
+    page[specks] = 10
+
+    return PIL.Image.fromarray(np.clip(page, 0, 255).astype(np.uint8))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_preprocess_image_matches_reference_chain(seed):
+    # Given
+    im = _scanned_page(seed)
+
+    # When
+    fused = np.asarray(preprocessing.preprocess_image(im))
+    reference = np.asarray(_reference_preprocess(im))
+
+    # Then
+    assert fused.dtype == reference.dtype == np.uint8
+    assert np.array_equal(fused, reference)
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "1"])
+@pytest.mark.parametrize("value", [0, 128, 255])
+def test_preprocess_image_matches_reference_chain_for_flat_pages(mode, value):
+    # Given
+    im = PIL.Image.new(mode, (40, 30), value if mode != "RGB" else (value,) * 3)
+
+    # Then
+    assert np.array_equal(
+        np.asarray(preprocessing.preprocess_image(im)),
+        np.asarray(_reference_preprocess(im)),
+    )
+
+
+def test_preprocess_image_matches_reference_chain_for_two_level_page():
+    # Given
+    pixels = np.full((50, 60), 255, dtype=np.uint8)
+    pixels[10:20, 5:55] = 0
+    pixels[30, 30] = 0  # Speck
+    im = PIL.Image.fromarray(pixels)
+
+    # When
+    fused = np.asarray(preprocessing.preprocess_image(im))
+
+    # Then
+    assert np.array_equal(fused, np.asarray(_reference_preprocess(im)))
+    assert fused[30, 30] == 255
+
+
+def test_render_pdf_renders_page_windows(monkeypatch):
+    # Given
+    calls = []
+
+    def convert_from_path(pdf_filepath, first_page, last_page, **kwargs):
+        calls.append((first_page, last_page))
+        return [PIL.Image.new("L", (4, 4), p) for p in range(first_page, last_page + 1)]
+
+    monkeypatch.setattr(preprocessing.pdf2image, "convert_from_path", convert_from_path)
+    monkeypatch.setattr(
+        preprocessing.pdf2image, "pdfinfo_from_path", lambda f: {"Pages": 7}
+    )
+    monkeypatch.setattr(preprocessing.config, "RENDER_PAGE_WINDOW", 3)
+    monkeypatch.setattr(preprocessing.config, "EXTRACT_EMBEDDED_IMAGES", False)
+
+    # When
+    pages = preprocessing.render_pdf("raw", "test.pdf")
+
+    # Then
+    assert calls == []  # Nothing is rendered until the pages are used
+    assert [page.image.getpixel((0, 0)) for page in pages] == list(range(1, 8))
+    assert calls == [(1, 3), (4, 6), (7, 7)]
+
+
+@pytest.fixture
+def fake_poppler(monkeypatch, tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in [("pdfinfo", FAKE_PDFINFO), ("pdftocairo", FAKE_PDFTOCAIRO)]:
+        filepath = bin_dir / name
+        filepath.write_text(script)
+        filepath.chmod(filepath.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(preprocessing.config, "SAVE_RAW_IMAGES", True)
+    monkeypatch.setattr(preprocessing.config, "IMAGE_FORMAT", "tiff")
+    monkeypatch.setattr(preprocessing.config, "EXTRACT_EMBEDDED_IMAGES", False)
+
+
+def _fake_pdf(tmp_path, num_pages):
+    filepath = tmp_path / "doc.pdf"
+    filepath.write_text(str(num_pages))
+    return str(filepath)
+
+
+def test_render_pdf_gives_each_page_its_own_image(monkeypatch, tmp_path, fake_poppler):
+    # Given
+    monkeypatch.setattr(preprocessing.config, "RENDER_PAGE_WINDOW", 8)
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+
+    # When
+    pages = preprocessing.render_pdf(str(raw_dir), _fake_pdf(tmp_path, 20))
+
+    # Then
+    assert [page.image.width - 10 for page in pages] == list(range(1, 21))
+
+
+def test_page_range_tasks_of_a_pdf_render_their_own_pages(
+    monkeypatch, tmp_path, fake_poppler
+):
+    # Given
+    monkeypatch.setattr(preprocessing.config, "RENDER_PAGE_WINDOW", 8)
+    monkeypatch.setattr(preprocessing.config, "SKIP_BLANK_PAGES", False)
+    monkeypatch.setattr(preprocessing.config, "PDF_READAHEAD_DIR", None)
+    raw_dir, processed_dir = tmp_path / "raw", tmp_path / "processed"
+    raw_dir.mkdir()
+    processed_dir.mkdir()
+
+    pdf_filepath = _fake_pdf(tmp_path, 12)
+    tasks = [
+        preprocessing.PageRangeTask(pdf_filepath, first_page=1, last_page=6),
+        preprocessing.PageRangeTask(pdf_filepath, first_page=7),
+    ]
+
+    # When: both ranges render into the same raw directory at once
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        results = pool.map(
+            lambda task: preprocessing.preprocess_task(
+                str(raw_dir), str(processed_dir), task
+            )[1],
+            tasks,
+        )
+
+    # Then
+    image_files = [f for result in results for f in result.image_files]
+    assert image_files == [
+        os.path.join(str(processed_dir), f"doc.pdf_{i}.tif") for i in range(12)
+    ]
+    for i, filepath in enumerate(image_files):
+        with PIL.Image.open(filepath) as im:
+            assert im.width - 10 == i + 1
+
+
+@pytest.mark.parametrize("save_raw_images", [True, False])
+def test_rasterise_only_writes_raw_images_when_configured(monkeypatch, save_raw_images):
+    # Given
+    calls = []
+
+    def convert_from_path(pdf_filepath, **kwargs):
+        calls.append(kwargs)
+        return [PIL.Image.new("L", (4, 4))]
+
+    monkeypatch.setattr(preprocessing.pdf2image, "convert_from_path", convert_from_path)
+    monkeypatch.setattr(preprocessing.config, "SAVE_RAW_IMAGES", save_raw_images)
+
+    # When
+    preprocessing._rasterise("raw", "test.pdf", 1, 1)
+
+    # Then
+    assert calls[0]["output_folder"] == ("raw" if save_raw_images else None)
+
+
+def test_save_processed_image_saves_bilevel_group4(monkeypatch, tmp_path):
+    # Given
+    monkeypatch.setattr(preprocessing.config, "PROCESSED_IMAGE_BILEVEL", True)
+    monkeypatch.setattr(preprocessing.config, "PROCESSED_IMAGE_COMPRESSION", "group4")
+    processed = preprocessing.preprocess_image(_scanned_page(0))
+    filepath = str(tmp_path / "page.tif")
+
+    # When
+    preprocessing.save_processed_image(processed, filepath, (300, 300))
+
+    # Then
+    with PIL.Image.open(filepath) as saved:
+        assert saved.mode == "1"
+        assert saved.info["compression"] == "group4"
+        assert saved.info["dpi"] == (300, 300)
+        assert np.array_equal(np.asarray(saved.convert("L")), np.asarray(processed))
+
+
+def test_plan_tasks_splits_long_pdfs_longest_first(monkeypatch):
+    # Given
+    class Batch(object):
+        def page_counts(self):
+            return [("short.pdf", 2), ("unknown.pdf", None), ("long.pdf", 7)]
+
+    monkeypatch.setattr(preprocessing.config, "SPLIT_PDF_PAGES", 3)
+    monkeypatch.setattr(preprocessing, "_probe_page_count", lambda f: 4)
+
+    # When
+    tasks = preprocessing.plan_tasks(Batch())
+
+    # Then
+    assert [task.key for task in tasks] == [
+        "unknown.pdf#pages=1-3",
+        "long.pdf#pages=1-3",
+        "long.pdf#pages=4-6",
+        "short.pdf",
+        "unknown.pdf#pages=4-",
+        "long.pdf#pages=7-",
+    ]
+    assert [task.last_page for task in tasks] == [3, 3, 6, None, None, None]
+
+
+def test_render_ahead_preprocesses_every_task(monkeypatch):
+    # Given
+    class Batch(object):
+        batch_id = 2
+
+        def page_counts(self):
+            return [(f"/pdfs/{i}.pdf", 1) for i in range(5)]
+
+    class WorkingDir(object):
+        batch_dir = "batch_02"
+        image_raw_dir = "raw"
+        image_processed_dir = "processed"
+        manifest = None
+
+    def preprocess_pdf(raw_dir, processed_dir, pdf_filepath, **kwargs):
+        return preprocessing.PreprocessedPdf(pdf_filepath, [f"{pdf_filepath}_0.tif"], 0)
+
+    monkeypatch.setattr(preprocessing, "preprocess_pdf", preprocess_pdf)
+
+    # When
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        ahead = preprocessing.RenderAhead(
+            Batch(), WorkingDir(), pool, max_in_flight=2
+        ).start()
+        results = list(ahead.results())
+
+    # Then
+    assert len(ahead.work()) == 5
+    assert sorted(task.pdf_filepath for task, _ in results) == [
+        f"/pdfs/{i}.pdf" for i in range(5)
+    ]
+
+
+def test_render_ahead_reads_ahead_and_profiles_into_its_batch(monkeypatch, tmp_path):
+    # Given
+    class Batch(object):
+        batch_id = 3
+
+        def page_counts(self):
+            return [(f"/pdfs/{i}.pdf", 1) for i in range(3)]
+
+    class WorkingDir(object):
+        batch_dir = str(tmp_path / "batch_03")
+        image_raw_dir = "raw"
+        image_processed_dir = "processed"
+        manifest = None
+
+    class Reader(object):
+        def __init__(self, pdf_filepaths):
+            self.pdf_filepaths = pdf_filepaths
+            self.done_pdfs = []
+            self.closed = False
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.closed = True
+
+        def done(self, pdf_filepath):
+            self.done_pdfs.append(pdf_filepath)
+
+    readers = []
+
+    def for_batch(batch, pdf_filepaths):
+        readers.append(Reader(pdf_filepaths))
+        return readers[-1]
+
+    def preprocess_pdf(raw_dir, processed_dir, pdf_filepath, **kwargs):
+        return preprocessing.PreprocessedPdf(pdf_filepath, [f"{pdf_filepath}_0.tif"], 0)
+
+    monkeypatch.setattr(preprocessing, "preprocess_pdf", preprocess_pdf)
+    monkeypatch.setattr(preprocessing.readahead, "for_batch", for_batch)
+    monkeypatch.setattr(preprocessing.profiling, "_profile_dir", str(tmp_path))
+
+    # When
+    with multiprocessing.pool.ThreadPool(1) as pool:
+        ahead = preprocessing.RenderAhead(
+            Batch(), WorkingDir(), pool, max_in_flight=1
+        ).start()
+        results = list(ahead.results())
+        ahead._thread.join(5)
+
+    # Then
+    (reader,) = readers
+    assert len(results) == 3
+    assert sorted(reader.done_pdfs) == sorted(reader.pdf_filepaths)
+    assert reader.closed
+    assert os.listdir(tmp_path / "batch_03" / "profiles")
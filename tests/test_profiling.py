@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+
+import ch_ocr_runner.utils.profiling as profiling
+
+
+def _busy_work(n):
+    return sum(i * i for i in range(n))
+
+
+def test_not_profiled_unless_turned_on(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.delenv(profiling.PROFILE_ENV_VAR, raising=False)
+    monkeypatch.setattr(profiling.config, "PROFILE_WORKERS", False)
+
+    # When
+    profiling.start_batch(str(tmp_path))
+
+    # Then
+    assert profiling.profiled("preprocess", _busy_work) is _busy_work
+    assert profiling.finish_batch() == []
+    assert not os.path.exists(os.path.join(str(tmp_path), profiling.PROFILE_DIRNAME))
+
+
+def test_worker_profiles_merged_per_stage(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv(profiling.PROFILE_ENV_VAR, "1")
+    profiling.start_batch(str(tmp_path))
+
+    busy_work = profiling.profiled("preprocess", _busy_work)
+
+    with multiprocessing.Pool(processes=2) as pool:
+        results = pool.map(busy_work, [10000] * 8, chunksize=1)
+
+    # When
+    stages = profiling.finish_batch()
+
+    # Then
+    assert results == [_busy_work(10000)] * 8
+    assert stages == ["preprocess"]
+
+    profile_dir = os.path.join(str(tmp_path), profiling.PROFILE_DIRNAME)
+    assert os.path.exists(os.path.join(profile_dir, "preprocess.prof"))
+
+    with open(os.path.join(profile_dir, "preprocess.txt")) as f:
+        report = f.read()
+
+    assert "_busy_work" in report
+    assert profiling.profiled("preprocess", _busy_work) is _busy_work
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+
+import pytest
+
+import ch_ocr_runner.readahead as readahead
+
+
+@pytest.fixture
+def readahead_dir(monkeypatch, tmp_path):
+    local_dir = tmp_path / "local"
+    monkeypatch.setattr(readahead.config, "PDF_READAHEAD_DIR", str(local_dir))
+    monkeypatch.setattr(readahead.config, "PDF_READAHEAD_MAX_BYTES_PER_SECOND", None)
+    return local_dir
+
+
+@pytest.fixture
+def pdfs(tmp_path):
+    shared_dir = tmp_path / "shared"
+    shared_dir.mkdir()
+
+    filepaths = []
+    for i in range(3):
+        filepath = shared_dir / f"doc_{i}.pdf"
+        filepath.write_bytes(f"%PDF-1.4 document {i}".encode("utf-8"))
+        filepaths.append(str(filepath))
+
+    return filepaths
+
+
+def _md5(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def test_local_copy_is_the_pdf_when_disabled(monkeypatch):
+    # Given
+    monkeypatch.setattr(readahead.config, "PDF_READAHEAD_DIR", None)
+
+    # When
+    filepath = readahead.local_copy("/shared/doc.pdf")
+
+    # Then
+    assert filepath == "/shared/doc.pdf"
+
+
+def test_local_copy_is_the_pdf_until_copied(readahead_dir):
+    # Given
+    pdf_filepath = "/shared/doc.pdf"
+
+    # When
+    filepath = readahead.local_copy(pdf_filepath)
+
+    # Then
+    assert filepath == pdf_filepath
+
+
+def test_digest_algorithm():
+    assert readahead.digest_algorithm("d41d8cd98f00b204e9800998ecf8427e") == "md5"
+    assert readahead.digest_algorithm("A" * 40) == "sha1"
+    assert readahead.digest_algorithm("0" * 64) == "sha256"
+    assert readahead.digest_algorithm("test") is None
+    assert readahead.digest_algorithm("g" * 32) is None
+    assert readahead.digest_algorithm(None) is None
+
+
+def test_copies_pdfs_and_removes_them_after_their_last_task(readahead_dir, pdfs):
+    # Given
+    tasks = [pdfs[0], pdfs[0], pdfs[1]]
+
+    # When
+    with readahead.ReadAhead(tasks, window=2, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+        copies = [readahead.local_copy(pdf) for pdf in pdfs[:2]]
+        contents = [open(copy, "rb").read() for copy in copies]
+
+        reader.done(pdfs[0])
+        after_first_task = os.path.exists(copies[0])
+        reader.done(pdfs[0])
+        after_last_task = os.path.exists(copies[0])
+
+    # Then
+    assert copies == [readahead.local_path(pdf) for pdf in pdfs[:2]]
+    assert contents == [open(pdf, "rb").read() for pdf in pdfs[:2]]
+    assert after_first_task
+    assert not after_last_task
+    assert reader.copied == 2
+    assert readahead.local_copy(pdfs[1]) == pdfs[1]
+
+
+def test_copies_only_the_window_ahead(readahead_dir, pdfs):
+    # Given
+    window = 2
+
+    # When
+    with readahead.ReadAhead(pdfs, window=window, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+        copied = [readahead.local_copy(pdf) != pdf for pdf in pdfs]
+
+    # Then
+    assert copied == [True, True, False]
+
+
+def test_matching_checksum_is_copied(readahead_dir, pdfs):
+    # Given
+    checksums = {pdfs[0]: _md5(pdfs[0]).upper()}
+
+    # When
+    with readahead.ReadAhead(pdfs[:1], checksums, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+        filepath = readahead.local_copy(pdfs[0])
+
+    # Then
+    assert filepath == readahead.local_path(pdfs[0])
+    assert reader.mismatches == 0
+
+
+def test_mismatched_checksum_is_discarded(readahead_dir, pdfs):
+    # Given
+    checksums = {pdfs[0]: "0" * 32}
+
+    # When
+    with readahead.ReadAhead(pdfs[:1], checksums, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+        filepath = readahead.local_copy(pdfs[0])
+
+    # Then
+    assert filepath == pdfs[0]
+    assert reader.mismatches == 1
+    assert reader.copied == 0
+
+
+def test_checksum_which_isnt_a_digest_is_not_checked(readahead_dir, pdfs):
+    # Given
+    checksums = {pdfs[0]: "test"}
+
+    # When
+    with readahead.ReadAhead(pdfs[:1], checksums, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+        filepath = readahead.local_copy(pdfs[0])
+
+    # Then
+    assert filepath == readahead.local_path(pdfs[0])
+    assert reader.mismatches == 0
+
+
+def test_copies_are_removed_on_exit(readahead_dir, pdfs):
+    # When
+    with readahead.ReadAhead(pdfs, threads=1) as reader:
+        reader._executor.shutdown(wait=True)
+
+    # Then
+    assert all(readahead.local_copy(pdf) == pdf for pdf in pdfs)
+    assert os.listdir(readahead_dir) == []
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import ch_ocr_runner.scratch as scratch
+
+
+@pytest.fixture
+def image_config(monkeypatch):
+    monkeypatch.setattr(scratch.config, "OCR_DPI", 300)
+    monkeypatch.setattr(scratch.config, "PROCESSED_IMAGE_BILEVEL", True)
+    monkeypatch.setattr(scratch.config, "PROCESSED_IMAGE_COMPRESSION", "group4")
+    monkeypatch.setattr(scratch.config, "SAVE_RAW_IMAGES", True)
+    monkeypatch.setattr(scratch.config, "EXTRACT_EMBEDDED_IMAGES", False)
+    monkeypatch.setattr(scratch, "_reserved", {})
+
+
+def test_plan_places_everything_within_budget(monkeypatch, tmp_path, image_config):
+    # Given
+    monkeypatch.setattr(scratch.config, "SCRATCH_MAX_BYTES", 10**12)
+
+    # When
+    placed = scratch.plan(10, str(tmp_path), str(tmp_path / "batch_01"))
+
+    # Then
+    assert placed == ["processed", "chunks", "tsv", "raw"]
+
+
+def test_plan_spills_directories_over_budget(monkeypatch, tmp_path, image_config):
+    # Given
+    pages = 100
+    estimates = scratch.estimate_bytes(pages)
+    budget = estimates["processed"] + estimates["chunks"] + estimates["tsv"]
+    monkeypatch.setattr(scratch.config, "SCRATCH_MAX_BYTES", budget)
+
+    # When
+    placed = scratch.plan(pages, str(tmp_path), str(tmp_path / "batch_01"))
+
+    # Then
+    assert placed == ["processed", "chunks", "tsv"]
+
+
+def test_batches_at_once_share_the_budget(monkeypatch, tmp_path, image_config):
+    # Given
+    pages = 100
+    monkeypatch.setattr(
+        scratch.config, "SCRATCH_MAX_BYTES", sum(scratch.estimate_bytes(pages).values())
+    )
+    current, ahead = str(tmp_path / "batch_01"), str(tmp_path / "batch_02")
+
+    # When: the next batch is planned while the current one is running
+    placed_current = scratch.plan(pages, str(tmp_path), current)
+    placed_ahead = scratch.plan(pages, str(tmp_path), ahead)
+
+    # Then
+    assert placed_current == ["processed", "chunks", "tsv", "raw"]
+    assert placed_ahead == []
+
+    # The current batch finishing frees its share
+    scratch.remove(current)
+    assert scratch.plan(pages, str(tmp_path), ahead) == placed_current
+
+
+def test_estimate_bytes_has_no_raw_images_when_not_saved(monkeypatch, image_config):
+    # Given
+    monkeypatch.setattr(scratch.config, "SAVE_RAW_IMAGES", False)
+
+    # Then
+    assert scratch.estimate_bytes(10)["raw"] == 0
+
+
+def test_placement_round_trips(tmp_path):
+    # Given
+    scratch.save_placement(str(tmp_path), "/dev/shm/batch_03", ["processed", "tsv"])
+
+    # Then
+    assert scratch.load_placement(str(tmp_path)) == (
+        "/dev/shm/batch_03",
+        ["processed", "tsv"],
+    )
+    assert scratch.load_placement(str(tmp_path / "other")) == (None, [])
+
+
+def test_batch_pages_counts_unknown_pdfs():
+    # Given
+    class Batch(object):
+        def page_counts(self):
+            return [("a.pdf", 3), ("b.pdf", None)]
+
+    # Then
+    assert scratch.batch_pages(Batch()) == 3 + scratch.UNKNOWN_PDF_PAGES
+
+
+def test_remove_deletes_batch_scratch_dir(tmp_path):
+    # Given
+    scratch_dir = tmp_path / "batch_01"
+    os.makedirs(scratch_dir / "tsv")
+
+    # When
+    scratch.remove(str(scratch_dir))
+
+    # Then
+    assert not scratch_dir.exists()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import os
+
+import PIL.Image
+import numpy as np
+import pytest
+
+import ch_ocr_runner.images.preprocessing as preprocessing
+import ch_ocr_runner.images.tesseract_engine as tesseract_engine
+
+
+class StubEngine(object):
+    """Stands in for `TesseractEngine`, a word per page giving the page size and DPI"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def tsv(self, image, page_index, dpi):
+        self.calls += 1
+        height, width = image.shape
+        return (
+            f"1\t{page_index + 1}\t0\t0\t0\t0\t0\t0\t{width}\t{height}\t-1\t\n"
+            f"5\t{page_index + 1}\t1\t1\t1\t1\t1\t1\t5\t5\t95\t{width}x{height}@{dpi}\n"
+        )
+
+
+@pytest.fixture
+def stub_engine(monkeypatch):
+    engine = StubEngine()
+    monkeypatch.setattr(tesseract_engine, "get_engine", lambda: engine)
+    return engine
+
+
+@pytest.fixture
+def fake_pdf(monkeypatch):
+    """A PDF of two pages, rendered at 200 DPI"""
+
+    def render_pdf(image_raw_dir, pdf_filepath, first_page=1, last_page=None):
+        for width in (40, 30):
+            yield preprocessing.RenderedPage(
+                PIL.Image.new("RGB", (width, 60), color="white"), dpi=(200, 200)
+            )
+
+    monkeypatch.setattr(preprocessing, "render_pdf", render_pdf)
+
+
+def test_ocr_pdf_writes_a_chunk_for_the_pdf(tmp_path, stub_engine, fake_pdf):
+    # When
+    chunk, hits, misses = tesseract_engine.ocr_pdf(
+        str(tmp_path), "processed", str(tmp_path), str(tmp_path), 3, "/pdfs/doc.pdf"
+    )
+
+    # Then
+    assert chunk.chunk_id == 3
+    assert chunk.filepaths == (
+        os.path.join("processed", "doc.pdf_0.tif"),
+        os.path.join("processed", "doc.pdf_1.tif"),
+    )
+    assert (hits, misses) == (0, 2)
+
+    with open(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv") as f:
+        rows = [line.rstrip("\n").split("\t") for line in f][1:]
+
+    assert [(row[1], row[-1]) for row in rows if row[0] == "5"] == [
+        ("1", "40x60@200"),
+        ("2", "30x60@200"),
+    ]
+
+
+def test_tsv_raises_when_tesseract_returns_no_text():
+    # Given
+    class Lib(object):
+        def __getattr__(self, name):
+            return lambda *args: 0
+
+        def TessBaseAPIGetTsvText(self, api, page_index):
+            return ctypes.POINTER(ctypes.c_char)()
+
+    engine = tesseract_engine.TesseractEngine.__new__(tesseract_engine.TesseractEngine)
+    engine._lib = Lib()
+    engine._api = 1
+
+    # When / Then
+    with pytest.raises(tesseract_engine.TesseractEngineError):
+        engine.tsv(np.zeros((10, 10), dtype=np.uint8), page_index=0, dpi=300)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from ch_ocr_runner.images.tesseract_options import TesseractOptions
+
+
+def test_default_command_template():
+    # Given
+    options = TesseractOptions()
+
+    # When
+    template = options.command_template()
+
+    # Then
+    assert template == "tesseract {chunk_path} {tsv_path} -l eng tsv"
+
+
+def test_command_template_with_all_options():
+    # Given
+    options = TesseractOptions(lang="eng+fra", oem=1, psm=6, tessdata_dir="/opt/fast")
+
+    # When
+    command = options.command_template().format(chunk_path="c.txt", tsv_path="out")
+
+    # Then
+    assert command == (
+        "tesseract c.txt out --tessdata-dir /opt/fast -l eng+fra --oem 1 --psm 6 tsv"
+    )
+
+
+def test_parse_overrides_base():
+    # Given
+    base = TesseractOptions(lang="eng", psm=4)
+
+    # When
+    options = TesseractOptions.parse("oem=1, psm=default", base=base)
+
+    # Then
+    assert options == TesseractOptions(lang="eng", oem=1, psm=None)
+
+
+def test_parse_rejects_unknown_keys():
+    with pytest.raises(ValueError):
+        TesseractOptions.parse("dpi=300", base=TesseractOptions())
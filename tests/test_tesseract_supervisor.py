@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import stat
+import sys
+
+import pytest
+
+import ch_ocr_runner.images.tesseract_supervisor as tesseract_supervisor
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+from ch_ocr_runner.manifest import BatchManifest
+from ch_ocr_runner.images.tesseract_wrapper import Chunk
+
+# Fake tesseract: hangs while a "hang" file holds a count above zero, and crashes
+# while the chunk's ".fail" file does, counting them down
+FAKE_TESSERACT = f"""#!{sys.executable}
+import os, sys, time
+chunk_path, tsv_path = sys.argv[1], sys.argv[2]
+hang_path = os.path.join(os.path.dirname(chunk_path), "hang")
+fail_path = chunk_path + ".fail"
+sys.stderr.write("Estimating resolution\\n")
+sys.stderr.flush()
+if os.path.exists(hang_path):
+    hangs = int(open(hang_path).read())
+    if hangs > 0:
+        open(hang_path, "w").write(str(hangs - 1))
+        time.sleep(60)
+if os.path.exists(fail_path):
+    fails = int(open(fail_path).read())
+    if fails > 0:
+        open(fail_path, "w").write(str(fails - 1))
+        sys.exit(1)
+with open(tsv_path + ".tsv", "w") as f:
+    f.write("level\\tpage_num\\n")
+"""
+
+
+@pytest.fixture
+def fake_tesseract(monkeypatch, tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    filepath = bin_dir / "tesseract"
+    filepath.write_text(FAKE_TESSERACT)
+    filepath.chmod(filepath.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def _chunks(tmp_path, n):
+    return [
+        Chunk([f"/images/doc.pdf_{i}.tif"], chunk_id=i, chunk_dir=str(tmp_path))
+        for i in range(n)
+    ]
+
+
+def _fail(chunk, times):
+    with open(f"{chunk.path}.fail", "w") as f:
+        f.write(str(times))
+
+
+def test_supervisor_runs_chunks_and_logs_stderr(tmp_path, fake_tesseract, caplog):
+    # Given
+    chunks = _chunks(tmp_path, 4)
+    caplog.set_level(logging.DEBUG, logger=tesseract_supervisor.logger.name)
+
+    # When
+    with tesseract_supervisor.TesseractSupervisor(max_processes=2) as supervisor:
+        results = [supervisor.submit(chunk, str(tmp_path)).result() for chunk in chunks]
+
+    # Then
+    assert [result.chunk for result in results] == chunks
+    assert all(result.returncode == 0 and result.attempts == 1 for result in results)
+    for chunk in chunks:
+        assert os.path.exists(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv")
+    assert "Estimating resolution" in caplog.text
+
+
+def test_supervisor_kills_and_retries_hung_chunk(tmp_path, fake_tesseract):
+    # Given
+    (chunk,) = _chunks(tmp_path, 1)
+    (tmp_path / "hang").write_text("1")
+
+    # When
+    with tesseract_supervisor.TesseractSupervisor(
+        timeout_per_page=0.5, retries=1
+    ) as supervisor:
+        result = supervisor.submit(chunk, str(tmp_path)).result()
+
+    # Then
+    assert result.attempts == 2
+    assert os.path.exists(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv")
+
+
+def test_supervisor_gives_up_after_retries(tmp_path, fake_tesseract):
+    # Given
+    (chunk,) = _chunks(tmp_path, 1)
+    (tmp_path / "hang").write_text("2")
+
+    # When
+    with tesseract_supervisor.TesseractSupervisor(
+        timeout_per_page=0.5, retries=1
+    ) as supervisor:
+        future = supervisor.submit(chunk, str(tmp_path))
+
+        # Then
+        with pytest.raises(tesseract_supervisor.TesseractTimeoutError):
+            future.result()
+
+
+def test_supervisor_retries_failed_chunk(tmp_path, fake_tesseract):
+    # Given
+    (chunk,) = _chunks(tmp_path, 1)
+    _fail(chunk, 1)
+
+    # When
+    with tesseract_supervisor.TesseractSupervisor(retries=1) as supervisor:
+        result = supervisor.submit(chunk, str(tmp_path)).result()
+
+    # Then
+    assert result.attempts == 2
+    assert result.succeeded
+
+
+def test_supervisor_raises_when_chunk_keeps_failing(tmp_path, fake_tesseract):
+    # Given
+    (chunk,) = _chunks(tmp_path, 1)
+    _fail(chunk, 2)
+
+    # When
+    with tesseract_supervisor.TesseractSupervisor(retries=1) as supervisor:
+        future = supervisor.submit(chunk, str(tmp_path))
+
+        # Then
+        with pytest.raises(tesseract_supervisor.TesseractFailedError):
+            future.result()
+    assert not os.path.exists(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv")
+
+
+def test_failed_chunk_is_not_recorded_as_done(tmp_path, fake_tesseract, monkeypatch):
+    # Given
+    monkeypatch.setattr(tesseract_wrapper.config, "TESSERACT_RETRIES", 1)
+    # One at a time, so the first chunk finishes before the second fails
+    monkeypatch.setattr(tesseract_supervisor, "NUM_PROCESSES", 1)
+    chunks = _chunks(tmp_path, 2)
+    _fail(chunks[1], 2)
+    manifest = BatchManifest(str(tmp_path))
+
+    # When
+    with pytest.raises(tesseract_supervisor.TesseractFailedError):
+        tesseract_wrapper._run_tesseract(chunks, str(tmp_path), manifest=manifest)
+
+    # Then
+    assert list(manifest.ocr_done()) == [chunks[0].chunk_id]
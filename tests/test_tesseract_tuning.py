@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import ch_ocr_runner.images.tesseract_tuning as tesseract_tuning
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+from ch_ocr_runner.images.tesseract_options import TesseractOptions
+
+
+def _result(psm, seconds, words, conf=90.0):
+    page_words = {
+        f"/images/doc.pdf_{i}.tif": (page, [conf] * len(page))
+        for i, page in enumerate(words)
+    }
+    return tesseract_tuning.TrialResult(TesseractOptions(psm=psm), seconds, page_words)
+
+
+def test_read_page_words(tmp_path):
+    # Given
+    image_files = ["/images/doc.pdf_0.tif", "/images/doc.pdf_1.tif"]
+    (chunk,) = tesseract_wrapper._create_chunks(image_files, chunk_dir=str(tmp_path))
+
+    tsv_filepath = str(tmp_path / "chunk.tsv")
+    with open(tsv_filepath, "w") as f:
+        f.write(tesseract_wrapper.TSV_HEADER)
+        f.write("1\t1\t0\t0\t0\t0\t0\t0\t10\t10\t-1\t\n")
+        f.write("5\t2\t1\t1\t1\t1\t0\t0\t5\t5\t80\tCompanies\n")
+        f.write("5\t2\t1\t1\t1\t2\t0\t0\t5\t5\t60\tHouse\n")
+
+    # When
+    page_words = tesseract_tuning.read_page_words(chunk, tsv_filepath)
+
+    # Then
+    assert page_words == {
+        "/images/doc.pdf_0.tif": ([], []),
+        "/images/doc.pdf_1.tif": (["Companies", "House"], [80.0, 60.0]),
+    }
+
+
+def test_fastest_setting_agreeing_with_reference_is_chosen():
+    # Given
+    pages = [["Annual", "return", "2019"], []]
+    reference = _result(psm=None, seconds=10, words=pages)
+    close = _result(psm=6, seconds=5, words=[["Annual", "return", "2019"], []])
+    faster_but_wrong = _result(psm=11, seconds=2, words=[["Anual", "retum"], ["x"]])
+    results = [reference, close, faster_but_wrong]
+
+    # When
+    tesseract_tuning.compare_to_reference(reference, results)
+    chosen = tesseract_tuning.choose(
+        reference, results[1:], min_agreement=0.95, max_conf_drop=5
+    )
+
+    # Then
+    assert reference.agreement == close.agreement == 1.0
+    assert faster_but_wrong.agreement < 0.5
+    assert chosen is close
+
+
+def test_reference_is_chosen_if_nothing_else_is_acceptable():
+    # Given
+    reference = _result(psm=None, seconds=10, words=[["a", "b"]], conf=90)
+    low_conf = _result(psm=6, seconds=1, words=[["a", "b"]], conf=70)
+
+    # When
+    tesseract_tuning.compare_to_reference(reference, [reference, low_conf])
+    chosen = tesseract_tuning.choose(
+        reference, [low_conf], min_agreement=0.95, max_conf_drop=5
+    )
+
+    # Then
+    assert chosen is reference
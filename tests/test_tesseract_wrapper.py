@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import ch_ocr_runner.images.tesseract_wrapper as tesseract_wrapper
+import ch_ocr_runner.leases as leases
+
+
+def test_create_chunks_splits_sorted_files_into_small_chunks(tmp_path):
+    # Given
+    image_files = [f"/images/doc.pdf_{i}.tif" for i in range(10)]
+
+    # When
+    chunks = tesseract_wrapper._create_chunks(
+        reversed(image_files), chunk_dir=str(tmp_path), pages_per_chunk=4
+    )
+
+    # Then
+    assert [len(chunk.filepaths) for chunk in chunks] == [4, 4, 2]
+    assert [chunk.chunk_id for chunk in chunks] == [0, 1, 2]
+
+    chunked_files = [f for chunk in chunks for f in chunk.filepaths]
+    assert chunked_files == sorted(image_files)
+
+
+def test_chunk_file_lists_pages_in_tsv_page_order(tmp_path):
+    # Given
+    image_files = ["/images/b.pdf_0.tif", "/images/a.pdf_1.tif", "/images/a.pdf_0.tif"]
+
+    # When
+    (chunk,) = tesseract_wrapper._create_chunks(
+        image_files, chunk_dir=str(tmp_path), pages_per_chunk=8
+    )
+
+    # Then
+    with open(chunk.path) as f:
+        saved_files = f.read().splitlines()
+
+    assert saved_files == list(chunk.filepaths) == sorted(image_files)
+    assert os.path.dirname(chunk.path) == str(tmp_path)
+
+
+def test_create_final_output_orders_pages_numerically(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(tesseract_wrapper.config, "OUTPUT_FORMAT", "csv")
+    monkeypatch.setattr(tesseract_wrapper.cor.output, "NUM_PROCESSES", 1)
+
+    image_files = [f"/images/doc_a.pdf_{i}.tif" for i in range(12)]
+    (chunk,) = tesseract_wrapper._create_chunks(
+        image_files, chunk_dir=str(tmp_path), pages_per_chunk=12
+    )
+
+    # Chunk order is by filename, so page 10 is the third page Tesseract sees
+    with open(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv", "w") as f:
+        f.write(tesseract_wrapper.TSV_HEADER)
+        for tesseract_page, image_file in enumerate(chunk.filepaths, 1):
+            f.write(f"5\t{tesseract_page}\t1\t1\t1\t1\t0\t0\t1\t1\t90\t{image_file}\n")
+
+    # When
+    tesseract_wrapper._create_final_output(
+        [chunk], tsv_dir=str(tmp_path), output_dir=str(tmp_path)
+    )
+
+    # Then
+    with open(os.path.join(str(tmp_path), "doc_a.pdf_output.csv")) as f:
+        rows = [line.rstrip("\n").split(",") for line in f][1:]
+
+    assert [row[0] for row in rows] == [str(i) for i in range(12)]
+    assert [row[-1] for row in rows] == image_files
+
+
+def test_create_final_output_not_written_after_lease_lost(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setattr(tesseract_wrapper.config, "OUTPUT_FORMAT", "csv")
+    (chunk,) = tesseract_wrapper._create_chunks(
+        ["/images/doc_a.pdf_0.tif"], chunk_dir=str(tmp_path)
+    )
+    with open(f"{chunk.tsv_filepath_no_suffix(str(tmp_path))}.tsv", "w") as f:
+        f.write(tesseract_wrapper.TSV_HEADER)
+        f.write("5\t1\t1\t1\t1\t1\t0\t0\t1\t1\t90\tword\n")
+
+    lease = leases.Lease(1, str(tmp_path / "batch_01.lease"), "token")
+    lease.lost.set()
+    monkeypatch.setattr(leases, "_held", lease)
+
+    # When
+    with pytest.raises(leases.LeaseLostError):
+        tesseract_wrapper._create_final_output(
+            [chunk], tsv_dir=str(tmp_path), output_dir=str(tmp_path)
+        )
+
+    # Then
+    assert not os.path.exists(os.path.join(str(tmp_path), "doc_a.pdf_output.csv"))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import csv
+
+import pandas as pd
+import pytest
+
+import ch_ocr_runner.images.tsv_reader as tsv_reader
+from ch_ocr_runner.images.tesseract_wrapper import TSV_HEADER
+
+ROWS = [
+    "1\t1\t0\t0\t0\t0\t0\t0\t2480\t3508\t-1\t",
+    '5\t1\t1\t1\t1\t1\t10\t10\t20\t20\t96\t"quoted',
+    "5\t1\t1\t1\t1\t2\t40\t10\t20\t20\t91\tNA",
+    "5\t1\t1\t1\t1\t3\t70\t10\t20\t20\t90\tnull",
+    "5\t2\t1\t1\t1\t1\t10\t10\t20\t20\t89\tit's\"",
+    "5\t2\t1\t1\t1\t2\t40\t10\t20\t20\t88\t#£1,000",
+    "5\t2\t1\t1\t1\t3\t70\t10\t20\t20\t87\t2019",
+]
+
+
+@pytest.fixture
+def tsv_filepath(tmp_path):
+    filepath = tmp_path / "chunk.tsv"
+    filepath.write_text(TSV_HEADER + "\n".join(ROWS) + "\n", encoding="utf-8")
+    return str(filepath)
+
+
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_read_tsv_matches_python_engine(tsv_filepath, engine):
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+
+    # Given
+    reference = pd.read_csv(
+        tsv_filepath,
+        sep="\t",
+        engine="python",
+        quotechar=None,
+        quoting=csv.QUOTE_NONE,
+        encoding="utf-8",
+    )
+
+    # When
+    df = tsv_reader.read_tsv(tsv_filepath, engine=engine)
+
+    # Then
+    pd.testing.assert_frame_equal(df, reference)
+    assert df.text.dtype == tsv_reader.TEXT_DTYPE
+    assert df.text.isna().tolist() == [True, False, True, True, False, False, False]
+
+
+def test_text_from_pyarrow_keeps_missing_words_missing():
+    # Given: the object column of str and None pyarrow gives before pandas 3
+    text = pd.Series(["quoted", None, "2019"], dtype=object)
+
+    # When
+    text = tsv_reader._text_as_c_parser(text)
+
+    # Then
+    assert text.dtype == tsv_reader.TEXT_DTYPE
+    assert text.isna().tolist() == [False, True, False]
+    assert "None" not in text.tolist()
+    assert text[0] == "quoted" and text[2] == "2019"
+
+
+@pytest.mark.parametrize("engine", ["c", "pyarrow"])
+def test_read_tsv_keeps_numeric_words_as_strings(tmp_path, engine):
+    if engine == "pyarrow":
+        pytest.importorskip("pyarrow")
+
+    # Given: a chunk where every word is a number
+    filepath = tmp_path / "chunk.tsv"
+    filepath.write_text(
+        TSV_HEADER
+        + "1\t1\t0\t0\t0\t0\t0\t0\t2480\t3508\t-1\t\n"
+        + "5\t1\t1\t1\t1\t1\t10\t10\t20\t20\t96\t2019\n"
+        + "5\t1\t1\t1\t1\t2\t40\t10\t20\t20\t95\t00123456\n",
+        encoding="utf-8",
+    )
+
+    # When
+    df = tsv_reader.read_tsv(str(filepath), engine=engine)
+
+    # Then
+    assert df.text.dtype == tsv_reader.TEXT_DTYPE
+    assert df.text.isna().tolist() == [True, False, False]
+    assert df.text.tolist()[1:] == ["2019", "00123456"]
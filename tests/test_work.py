@@ -60,3 +60,115 @@ def test_work_fetcher():
     work_list = list(work)
     assert len(work_list) == 1
     assert type(work_list[0]) == work_fetcher.WorkBatch
+
+
+def test_work_batch_page_counts():
+    # Given
+    df = pd.DataFrame(
+        {
+            "batch_id": [1, 1, 1],
+            "machine_allocation": ["TEST-MACHINE-01"] * 3,
+            "path": ["dummy1", "dummy2", "dummy3"],
+            "pages": [3, None, "unknown"],
+        }
+    )
+    batch = work_fetcher.WorkBatch(1, df)
+    batch.data = df  # Files don't exist, keep them all
+
+    # When
+    page_counts = [num_pages for _, num_pages in batch.page_counts()]
+
+    # Then
+    assert page_counts == [3, None, None]
+
+
+def test_with_checksums_keeps_the_checksum_of_each_pdf():
+    # Given
+    df = pd.DataFrame(
+        {
+            "path": ["full/a.pdf", "full/b.pdf", "full/c.pdf"],
+            "files": [
+                "[{'url': 'u1', 'path': 'full/a.pdf', 'checksum': 'abc'}, "
+                "{'url': 'u2', 'path': 'full/other.pdf', 'checksum': 'def'}]",
+                "[{'url': 'u3', 'path': 'b.pdf', 'checksum': 'test'}]",
+                "[{'url': 'u4'",
+            ],
+        }
+    )
+
+    # When
+    df = work_fetcher.with_checksums(df)
+
+    # Then
+    assert "files" not in df
+    assert df["checksum"].tolist()[:2] == ["abc", "test"]
+    assert pd.isna(df["checksum"].iloc[2])
+
+
+def test_work_batch_checksums():
+    # Given
+    df = pd.DataFrame(
+        {
+            "batch_id": [1, 1],
+            "machine_allocation": ["TEST-MACHINE-01"] * 2,
+            "path": ["dummy1", "dummy2"],
+            "checksum": ["abc", None],
+        }
+    )
+    batch = work_fetcher.WorkBatch(1, df)
+    batch.data = df  # Files don't exist, keep them all
+
+    # When
+    checksums = batch.checksums()
+
+    # Then
+    assert list(checksums.values()) == ["abc"]
+    assert list(checksums)[0].endswith("dummy1")
+
+
+def test_fetch_other_machines_reverses_batches(tmp_path, monkeypatch):
+    # Given
+    monkeypatch.setenv(config.MACHINE_ENV_VAR, "TEST-MACHINE-01")
+    monkeypatch.setattr(work_fetcher.config, "FILE_INDEX_ENABLED", False)
+
+    allocation_filepath = str(tmp_path / "allocation.csv")
+    pd.DataFrame(
+        {
+            "batch_id": [1, 2, 3, 4],
+            "machine_allocation": ["TEST-MACHINE-01", "M2", "M2", "M3"],
+            "path": ["dummy1", "dummy2", "dummy3", "dummy4"],
+        }
+    ).to_csv(allocation_filepath, index=False)
+
+    # When
+    batches = list(
+        work_fetcher.fetch_other_machines(
+            allocation_filepath, store_filepath=str(tmp_path / "missing.sqlite")
+        )
+    )
+
+    # Then
+    assert [batch.batch_id for batch in batches] == [4, 3, 2]
+
+
+def test_prefetch_pairs_each_batch_with_the_next():
+    # Given
+    built = []
+
+    def batches():
+        for batch_id in range(3):
+            built.append(batch_id)
+            yield batch_id
+
+    # When
+    pairs = work_fetcher.prefetch(batches())
+    first = next(pairs)
+
+    # Then
+    assert first == (0, 1)
+    assert list(pairs) == [(1, 2), (2, None)]
+    assert built == [0, 1, 2]
+
+
+def test_prefetch_of_no_batches_is_empty():
+    assert list(work_fetcher.prefetch([])) == []